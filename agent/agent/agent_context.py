@@ -1,11 +1,16 @@
+import asyncio
+import threading
+import time
+
 from pydantic import BaseModel, Field
 from typing import Optional, List
 
+from agent.llm.usage_ledger import UsageLedger
 from agent.tool.base_tool import BaseTool
 from agent.tool.mcp_tool import McpTool
 from loguru import logger
 from asyncio import Queue
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 
 class McpToolInfo(BaseModel):
@@ -15,6 +20,83 @@ class McpToolInfo(BaseModel):
     parameters: Optional[str] = None
 
 
+class CancelToken:
+    """
+    运行取消标记，客户端断开等场景下由服务端设置，
+    agent循环、LLM流及工具流式请求检查该标记，并通过回调关闭阻塞中的流
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks = list()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks = list(self._callbacks)
+            self._callbacks.clear()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.warning(f"cancel callback {callback} error")
+
+    def register(self, callback):
+        """注册取消回调，已取消时立即执行"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def unregister(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise asyncio.CancelledError()
+
+    async def aiterate(self, aiterable):
+        """异步迭代流式响应，取消时中断并抛出CancelledError，结束后关闭响应"""
+        try:
+            async for item in aiterable:
+                self.raise_if_cancelled()
+                yield item
+        finally:
+            close = getattr(aiterable, "close", None)
+            if close is not None:
+                await close()
+
+    def iterate(self, iterable, close=None):
+        """
+        迭代流式响应，取消时通过close关闭响应，迭代中断并抛出CancelledError
+        :close: 关闭响应的函数，默认使用iterable.close
+        """
+        close = close or getattr(iterable, "close", None)
+        if close is not None:
+            self.register(close)
+        try:
+            for item in iterable:
+                self.raise_if_cancelled()
+                yield item
+        except Exception:
+            # 响应被关闭导致的读取异常，以取消处理
+            self.raise_if_cancelled()
+            raise
+        finally:
+            if close is not None:
+                self.unregister(close)
+
+
 class ToolCollection:
     def __init__(
             self,
@@ -30,19 +112,43 @@ class ToolCollection:
         # 数字员工列表相关
         self.current_task = current_task
         self.digital_employees = digital_employees
+        # 工具列表版本，增删工具时递增，工具schema缓存按版本失效
+        self.version = 0
+        self._schema_cache = dict()
+
+    def _tools_changed(self):
+        self.version += 1
+        self._schema_cache.clear()
 
     def add_tool(self, tool: BaseTool):
         self.tool_map[tool.name] = tool
+        self._tools_changed()
+
+    def remove_tool(self, name):
+        if self.tool_map.pop(name, None) is not None or self.mcp_tool_map.pop(name, None) is not None:
+            self._tools_changed()
 
     def get_tool(self, name) -> BaseTool:
         return self.tool_map[name]
 
     def add_mcp_tool(self, name, desc, params, mcp_server_url):
         self.mcp_tool_map[name] = McpToolInfo(name=name, desc=desc, parameters=params, mcp_server_url=mcp_server_url)
+        self._tools_changed()
 
     def get_mcp_tool(self, name):
         return self.mcp_tool_map[name]
 
+    def cached_schema(self, form: str, build):
+        """
+        获取指定格式的工具schema，当前版本未生成时调用build生成并缓存
+        返回的对象在多次调用间共享，调用方不能修改
+        """
+        schema = self._schema_cache.get(form, None)
+        if schema is None:
+            schema = build()
+            self._schema_cache[form] = schema
+        return schema
+
     async def execute(self, name, tool_input):
         if name in self.tool_map:
             tool = self.get_tool(name)
@@ -93,3 +199,38 @@ class AgentContext:
     task_product_files: Optional[list] = None
     template_type: Optional[str] = None
     queue: Optional[Queue] = None
+    cancel_token: CancelToken = field(default_factory=CancelToken)
+    # 请求截止时间（时间戳，秒），为空时不限制
+    deadline: Optional[float] = None
+    # 本次运行的LLM调用记录
+    usage_ledger: UsageLedger = field(default_factory=UsageLedger)
+
+    def remaining_seconds(self):
+        """距离截止时间的剩余秒数，未设置截止时间时返回None"""
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+    def deadline_reached(self, reserve: float = 0):
+        """剩余时间不超过reserve秒"""
+        remaining = self.remaining_seconds()
+        return remaining is not None and remaining <= reserve
+
+    def timeout_for(self, default):
+        """
+        根据剩余时间计算调用超时，不超过默认值，最少1秒
+        :default: 默认超时，数字或(连接超时, 读取超时)
+        """
+        remaining = self.remaining_seconds()
+        if remaining is None:
+            return default
+        if isinstance(default, tuple):
+            return tuple(max(1, min(item, remaining)) for item in default)
+        return max(1, min(default, remaining))
+
+    async def aiterate(self, aiterable):
+        """异步迭代工具流式响应，支持取消，超过截止时间时中断"""
+        async for item in self.cancel_token.aiterate(aiterable):
+            if self.deadline_reached():
+                raise TimeoutError(f"{self.request_id} request deadline exceeded")
+            yield item
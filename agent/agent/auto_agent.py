@@ -9,7 +9,7 @@ from agent.tool.common.multi_modal_agent_tool import MultiModalAgent
 from agent.tool.common.report_tool import ReportTool
 from agent.tool.mcp_tool import McpTool
 from model.protocal import AgentRequest
-from agent.agent.agent_context import AgentContext, ToolCollection
+from agent.agent.agent_context import AgentContext, ToolCollection, CancelToken
 from util import date_util
 from handler.react_handler import ReactHandler
 from handler.plan_solve_handler import PlanSolveHandler
@@ -23,7 +23,7 @@ langfuse = Langfuse(
     host="https://cloud.langfuse.com"
 )
 
-def build_tool_collection(agent_context: AgentContext, agent_request: AgentRequest):
+async def build_tool_collection(agent_context: AgentContext, agent_request: AgentRequest):
     tool_collection = ToolCollection(agent_context)
     if "dataAgent" == agent_request.output_style:
         pass # todo 智能问数暂未开发
@@ -66,7 +66,7 @@ def build_tool_collection(agent_context: AgentContext, agent_request: AgentReque
                 agent_context=agent_context
             )
             for mcp_server in genie_config.mcp_server_url_arr:
-                list_tool_result = mcp_tool.list_tool(mcp_server)
+                list_tool_result = await mcp_tool.list_tool(mcp_server)
                 if len(list_tool_result) == 0:
                     logger.error(f"{agent_context.request_id} mcp server {mcp_server} invalid")
                     continue
@@ -91,8 +91,11 @@ def build_tool_collection(agent_context: AgentContext, agent_request: AgentReque
 
 
 class AutoAgent(object):
-    def __init__(self, queue):
+    def __init__(self, queue, cancel_token: CancelToken = None, deadline: float = None):
         self.queue = queue or asyncio.Queue()
+        self.cancel_token = cancel_token or CancelToken()
+        self.deadline = deadline
+        self.context = None
         self.handlers = [ReactHandler(genie_config), PlanSolveHandler(genie_config)]
 
     def _get_handler(self, agent_type):
@@ -116,8 +119,11 @@ class AutoAgent(object):
             agent_context.is_stream = request.is_stream if request.is_stream is not None else False
             agent_context.template_type = "fix" if "dataAgent" == request.output_style else "empty"
             agent_context.queue = self.queue
+            agent_context.cancel_token = self.cancel_token
+            agent_context.deadline = self.deadline
+            self.context = agent_context
 
-            agent_context.tool_collection = build_tool_collection(agent_context, request)
+            agent_context.tool_collection = await build_tool_collection(agent_context, request)
             handler = self._get_handler(request.agent_type)
             with langfuse.start_as_current_observation(as_type="span", name=handler.__class__.__name__) as span:
                 result = await handler.handle(agent_context, request)
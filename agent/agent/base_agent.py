@@ -10,6 +10,36 @@ from agent.entity.enums import RoleType
 from agent.agent.message import Message
 from loguru import logger
 from concurrent.futures import ThreadPoolExecutor
+from util.metrics import metrics
+from agent.llm.usage_ledger import call_scope
+from config.genie_config import genie_config
+
+
+class ToolDispatcher:
+    """
+    提前执行工具：模型流式输出过程中，工具调用参数完整后立即开始执行，与模型后续输出并行
+    执行结果仍由execute_tools按工具调用顺序收集
+    """
+
+    def __init__(self, execute):
+        self._execute = execute
+        self._tasks = dict()
+
+    def dispatch(self, tool_call: ToolCall):
+        # 没有id时无法与最终的工具调用对应，等模型输出结束后再执行
+        if not tool_call.id or tool_call.id in self._tasks:
+            return
+        self._tasks[tool_call.id] = asyncio.create_task(self._execute(tool_call))
+        metrics.inc("tool_early_dispatched")
+
+    def pop(self, tool_call: ToolCall):
+        return self._tasks.pop(tool_call.id, None)
+
+    def cancel(self):
+        """取消未被收集的工具执行，如思考过程出错时"""
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
 
 
 class BaseAgent:
@@ -46,10 +76,17 @@ class BaseAgent:
         self.duplicate_threshold = duplicate_threshold
         self.queue = queue
         self.digital_employee_prompt = digital_employee_prompt
+        self.tool_dispatcher = None
 
     async def step(self):
         pass
 
+    def new_tool_dispatcher(self):
+        """开启提前执行工具时创建dispatcher"""
+        if "1" != genie_config.early_tool_dispatch:
+            return None
+        return ToolDispatcher(self.execute_tool)
+
     async def run(self, query: str):
         """运行代理主循环"""
         self.state = AgentState.IDLE
@@ -57,9 +94,20 @@ class BaseAgent:
             # 修改记忆
             self.update_memory(RoleType.USER, query, None)
         results = list()
+        # LLM调用记录按agent及步数标记，运行结束后恢复
+        scope = call_scope.set((self.name, self.current_step))
         try:
             while self.current_step < self.max_steps and self.state != AgentState.FINISHED:
+                self.context.cancel_token.raise_if_cancelled()
+                if self.context.deadline_reached(genie_config.agent_deadline_reserve_seconds):
+                    # 剩余时间仅够总结，不再执行新的步骤
+                    logger.warning(f"{self.context.request_id} {self.name} stop at step {self.current_step}/{self.max_steps}, "
+                                   f"request deadline is nearly reached")
+                    metrics.inc("agent_deadline_stopped", agent=self.name)
+                    results.append("Terminated: Reached request deadline")
+                    break
                 self.current_step += 1
+                call_scope.set((self.name, self.current_step))
                 logger.info(
                     f"{self.context.request_id} {self.name} Executing step {self.current_step}/{self.max_steps}")
                 step_result = await self.step()
@@ -68,10 +116,18 @@ class BaseAgent:
                 self.current_step = 0
                 self.state = AgentState.IDLE
                 results.append(f"Terminated: Reached max steps ({self.max_steps}")
+        except asyncio.CancelledError:
+            # 客户端断开等原因取消运行，记录未执行的步数
+            self.state = AgentState.FINISHED
+            metrics.inc("agent_steps_saved", self.max_steps - self.current_step, agent=self.name)
+            logger.info(f"{self.context.request_id} {self.name} cancelled at step {self.current_step}/{self.max_steps}")
+            raise
         except Exception as e:
             self.state = AgentState.ERROR
             logger.error(f"{self.context.request_id} Terminated: {str(e)}")
             # raise Exception(traceback.format_exc()) todo,这里抛出异常会导致前端一直卡住，java版本这里是否需要注释掉
+        finally:
+            call_scope.reset(scope)
         return "No steps executed" if len(results) == 0 else results[-1]
 
     def update_memory(self, role: RoleType, content: str, base64_image, *args):
@@ -111,8 +167,16 @@ class BaseAgent:
         :tool_calls: 工具调用命令列表
         return: 返回工具执行结果映射，key为工具ID，value为执行结果
         """
-        tasks = [asyncio.create_task(self.execute_tool(command)) for command in tool_calls]
-        results = await asyncio.gather(*(task for task in tasks))
+        tasks = list()
+        for command in tool_calls:
+            task = self.tool_dispatcher.pop(command) if self.tool_dispatcher is not None else None
+            tasks.append(task if task is not None else asyncio.create_task(self.execute_tool(command)))
+        try:
+            results = await asyncio.gather(*(task for task in tasks))
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+            raise
         result_dict = {}
         for result, tool_call in zip(results, tool_calls):
             result_dict[tool_call.id] = result
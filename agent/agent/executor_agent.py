@@ -65,13 +65,14 @@ class ExecutorAgent(BaseReActAgent):
             logger.info(f"{self.context.request_id} executor ask tool {self.available_tools}")
             response = await self.llm.ask_tool(
                 self.context,
-                self.memory.messages,
+                self.memory,
                 Message.system_message(self.system_prompt, None),
                 self.available_tools,
                 ToolChoice.AUTO.value,
                 False,
                 300,
-                None
+                None,
+                self.tool_dispatcher
             )
 
             # 记录响应信息
@@ -157,7 +158,7 @@ class ExecutorAgent(BaseReActAgent):
 
     async def run(self, query: str):
         # 数字员工设置
-        self.generate_digital_employee(query)
+        await self.generate_digital_employee(query)
         query = genie_config.task_pre_prompt + query
         self.context.task = query
         return await super().run(query)
\ No newline at end of file
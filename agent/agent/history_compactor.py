@@ -0,0 +1,150 @@
+import asyncio
+import traceback
+from typing import List
+
+from loguru import logger
+
+from agent.agent.message import Message, Memory
+from agent.entity.enums import RoleType
+from agent.llm.llm import LLM
+from agent.prompt.history_compact_prompt import HistoryCompactPrompt
+from config.genie_config import genie_config
+from util.metrics import metrics
+
+# 摘要消息的开头，再次压缩时上一次的摘要与之后的历史一起合并
+DIGEST_PREFIX = "以下是之前步骤的执行摘要："
+
+
+class HistoryCompactor:
+    """
+    滚动压缩历史：记忆的token数超过水位线时，在后台调用LLM将最早的工具调用及结果合并为一条摘要，
+    摘要完成后在下一步开始时替换原消息，不阻塞当前步骤
+    开头的系统、用户消息及最近keep_rounds轮（以用户消息分隔）保持原样
+    """
+
+    def __init__(self, context, memory: Memory, llm: LLM):
+        self.context = context
+        self.memory = memory
+        self.llm = llm
+        self._task = None
+        # 被压缩的消息及压缩时的内容，替换前校验
+        self._span = None
+
+    @staticmethod
+    def enabled():
+        return "1" == genie_config.history_compact_enable and genie_config.history_compact_watermark > 0
+
+    def schedule(self):
+        """记忆超过水位线且没有进行中的压缩时，后台生成最早部分历史的摘要"""
+        if self._task is not None:
+            return
+        tokens = self.memory.context_window.total_tokens(self.llm.token_counter)
+        if tokens <= genie_config.history_compact_watermark:
+            return
+        span = self._select_span()
+        if span is None:
+            return
+        logger.info(f"{self.context.request_id} compact {len(span)} history messages, memory tokens {tokens}")
+        self._span = [(message, message.content) for message in span]
+        self._task = asyncio.create_task(self._digest(span))
+
+    def apply(self):
+        """
+        压缩完成时用摘要替换原消息，压缩期间原消息被删除或修改时放弃
+        return: 是否替换
+        """
+        if self._task is None or not self._task.done():
+            return False
+        task, span = self._task, self._span
+        self._task = None
+        self._span = None
+        if task.cancelled() or not task.result():
+            return False
+        start = self._find(span)
+        if start is None:
+            metrics.inc("history_compact_discarded")
+            return False
+        token_counter = self.llm.token_counter
+        before = self.memory.context_window.total_tokens(token_counter)
+        digest = Message.assistant_message(DIGEST_PREFIX + "\n" + task.result(), None)
+        self.memory.replace_messages(start, start + len(span), [digest])
+        after = self.memory.context_window.total_tokens(token_counter)
+        metrics.inc("history_compacted")
+        metrics.inc("history_compact_saved_tokens", before - after)
+        logger.info(f"{self.context.request_id} history compacted {len(span)} messages, tokens {before} -> {after}")
+        return True
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._task = None
+        self._span = None
+
+    def _select_span(self):
+        """开头的系统、用户消息之后，到倒数第keep_rounds条用户消息之前的部分，需要包含工具调用"""
+        messages = self.memory.messages
+        start = 0
+        while start < len(messages) and messages[start].role in (RoleType.SYSTEM, RoleType.USER):
+            start += 1
+        rounds = [index for index in range(start, len(messages)) if messages[index].role == RoleType.USER]
+        keep_rounds = max(1, genie_config.history_compact_keep_rounds)
+        if len(rounds) < keep_rounds:
+            return None
+        span = messages[start:rounds[-keep_rounds]]
+        if not any(self._is_tool_message(message) for message in span):
+            return None
+        return span
+
+    @staticmethod
+    def _is_tool_message(message: Message):
+        if message.role == RoleType.TOOL or message.tool_calls:
+            return True
+        # struct_parse模式下工具结果追加在助手消息中
+        return message.role == RoleType.ASSISTANT and message.content is not None \
+            and "工具执行结果为" in message.content
+
+    def _find(self, span: list):
+        messages = self.memory.messages
+        for start, message in enumerate(messages):
+            if message is span[0][0]:
+                break
+        else:
+            return None
+        if start + len(span) > len(messages):
+            return None
+        for offset, (message, content) in enumerate(span):
+            current = messages[start + offset]
+            if current is not message or current.content is not content:
+                return None
+        return start
+
+    @staticmethod
+    def _format(messages: List[Message]):
+        lines = list()
+        limit = genie_config.message_size_limit
+        for message in messages:
+            content = message.content or ""
+            if len(content) > limit:
+                content = content[:limit] + "..."
+            lines.append(f"role:{message.role.name} content:{content}")
+            for tool_call in message.tool_calls or []:
+                if tool_call.function is not None:
+                    lines.append(f"tool_call:{tool_call.function.name} arguments:{tool_call.function.arguments}")
+        return "\n".join(lines)
+
+    async def _digest(self, span: List[Message]):
+        """生成摘要，温度为0，相同的历史命中LLM响应缓存"""
+        try:
+            prompt = genie_config.history_compact_prompt or HistoryCompactPrompt.PROMPT
+            prompt = prompt.replace("{{query}}", self.context.query or "") \
+                .replace("{{history}}", self._format(span))
+            llm = LLM(genie_config.history_compact_model_name, "") if genie_config.history_compact_model_name \
+                else self.llm
+            return await llm.ask(self.context, [Message.user_message(prompt, None)], [], False, 0)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.warning(f"{self.context.request_id} history compact failed")
+            logger.warning(traceback.format_exc())
+            metrics.inc("history_compact_failed")
+            return None
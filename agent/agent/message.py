@@ -1,4 +1,6 @@
-from pydantic import BaseModel
+import bisect
+
+from pydantic import BaseModel, PrivateAttr
 
 from agent.entity.enums import RoleType
 from typing import Optional, List
@@ -21,6 +23,32 @@ class Message(BaseModel):
     base64_image: Optional[str] = None
     tool_call_id: Optional[str] = None
     tool_calls: List[ToolCall] = None
+    # token数缓存：(分词器, content, tool_calls, base64_image, token数)，字段被重新赋值后失效
+    _token_cache: Optional[tuple] = PrivateAttr(default=None)
+    # 格式化结果缓存：(格式, role, content, tool_calls, base64_image, tool_call_id, 格式化结果)，字段被重新赋值后失效
+    _format_cache: Optional[tuple] = PrivateAttr(default=None)
+
+    def cached_token_count(self, tokenizer: str):
+        cache = self._token_cache
+        if cache is None or cache[0] != tokenizer or cache[1] is not self.content \
+                or cache[2] is not self.tool_calls or cache[3] is not self.base64_image:
+            return None
+        return cache[4]
+
+    def cache_token_count(self, tokenizer: str, count: int):
+        self._token_cache = (tokenizer, self.content, self.tool_calls, self.base64_image, count)
+
+    def cached_format(self, form: str):
+        cache = self._format_cache
+        if cache is None or cache[0] != form or cache[1] is not self.role or cache[2] is not self.content \
+                or cache[3] is not self.tool_calls or cache[4] is not self.base64_image \
+                or cache[5] is not self.tool_call_id:
+            return None
+        return cache[6]
+
+    def cache_format(self, form: str, formatted: dict):
+        self._format_cache = (form, self.role, self.content, self.tool_calls, self.base64_image, self.tool_call_id,
+                              formatted)
 
     @classmethod
     def user_message(cls, content: str, base64_image: str):
@@ -48,9 +76,73 @@ class Message(BaseModel):
         return Message(role=RoleType.ASSISTANT, content=content, tool_calls=tool_calls)
 
 
+class ContextWindow:
+    """
+    按token上限截取消息窗口，维护消息token数的前缀和，追加消息时只计算新消息
+    窗口从用户消息开始，保证工具调用与工具结果成对出现，开头的系统消息始终保留
+    """
+
+    def __init__(self, messages: List[Message]):
+        self.messages = messages
+        self._prefix = [0]
+        self._last = None
+        self._tokenizer = None
+
+    def invalidate(self):
+        """删除或替换消息、修改非最后一条消息的内容后调用，下次计算时重建"""
+        self._prefix = [0]
+        self._last = None
+
+    def _count(self, token_counter, index: int):
+        return self._prefix[index] + token_counter.count_message_tokens(self.messages[index])
+
+    def sync(self, token_counter):
+        """同步消息列表的变化：追加的消息计入前缀和，最后一条已计入的消息内容变化时重新计算"""
+        if self._tokenizer != token_counter.tokenizer.name:
+            self._tokenizer = token_counter.tokenizer.name
+            self.invalidate()
+        tracked = len(self._prefix) - 1
+        if tracked > len(self.messages) or (tracked != 0 and self.messages[tracked - 1] is not self._last):
+            self.invalidate()
+            tracked = 0
+        if tracked != 0:
+            self._prefix[tracked] = self._count(token_counter, tracked - 1)
+        for index in range(tracked, len(self.messages)):
+            self._prefix.append(self._count(token_counter, index))
+        self._last = self.messages[-1] if len(self.messages) != 0 else None
+
+    def total_tokens(self, token_counter):
+        self.sync(token_counter)
+        return self._prefix[-1]
+
+    def window(self, token_counter, max_tokens: int):
+        """
+        返回不超过max_tokens的消息窗口，max_tokens不大于0时不截取
+        二分查找截取位置，再跳过位于窗口开头的非用户消息
+        """
+        self.sync(token_counter)
+        total = self._prefix[-1]
+        if max_tokens <= 0 or total <= max_tokens:
+            return list(self.messages)
+        start = 1 if self.messages[0].role == RoleType.SYSTEM else 0
+        # 第一个满足 total - prefix[cut] <= 剩余额度 的位置
+        budget = max_tokens - self._prefix[start]
+        cut = bisect.bisect_left(self._prefix, total - budget, start, len(self.messages))
+        index = cut
+        while index < len(self.messages) and self.messages[index].role != RoleType.USER:
+            index += 1
+        if index == len(self.messages):
+            # 没有用户消息时只跳过缺少工具调用的工具结果
+            index = cut
+            while index < len(self.messages) and self.messages[index].role == RoleType.TOOL:
+                index += 1
+        return self.messages[:start] + self.messages[index:]
+
+
 class Memory:
     def __init__(self):
         self.messages: List[Message] = list()
+        self.context_window = ContextWindow(self.messages)
 
     def add_message(self, message: Message):
         """添加消息"""
@@ -67,6 +159,7 @@ class Memory:
     def clear(self):
         """清空消息"""
         self.messages.clear()
+        self.context_window.invalidate()
 
     #作用是什么？
     def clear_tool_context(self):
@@ -83,6 +176,12 @@ class Memory:
                 remove_messages.append(message)
         for message in remove_messages:
             self.messages.remove(message)
+        self.context_window.invalidate()
+
+    def replace_messages(self, start: int, end: int, messages: List[Message]):
+        """将[start, end)范围的消息替换为messages"""
+        self.messages[start:end] = messages
+        self.context_window.invalidate()
 
     def format_messsages(self):
         """格式化message"""
@@ -67,7 +67,7 @@ class PlanningAgent(BaseReActAgent):
             self.context.stream_message_type = "plan_thought"
             plan_response = await self.llm.ask_tool(
                 self.context,
-                self.memory.messages,
+                self.memory,
                 Message.system_message(self.system_prompt, None),
                 self.available_tools,
                 ToolChoice.AUTO.value,
@@ -5,6 +5,7 @@ import traceback
 from loguru import logger
 import json_repair
 from agent.agent.base_agent import BaseAgent
+from agent.agent.history_compactor import HistoryCompactor
 from typing import Optional, List
 from agent.agent.message import Message, ToolCall
 from agent.agent.agent_context import AgentContext
@@ -23,6 +24,7 @@ class BaseReActAgent(BaseAgent):
             *args, **kwargs
     ):
         super().__init__(*args, **kwargs)
+        self.history_compactor = None
 
     async def think(self):
         """思考过程"""
@@ -34,12 +36,37 @@ class BaseReActAgent(BaseAgent):
 
     async def step(self):
         """执行单个步骤"""
-        should_act = await self.think()
-        if not should_act:
-            return "Thinking complete - no action needed"
-        return await self.act()
+        compactor = self.get_history_compactor()
+        if compactor is not None:
+            compactor.apply()
+        self.tool_dispatcher = self.new_tool_dispatcher()
+        try:
+            should_act = await self.think()
+            if not should_act:
+                return "Thinking complete - no action needed"
+            result = await self.act()
+            if compactor is not None and self.state != AgentState.FINISHED:
+                compactor.schedule()
+            return result
+        finally:
+            if self.tool_dispatcher is not None:
+                self.tool_dispatcher.cancel()
+                self.tool_dispatcher = None
+
+    def get_history_compactor(self):
+        """开启历史压缩时创建compactor，llm在子类构造时设置"""
+        if self.history_compactor is None and self.llm is not None and HistoryCompactor.enabled():
+            self.history_compactor = HistoryCompactor(self.context, self.memory, self.llm)
+        return self.history_compactor
+
+    async def run(self, query: str):
+        try:
+            return await super().run(query)
+        finally:
+            if self.history_compactor is not None:
+                self.history_compactor.cancel()
 
-    def generate_digital_employee(self, task):
+    async def generate_digital_employee(self, task):
         # 参数检查
         if task is None or len(task) == 0:
             return
@@ -47,7 +74,7 @@ class BaseReActAgent(BaseAgent):
             format_digital_prompt = self.format_digital_prompt(task)
             user_message = Message.user_message(format_digital_prompt, None)
 
-            result = self.llm.ask(
+            result = await self.llm.ask(
                 self.context,
                 [user_message],
                 [],
@@ -158,13 +185,14 @@ class ReActAgent(BaseReActAgent):
             self.context.stream_message_type = "tool_thought"
             response = await self.llm.ask_tool(
                 self.context,
-                self.memory.messages,
+                self.memory,
                 Message.system_message(self.system_prompt, None),
                 self.available_tools,
                 ToolChoice.AUTO.value,
                 self.context.is_stream,
                 300,
-                None
+                None,
+                self.tool_dispatcher
             )
             self.tool_calls = response.tool_calls
             # 记录响应信息
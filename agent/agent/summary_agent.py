@@ -84,7 +84,7 @@ class SummaryAgent(BaseAgent):
 
         return TaskSummaryResult(task_summary=summary, files=product)
 
-    def summary_task_result(
+    async def summary_task_result(
             self,
             messages: Optional[List[Message]] = None,
             query: Optional[str] = ""
@@ -105,7 +105,7 @@ class SummaryAgent(BaseAgent):
                 format_messages.append(f"role:{message.role.value} content:{content}")
             formatted_prompt = self._format_system_prompt("\n".join(format_messages), query)
             user_message = Message.user_message(formatted_prompt, None)
-            summary_response = self.llm.ask(self.context, [user_message], [], stream=False, temperature=0.01)
+            summary_response = await self.llm.ask(self.context, [user_message], [], stream=False, temperature=0.01)
             logger.info(f"requestId: {self.context.request_id} summaryTaskResult: {summary_response}")
 
             return self._parse_llm_response(summary_response)
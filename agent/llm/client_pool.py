@@ -0,0 +1,133 @@
+import threading
+import weakref
+from typing import Optional
+
+import anthropic
+import httpx
+import openai
+
+from config.genie_config import genie_config
+from util.metrics import metrics
+
+
+def _limits():
+    return httpx.Limits(
+        max_connections=genie_config.llm_client_max_connections or None,
+        max_keepalive_connections=genie_config.llm_client_max_keepalive_connections or None,
+        keepalive_expiry=genie_config.llm_client_keepalive_expiry,
+    )
+
+
+def _timeout():
+    # 单次调用会传入timeout覆盖，这里只作为兜底
+    return httpx.Timeout(600, connect=genie_config.llm_client_connect_timeout)
+
+
+class _ConnectionTracer:
+    """通过httpcore的trace扩展统计连接复用，请求未建立新TCP连接即视为复用"""
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+
+    def _on_request(self, request: httpx.Request):
+        state = {"new": False}
+        request.extensions["genie_connection"] = state
+        return state
+
+    def _on_response(self, response: httpx.Response):
+        state = response.request.extensions.get("genie_connection", None)
+        if state is None:
+            return
+        if state["new"]:
+            metrics.inc("llm_client_connection_new", endpoint=self.endpoint)
+        else:
+            metrics.inc("llm_client_connection_reused", endpoint=self.endpoint)
+
+    def request_hook(self, request: httpx.Request):
+        state = self._on_request(request)
+
+        def trace(name, info):
+            if name == "connection.connect_tcp.complete":
+                state["new"] = True
+
+        request.extensions["trace"] = trace
+
+    def response_hook(self, response: httpx.Response):
+        self._on_response(response)
+
+    async def async_request_hook(self, request: httpx.Request):
+        state = self._on_request(request)
+
+        async def trace(name, info):
+            if name == "connection.connect_tcp.complete":
+                state["new"] = True
+
+        request.extensions["trace"] = trace
+
+    async def async_response_hook(self, response: httpx.Response):
+        self._on_response(response)
+
+
+class ClientPool:
+    """
+    进程内共享的LLM SDK客户端，按(provider, base_url, api_key)复用，底层httpx连接池保持长连接
+    异步客户端的连接绑定在事件循环上，按事件循环分别缓存，事件循环回收后随之释放
+    """
+
+    def __init__(self):
+        self._clients = dict()
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _endpoint(provider: str, base_url: Optional[str]):
+        return f"{provider}|{base_url or 'default'}"
+
+    def _build(self, provider: str, base_url: Optional[str], api_key: Optional[str], is_async: bool):
+        endpoint = self._endpoint(provider, base_url)
+        tracer = _ConnectionTracer(endpoint)
+        if is_async:
+            http_client = httpx.AsyncClient(
+                limits=_limits(), timeout=_timeout(),
+                event_hooks={"request": [tracer.async_request_hook], "response": [tracer.async_response_hook]})
+        else:
+            http_client = httpx.Client(
+                limits=_limits(), timeout=_timeout(),
+                event_hooks={"request": [tracer.request_hook], "response": [tracer.response_hook]})
+        metrics.inc("llm_client_created", endpoint=endpoint)
+        api_kwargs = {}
+        if base_url:
+            api_kwargs["base_url"] = base_url
+        if provider == "anthropic":
+            client_cls = anthropic.AsyncAnthropic if is_async else anthropic.Anthropic
+            # 重试由Resilience统一处理，SDK内部不再重试
+            return client_cls(api_key=api_key, http_client=http_client, max_retries=0, **api_kwargs)
+        if api_key:
+            api_kwargs["api_key"] = api_key
+        client_cls = openai.AsyncOpenAI if is_async else openai.OpenAI
+        return client_cls(http_client=http_client, max_retries=0, **api_kwargs)
+
+    def get(self, provider: str, base_url: Optional[str], api_key: Optional[str], loop=None):
+        """
+        获取客户端
+        :provider: openai或anthropic
+        :loop: 异步客户端所属的事件循环，为空时返回同步客户端
+        """
+        key = (provider, base_url, api_key)
+        with self._lock:
+            clients = self._clients if loop is None else self._async_clients.setdefault(loop, dict())
+            client = clients.get(key, None)
+            if client is None:
+                client = self._build(provider, base_url, api_key, loop is not None)
+                clients[key] = client
+            return client
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sync": len(self._clients),
+                "async": sum(len(clients) for clients in self._async_clients.values()),
+            }
+
+
+client_pool = ClientPool()
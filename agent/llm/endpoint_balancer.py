@@ -0,0 +1,153 @@
+import asyncio
+import random
+import threading
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import List, Optional
+
+from loguru import logger
+
+from agent.llm.rate_limiter import get_rate_limiter
+from agent.llm.resilience import is_retryable
+from config.genie_config import genie_config
+from util.metrics import metrics
+
+
+class Endpoint:
+    """逻辑模型下的一个接入点（网关 + api_key），各自限流、统计健康状态"""
+
+    def __init__(self, name: str, model: str, base_url: Optional[str], api_key: Optional[str],
+                 interface_url: Optional[str] = None, rpm: int = 0, tpm: int = 0, max_concurrency: int = 0):
+        self.name = name
+        self.model = model
+        self.base_url = base_url
+        self.api_key = api_key
+        self.interface_url = interface_url
+        self.rate_limiter = get_rate_limiter(name, rpm, tpm, max_concurrency)
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0
+
+    def healthy(self, now: float):
+        return self.ejected_until <= now
+
+
+class EndpointLease:
+    """一次调用占用的接入点，结束时调用release归还并记录结果，可重复调用"""
+
+    def __init__(self, balancer, endpoint: Endpoint, stack: AsyncExitStack):
+        self.balancer = balancer
+        self.endpoint = endpoint
+        self._stack = stack
+        self._start = time.monotonic()
+        self._released = False
+
+    async def release(self, error: Optional[BaseException] = None):
+        if self._released:
+            return
+        self._released = True
+        await self._stack.aclose()
+        self.balancer.on_release(self.endpoint, time.monotonic() - self._start, error)
+
+
+class EndpointBalancer:
+    """
+    同一逻辑模型的多个接入点之间按最少未完成请求数选择，相同时随机选择；
+    连续失败达到阈值的接入点摘除一段时间，全部被摘除时仍从中选择最早恢复的
+    """
+
+    def __init__(self, key: str, endpoints: List[Endpoint]):
+        self.key = key
+        self.endpoints = endpoints
+        self._lock = threading.Lock()
+
+    @property
+    def primary(self):
+        return self.endpoints[0]
+
+    def select(self) -> Endpoint:
+        with self._lock:
+            now = time.time()
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.healthy(now)]
+            if len(candidates) == 0:
+                candidates = [min(self.endpoints, key=lambda endpoint: endpoint.ejected_until)]
+            least = min(endpoint.outstanding for endpoint in candidates)
+            endpoint = random.choice([endpoint for endpoint in candidates if endpoint.outstanding == least])
+            endpoint.outstanding += 1
+            metrics.set_gauge("llm_endpoint_outstanding", endpoint.outstanding, endpoint=endpoint.name)
+        metrics.inc("llm_endpoint_selected", endpoint=endpoint.name)
+        return endpoint
+
+    async def acquire(self, tokens: int = 0) -> EndpointLease:
+        """选择接入点并等待其限流额度"""
+        endpoint = self.select()
+        stack = AsyncExitStack()
+        lease = EndpointLease(self, endpoint, stack)
+        try:
+            await stack.enter_async_context(endpoint.rate_limiter.limit(tokens))
+        except BaseException:
+            await lease.release()
+            raise
+        return lease
+
+    @asynccontextmanager
+    async def lease(self, tokens: int = 0):
+        lease = await self.acquire(tokens)
+        try:
+            yield lease.endpoint
+        except BaseException as e:
+            await lease.release(e)
+            raise
+        await lease.release()
+
+    def on_release(self, endpoint: Endpoint, cost: float, error: Optional[BaseException]):
+        with self._lock:
+            endpoint.outstanding -= 1
+            metrics.set_gauge("llm_endpoint_outstanding", endpoint.outstanding, endpoint=endpoint.name)
+            if error is None:
+                endpoint.consecutive_failures = 0
+            elif is_retryable(error):
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= genie_config.llm_endpoint_eject_failures \
+                        and len(self.endpoints) > 1:
+                    endpoint.consecutive_failures = 0
+                    endpoint.ejected_until = time.time() + genie_config.llm_endpoint_eject_seconds
+                    metrics.inc("llm_endpoint_ejected", endpoint=endpoint.name)
+                    logger.warning(f"llm endpoint {endpoint.name} ejected for "
+                                   f"{genie_config.llm_endpoint_eject_seconds}s after consecutive failures")
+        if error is None:
+            metrics.observe("llm_endpoint_latency_ms", int(cost * 1000), endpoint=endpoint.name)
+        elif not isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+            metrics.inc("llm_endpoint_failed", endpoint=endpoint.name, error=type(error).__name__)
+
+
+_balancers = dict()
+_balancers_lock = threading.Lock()
+
+
+def get_endpoint_balancer(model_name: str, llm_settings):
+    """
+    按llm.settings的配置名获取进程内共享的负载均衡器
+    配置项endpoints为接入点列表，每项可以覆盖base_url、api_key、interface_url及限流配置；未配置时使用配置项本身
+    """
+    with _balancers_lock:
+        balancer = _balancers.get(model_name, None)
+        if balancer is not None:
+            return balancer
+        endpoint_settings = llm_settings.endpoints or [dict()]
+        endpoints = list()
+        for index, settings in enumerate(endpoint_settings):
+            base_url = settings.get("base_url", llm_settings.base_url)
+            endpoints.append(Endpoint(
+                name=f"{base_url}|{llm_settings.model}#{index}",
+                model=llm_settings.model,
+                base_url=base_url,
+                api_key=settings.get("api_key", llm_settings.api_key),
+                interface_url=settings.get("interface_url", llm_settings.interface_url),
+                rpm=settings.get("rpm", llm_settings.rpm),
+                tpm=settings.get("tpm", llm_settings.tpm),
+                max_concurrency=settings.get("max_concurrency", llm_settings.max_concurrency),
+            ))
+        balancer = EndpointBalancer(model_name, endpoints)
+        _balancers[model_name] = balancer
+        return balancer
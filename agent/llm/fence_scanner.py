@@ -0,0 +1,66 @@
+from typing import List, Tuple
+
+OPEN_FENCE = "```json"
+CLOSE_FENCE = "```"
+
+
+def _partial_suffix(text: str, fence: str):
+    """text末尾可能是fence前缀的最长长度，需要等待后续内容才能判断"""
+    for k in range(min(len(fence) - 1, len(text)), 0, -1):
+        if text.endswith(fence[:k]):
+            return k
+    return 0
+
+
+class FenceScanner:
+    """
+    struct_parse模式下流式内容的```json代码块扫描器，跨chunk保存状态，每个chunk只扫描一次
+    第一个```json之前的内容对用户可见，之后的内容不再输出；每个代码块在结束标记到达时立即返回
+    """
+
+    def __init__(self):
+        self.visible = True
+        self.in_block = False
+        self._pending = ""
+        self._block = list()
+
+    def feed(self, chunk: str) -> Tuple[str, List[str]]:
+        """返回(本次可见内容, 本次完成的代码块)"""
+        visible = list()
+        blocks = list()
+        text = self._pending + chunk
+        self._pending = ""
+        while len(text) != 0:
+            fence = CLOSE_FENCE if self.in_block else OPEN_FENCE
+            pos = text.find(fence)
+            if pos < 0:
+                keep = _partial_suffix(text, fence)
+                self._emit(text[:len(text) - keep], visible)
+                self._pending = text[len(text) - keep:]
+                break
+            self._emit(text[:pos], visible)
+            if self.in_block:
+                blocks.append("".join(self._block).strip())
+                self._block = list()
+            else:
+                self.visible = False
+            self.in_block = not self.in_block
+            text = text[pos + len(fence):]
+        return "".join(visible), blocks
+
+    def finish(self) -> Tuple[str, List[str]]:
+        """流结束时输出剩余内容，未闭合的代码块也作为完成的代码块返回"""
+        text, self._pending = self._pending, ""
+        if not self.in_block:
+            return (text if self.visible else ""), []
+        self._block.append(text)
+        block = "".join(self._block).strip()
+        self._block = list()
+        self.in_block = False
+        return "", [block] if len(block) != 0 else []
+
+    def _emit(self, text: str, visible: list):
+        if self.in_block:
+            self._block.append(text)
+        elif self.visible:
+            visible.append(text)
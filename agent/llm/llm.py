@@ -1,6 +1,6 @@
+import asyncio
 import copy
 import json
-import re
 import time
 import uuid
 import traceback
@@ -12,14 +12,21 @@ from pydantic import BaseModel
 
 from agent.agent.agent_context import AgentContext, ToolCollection
 from agent.entity.enums import ToolChoice
-from agent.agent.message import Message, ToolCall, Function
+from agent.agent.message import Message, ToolCall, Function, Memory, ContextWindow
 from config.llm_settings import LLMSettings
 from model.response.agent_response import build_stream_response
 from agent.llm.token_counter import TokenCounter
+from agent.llm.endpoint_balancer import get_endpoint_balancer
+from agent.llm.client_pool import client_pool
+from agent.llm.fence_scanner import FenceScanner
+from agent.llm.resilience import get_resilience, KIND_CALL, KIND_FIRST_TOKEN
+from agent.llm.response_cache import response_cache
+from agent.llm import prompt_cache
+from agent.llm.usage_ledger import LLMCall
 from config.genie_config import genie_config
 from util import string_util
+from util.stream_coalescer import StreamCoalescer
 import openai
-import anthropic
 
 
 class LLM:
@@ -33,15 +40,20 @@ class LLM:
         self.model = llm_settings.model
         self.max_tokens = llm_settings.max_tokens
         self.temperature = llm_settings.temperature
-        self.api_key = llm_settings.api_key
-        self.base_url = llm_settings.base_url
-        self.interface_url = llm_settings.interface_url
+        # 每次调用从多个接入点中选择，base_url等为第一个接入点，供同步调用使用
+        self.balancer = get_endpoint_balancer(model_name, llm_settings)
+        self.api_key = self.balancer.primary.api_key
+        self.base_url = self.balancer.primary.base_url
+        self.interface_url = self.balancer.primary.interface_url
         self.function_call_type = llm_settings.function_call_type
         self.total_input_tokens = 0
         self.max_input_tokens = llm_settings.max_input_tokens
         self.ext_params = llm_settings.ext_params
         self.token_counter = TokenCounter()
+        self.resilience = get_resilience(model_name)
 
+        # openai 0.x没有异步客户端，沿用同步调用
+        self.async_client = not openai.__version__.startswith("0.")
         if openai.__version__.startswith("0."):
             if self.base_url:
                 openai.base = self.base_url + self.interface_url
@@ -49,104 +61,118 @@ class LLM:
                 openai.api_key = self.api_key
             self._chat_complete_create = openai.ChatCompletion.create
         else:
-            api_kwargs = {}
-            if self.base_url:
-                api_kwargs["base_url"] = self.base_url
-            if self.api_key:
-                api_kwargs["api_key"] = self.api_key
-
+            # 客户端进程内共享，复用底层连接池
             def _chat_complete_create(*args, **kwargs):
-                client = openai.OpenAI(**api_kwargs)
+                client = client_pool.get("openai", self.base_url, self.api_key)
                 return client.chat.completions.create(*args, **kwargs)
 
             self._chat_complete_create = _chat_complete_create
 
+            async def _chat_complete_create_async(endpoint, *args, **kwargs):
+                client = client_pool.get("openai", endpoint.base_url, endpoint.api_key, asyncio.get_running_loop())
+                return await client.chat.completions.create(*args, **kwargs)
+
+            self._chat_complete_create_async = _chat_complete_create_async
+
         def _claude_message_create(*args, **kwargs):
-            client = anthropic.Anthropic(api_key=self.api_key)
+            client = client_pool.get("anthropic", self.base_url, self.api_key)
             return client.messages.create(*args, **kwargs)
 
         self._claude_message_create = _claude_message_create
 
+        async def _claude_message_create_async(endpoint, *args, **kwargs):
+            client = client_pool.get("anthropic", endpoint.base_url, endpoint.api_key, asyncio.get_running_loop())
+            return await client.messages.create(*args, **kwargs)
+
+        self._claude_message_create_async = _claude_message_create_async
+
     def format_messages(self, messages: List[Message], is_claude):
-        """格式化消息为大语言模型接口接收的格式"""
+        """
+        格式化消息为大语言模型接口接收的格式
+        格式化结果缓存在消息上，消息内容被修改后重新生成，返回的dict在多次调用间共享，不能修改
+        """
+        form = "claude" if is_claude else "openai"
         formated_messages = list()
         for message in messages:
-            message_dict = {}
-            if message.base64_image is not None and len(message.base64_image) != 0:
-                multi_modal_list = []
-                # 处理base64图像
-                image_dict = {"type": "image_url",
-                              "image_url": {"url": "data:image/jpeg;base64," + message.base64_image}}
-                multi_modal_list.append(image_dict)
-                # 处理文本
-                text_dict = {"type": "text", "text": message.content}
-                multi_modal_list.append(text_dict)
-                message_dict["role"] = message.role.value
-                message_dict["content"] = multi_modal_list
-                formated_messages.append(message_dict)
-            elif message.tool_calls is not None and len(message.tool_calls) != 0:
-                message_dict["role"] = message.role.value
-                if is_claude:
-                    claude_tool_calls = list()
-                    for tool_call in message.tool_calls:
-                        claude_tool_calls.append({
-                            "type": "tool_use",
-                            "id": tool_call.id,
-                            "name": tool_call.function.name,
-                            "input": json.loads(tool_call.function.arguments)
-                        })
-                    message_dict["role"] = message.role.value
-                    message_dict["content"] = claude_tool_calls
-                else:
-                    message_dict["tool_calls"] = message.tool_calls
-            elif message.tool_call_id is not None and len(message.tool_call_id) != 0:
-                content = string_util.text_desensitization(message.content, genie_config.sensitive_patterns)
-                if is_claude:
-                    message_dict["role"] = "user"
-                    message_dict["content"] = [
-                        {"type": "tool_result", "tool_use_id": message.tool_call_id, "content": content}]
-                else:
-                    message_dict["role"] = message.role.value
-                    message_dict["content"] = content
-                    message_dict["tool_call_id"] = message.tool_call_id
-            else:
-                message_dict["role"] = message.role.value
-                message_dict["content"] = message.content
+            message_dict = message.cached_format(form)
+            if message_dict is None:
+                message_dict = self._format_message(message, is_claude)
+                message.cache_format(form, message_dict)
             formated_messages.append(message_dict)
 
         return formated_messages
 
-    def truncate_message(self, context: AgentContext, messages: list, max_input_tokens):
-        if len(messages) == 0 or max_input_tokens < 0:
-            return messages
-
-        logger.info(f"{context.request_id} before truncate {messages}")
-        t_messages = list()
-        remaining_tokens = max_input_tokens
-        system_message = messages[0]
-        if "system" == system_message.role.value:
-            remaining_tokens -= self.token_counter.count_message_tokens(system_message)
-
-        for message in messages[::-1]:
-            message_token = self.token_counter.count_message_tokens(message)
-            if remaining_tokens >= message_token:
-                t_messages.insert(0, message)
-                remaining_tokens -= message_token
+    @staticmethod
+    def _format_message(message: Message, is_claude):
+        message_dict = {}
+        if message.base64_image is not None and len(message.base64_image) != 0:
+            multi_modal_list = []
+            # 处理base64图像
+            image_dict = {"type": "image_url",
+                          "image_url": {"url": "data:image/jpeg;base64," + message.base64_image}}
+            multi_modal_list.append(image_dict)
+            # 处理文本
+            text_dict = {"type": "text", "text": message.content}
+            multi_modal_list.append(text_dict)
+            message_dict["role"] = message.role.value
+            message_dict["content"] = multi_modal_list
+        elif message.tool_calls is not None and len(message.tool_calls) != 0:
+            message_dict["role"] = message.role.value
+            if is_claude:
+                claude_tool_calls = list()
+                for tool_call in message.tool_calls:
+                    claude_tool_calls.append({
+                        "type": "tool_use",
+                        "id": tool_call.id,
+                        "name": tool_call.function.name,
+                        "input": json.loads(tool_call.function.arguments)
+                    })
+                message_dict["role"] = message.role.value
+                message_dict["content"] = claude_tool_calls
             else:
-                break
-        # use assistant 保证完整性
-        truncate_messages = []
-        for ix, message in enumerate(t_messages):
-            if message.role.value != "user":
-                continue
-            truncate_messages = t_messages[ix:]
-            break
-        if "system" == system_message.role.value:
-            truncate_messages.append(system_message)
-        logger.info(f"{context.request_id} after truncate {truncate_messages}")
-
+                message_dict["tool_calls"] = message.tool_calls
+        elif message.tool_call_id is not None and len(message.tool_call_id) != 0:
+            content = string_util.text_desensitization(message.content, genie_config.sensitive_patterns)
+            if is_claude:
+                message_dict["role"] = "user"
+                message_dict["content"] = [
+                    {"type": "tool_result", "tool_use_id": message.tool_call_id, "content": content}]
+            else:
+                message_dict["role"] = message.role.value
+                message_dict["content"] = content
+                message_dict["tool_call_id"] = message.tool_call_id
+        else:
+            message_dict["role"] = message.role.value
+            message_dict["content"] = message.content
+        return message_dict
+
+    def truncate_message(self, context: AgentContext, messages: List[Message] | Memory, system_msgs=None):
+        """
+        按max_input_tokens截取消息，扣除系统消息占用的token数
+        传入Memory时复用其上下文窗口的token前缀和，只计算新增的消息
+        """
+        window = messages.context_window if isinstance(messages, Memory) else ContextWindow(messages)
+        if self.max_input_tokens is None or self.max_input_tokens <= 0:
+            return list(window.messages)
+        budget = self.max_input_tokens
+        if system_msgs is not None:
+            system_msgs = system_msgs if isinstance(system_msgs, list) else [system_msgs]
+            budget -= self.token_counter.count_messages(system_msgs)
+        truncate_messages = window.window(self.token_counter, max(1, budget))
+        if len(truncate_messages) != len(window.messages):
+            logger.info(f"{context.request_id} truncate messages from {len(window.messages)} to "
+                        f"{len(truncate_messages)}, max input tokens {self.max_input_tokens}")
         return truncate_messages
 
+    def estimate_tokens(self, messages: List[Message], system_msgs=None):
+        """预估一次调用消耗的tokens，用于限流，包含输出上限"""
+        tokens = self.max_tokens or 0
+        if system_msgs is not None:
+            system_msgs = system_msgs if isinstance(system_msgs, list) else [system_msgs]
+            tokens += self.token_counter.count_messages(system_msgs)
+        tokens += self.token_counter.count_messages(messages)
+        return tokens
+
     def call_openai(self, params: dict, timeout: int):
         """非流式调用"""
         try:
@@ -168,40 +194,145 @@ class LLM:
         except Exception as e:
             raise e
 
-    async def _call_openai_function_call_stream(self, context: AgentContext, params: dict):
+    def new_call(self, context: AgentContext, stream: bool, estimated_tokens: int = 0):
+        """创建调用统计，estimated_tokens包含输出上限，服务端没有返回usage时扣除后作为输入token数"""
+        return LLMCall(context, self.model, stream, max(0, estimated_tokens - (self.max_tokens or 0)),
+                       self.token_counter)
+
+    async def acall_openai(self, context: AgentContext, params: dict, timeout: int, estimated_tokens: int = 0):
+        """非流式异步调用，每次尝试选择接入点，失败时按配置重试，openai 0.x在线程中执行同步调用"""
+        timeout = context.timeout_for(self.resilience.timeout(KIND_CALL, timeout))
+        call = self.new_call(context, False, estimated_tokens)
+
+        async def create():
+            async with self.balancer.lease(estimated_tokens) as endpoint:
+                if self.async_client:
+                    response = await self._chat_complete_create_async(endpoint, **params, timeout=timeout)
+                else:
+                    response = await asyncio.to_thread(self.call_openai, params, timeout)
+                usage = getattr(response, "usage", None)
+                if usage is not None and getattr(usage, "total_tokens", None):
+                    # 按实际消耗修正限流额度
+                    endpoint.rate_limiter.adjust(usage.total_tokens - estimated_tokens)
+                prompt_cache.report_usage(context.request_id, self.model, usage)
+                return response
+
+        try:
+            response = await self.resilience.call(context, create)
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            raise e
+        call.on_usage(getattr(response, "usage", None))
+        if getattr(response, "choices", None):
+            message = response.choices[0].message
+            call.add_output(message.content)
+            for tool_call in getattr(message, "tool_calls", None) or []:
+                call.add_output(tool_call.function.arguments)
+        call.finish()
+        return response
+
+    async def acall_openai_stream(self, context: AgentContext, params: dict, estimated_tokens: int = 0):
+        """流式异步调用，返回流式调用结果拼接的完整内容"""
+        if not self.async_client:
+            call = self.new_call(context, True, estimated_tokens)
+            async with self.balancer.lease(estimated_tokens):
+                result = await asyncio.to_thread(self.call_openai_stream, params, context.timeout_for(300))
+            call.add_output(result)
+            call.finish()
+            return result
+        full_response = list()
+        async for chunk in self._create_stream(context, params, False, estimated_tokens):
+            if chunk.choices and chunk.choices[0].delta.content:
+                full_response.append(chunk.choices[0].delta.content)
+        return "".join(full_response)
+
+    async def _create_stream(self, context: AgentContext, params: dict, is_claude: bool, estimated_tokens: int = 0,
+                             call: Optional[LLMCall] = None):
+        """
+        创建流式响应并异步迭代，收到首个chunk之前失败时重试，openai 0.x使用同步迭代
+        接入点在每次尝试时选择，流结束后归还
+        :call: 调用统计，为空时内部创建，流结束后记录到运行的UsageLedger
+        """
+        timeout = context.timeout_for(self.resilience.timeout(KIND_FIRST_TOKEN, 300))
+        call = call or self.new_call(context, True, estimated_tokens)
+        if not is_claude and not self.async_client:
+            async with self.balancer.lease(estimated_tokens):
+                for chunk in context.cancel_token.iterate(self._chat_complete_create(**params, timeout=timeout)):
+                    call.on_chunk(chunk)
+                    yield chunk
+            call.finish()
+            return
+        lease = None
+        if not is_claude and "1" == genie_config.llm_stream_include_usage:
+            # 最后一个chunk返回usage，choices为空
+            params = dict(params, stream_options={"include_usage": True})
+
+        async def create():
+            nonlocal lease
+            lease = await self.balancer.acquire(estimated_tokens)
+            if is_claude:
+                return await self._claude_message_create_async(lease.endpoint, **params, timeout=timeout)
+            return await self._chat_complete_create_async(lease.endpoint, **params, timeout=timeout)
+
+        async def on_failure(e):
+            nonlocal lease
+            if lease is not None:
+                await lease.release(e)
+                lease = None
+
+        error = None
+        response = None
         try:
-            # 输出流式内容前间隔次数
-            intervals = genie_config.message_interval.get("llm", "1,3").split(",")
-            first_interval = int(intervals[0])
-            send_interval = int(intervals[1])
-            index = 1  # 统计是否达到间隔流式输出次数
-            is_content = True  # 是否不包含json内容
-            response = self._chat_complete_create(**params, timeout=300)
+            response = await self.resilience.open_stream(context, create, on_failure)
+            async for chunk in context.cancel_token.aiterate(response):
+                call.on_chunk(chunk)
+                # openai在最后一个chunk，claude在message_start事件中返回输入token数
+                usage = getattr(chunk, "usage", None) or getattr(getattr(chunk, "message", None), "usage", None)
+                if usage is not None:
+                    prompt_cache.report_usage(context.request_id, self.model, usage)
+                yield chunk
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if lease is not None:
+                await lease.release(error)
+            if response is not None:
+                call.finish(error)
+
+    async def _call_openai_function_call_stream(self, context: AgentContext, params: dict, tool_dispatcher=None,
+                                                emit: bool = True, estimated_tokens: int = 0):
+        """
+        流式调用
+        :tool_dispatcher: 工具调用参数完整时立即交给dispatcher执行
+        :emit: 是否向前端输出流式内容，为False时仅用于提前执行工具
+        """
+        message_id = str(uuid.uuid4())
+        coalescer = self._stream_coalescer(context, message_id)
+        try:
+            scanner = FenceScanner() if "struct_parse" == self.function_call_type else None
             open_tool_calls_map = dict()
-            message_id = str(uuid.uuid4())
-            str_builder = list()
+            last_tool_index = None
             str_all_builder = list()
+            visible_builder = list()
+            tool_calls = list()
             #工具问题定位
             calls = []
-            for chunk in response:
-                if chunk.choices:
-                    if hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content:
-                        content = chunk.choices[0].delta.content
-                        str_all_builder.append(content)
-                        if "struct_parse" == self.function_call_type:
-                            if "```json" in "".join(str_all_builder):
-                                is_content = False
-                        if (not is_content):
+            call = self.new_call(context, True, estimated_tokens)
+            async for chunk in self._create_stream(context, params, False, estimated_tokens, call):
+                if not chunk.choices:
+                    continue
+                if hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content:
+                    content = chunk.choices[0].delta.content
+                    str_all_builder.append(content)
+                    if scanner is not None:
+                        content, blocks = scanner.feed(content)
+                        self._collect_tool_calls(self._parse_tool_calls(context, blocks), tool_calls, tool_dispatcher)
+                        if len(content) == 0:
                             continue
-                        str_builder.append(content)
-                        if index == first_interval or index % send_interval == 0:
-                            # 输出给前端的数据格式
-                            # message_id, stream_message_type, str_builder, is_final
-                            data = build_stream_response(context.request_id, context.agent_type, message_id,
-                                                         context.stream_message_type, "".join(str_builder), None, False)
-                            str_builder.clear()
-                            await context.queue.put(data)
-                        index += 1
+                    visible_builder.append(content)
+                    if emit:
+                        await coalescer.add(content)
 
                 if hasattr(chunk.choices[0].delta, 'tool_calls') \
                         and chunk.choices[0].delta.tool_calls \
@@ -209,6 +340,11 @@ class LLM:
                     openai_tool_calls = chunk.choices[0].delta.tool_calls
                     calls.append(openai_tool_calls)
                     for tool_call in openai_tool_calls:
+                        # index变化说明上一个工具调用的参数已经完整
+                        if tool_call.index != last_tool_index and last_tool_index in open_tool_calls_map:
+                            self._dispatch(tool_dispatcher,
+                                           self._to_tool_call(open_tool_calls_map[last_tool_index], last_tool_index))
+                        last_tool_index = tool_call.index
                         current_tool_call = open_tool_calls_map.get(tool_call.index, None)
                         if current_tool_call is None:
                             current_tool_call = OpenAIToolCall()
@@ -226,181 +362,137 @@ class LLM:
                                 current_tool_call.function.arguments += tool_call.function.arguments
                         open_tool_calls_map[tool_call.index] = current_tool_call
             content_all = "".join(str_all_builder)
-            if "struct_parse" == self.function_call_type:
-                if "```json" in "".join(str_builder):
-                    stop_pos = "".join(str_builder).find("```json")
-                else:
-                    stop_pos = len("".join(str_builder))
-                data = build_stream_response(context.request_id, context.agent_type, message_id,
-                                             context.stream_message_type, "".join(str_builder)[:stop_pos], None, False)
-                await context.queue.put(data)
-                if "```json" in content_all:
-                    stop_pos = content_all.find("```json")
-                else:
-                    stop_pos = len(content_all)
-                if len(content_all) != 0:
-                    data = build_stream_response(context.request_id, context.agent_type, message_id,
-                                                 context.stream_message_type, content_all[:stop_pos], None, True)
-                    await context.queue.put(data)
-            else:
-                if len(content_all) != 0:
-                    data = build_stream_response(context.request_id, context.agent_type, message_id,
-                                                 context.stream_message_type, "".join(str_builder), None, False)
-                    await context.queue.put(data)
-                    data = build_stream_response(context.request_id, context.agent_type, message_id,
-                                                 context.stream_message_type, "".join(str_all_builder), None, True)
-                    await context.queue.put(data)
+            visible_all = await self._finish_stream_content(context, message_id, scanner, coalescer,
+                                                            visible_builder, tool_calls, tool_dispatcher,
+                                                            emit and len(content_all) != 0)
 
-            tool_calls = list()
-            if "struct_parse" == self.function_call_type:
-                matches = re.findall(r"```json\s*([\s\S]*?)\s*```", content)
-                for match in matches:
-                    tool_call = self._parse_tool_call(context, match)
-                    if tool_call is not None:
-                        tool_calls.append(tool_call)
-            else:
-                for tool_call in open_tool_calls_map.values():
-                    tool_calls.append(
-                        ToolCall(
-                            id=tool_call.id,
-                            type=tool_call.type,
-                            function=Function(
-                                name=tool_call.function.name,
-                                arguments=tool_call.function.arguments)
-                        )
-                    )
+            if scanner is None:
+                for index, tool_call in open_tool_calls_map.items():
+                    tool_calls.append(self._to_tool_call(tool_call, index))
             logger.info(f"{context.request_id} call llm stream response {content_all} {tool_calls}")
             logger.info(f"工具结果：{calls}")
-            full_response = ToolCallResponse(content=content_all, tool_calls=tool_calls)
+            record = call.finish()
+            full_response = ToolCallResponse(content=content_all if emit else visible_all, tool_calls=tool_calls,
+                                             total_tokens=record.input_tokens + record.output_tokens,
+                                             duration=record.duration_ms)
             return full_response
-        except Exception:
+        except Exception as e:
             logger.error(f"{context.request_id} ask tool stream response error or empty")
-            raise Exception(f"Unexpected response code:{response}")
+            logger.error(traceback.format_exc())
+            raise e
+        finally:
+            await coalescer.close()
         return None
 
-    async def _call_claude_function_call_stream(self, context: AgentContext, params: dict):
-        """流式调用，"""
+    async def _call_claude_function_call_stream(self, context: AgentContext, params: dict, tool_dispatcher=None,
+                                                emit: bool = True, estimated_tokens: int = 0):
+        """流式调用，参数同_call_openai_function_call_stream"""
+        message_id = str(uuid.uuid4())
+        coalescer = self._stream_coalescer(context, message_id)
         try:
-            intervals = genie_config.message_interval.get("llm", "1,3").split(",")
-            first_interval = max(3, intervals[0]) if "struct_parse" == self.function_call_type else int(intervals[0])
-            send_interval = int(intervals[1])
-            index = 1  # 统计是否达到间隔流式输出次数
-            is_content = True  # 是否不包含json内容
-
-            response = self._claude_message_create(**params, timeout=300)
-            message_id = str(uuid.uuid4())
-            str_list = list()
+            scanner = FenceScanner() if "struct_parse" == self.function_call_type else None
+
             str_all_list = list()
+            visible_list = list()
             str_tool_list = list()
-            open_tool_calls_map = dict()
-            tool_id = ""
-            for chunk in response:
-                if chunk.delta is None:
+            tool_calls = list()
+            claude_tool_call = None
+            tool_id = None
+            call = self.new_call(context, True, estimated_tokens)
+            async for chunk in self._create_stream(context, params, True, estimated_tokens, call):
+                if getattr(chunk, "message", None) is not None:
+                    tool_id = chunk.message.id  # todo claude返回的结果中没有id，这里使用流式输出刚开始时的message id
+                if chunk.type == "content_block_stop" and claude_tool_call is None and len(str_tool_list) != 0:
+                    # 工具参数输出完成
+                    claude_tool_call = self._to_claude_tool_call(str_tool_list, tool_id)
+                    self._dispatch(tool_dispatcher, claude_tool_call)
+                delta = getattr(chunk, "delta", None)
+                # message_delta事件的delta没有type
+                if delta is None or getattr(delta, "type", None) is None:
                     continue
 
                 # content
-                if chunk.delta.type == "text_delta":
-                    content = chunk.delta.text
-                    if not is_content:
-                        str_all_list.append(content)
-                        continue
-                    str_list.append(content)
+                if delta.type == "text_delta":
+                    content = delta.text
                     str_all_list.append(content)
-                    if "struct_parse" == self.function_call_type:
-                        if "```json" in "".join(str_all_list):
-                            is_content = False
-                            # continue todo,这里是否应该continue
-                    if index == first_interval or index % send_interval == 0:
-                        # 输出给前端的数据格式
-                        # message_id, stream_message_type, str_builder, is_final
-                        data = build_stream_response(context.request_id, context.agent_type, message_id,
-                                                     context.stream_message_type, "".join(str_list), None, False)
-                        str_list.clear()
-                        await context.queue.put(data)
-                    index += 1
+                    if scanner is not None:
+                        content, blocks = scanner.feed(content)
+                        self._collect_tool_calls(self._parse_tool_calls(context, blocks), tool_calls, tool_dispatcher)
+                        if len(content) == 0:
+                            continue
+                    visible_list.append(content)
+                    if emit:
+                        await coalescer.add(content)
 
                 # tool call
-                if chunk.delta.type == "input_json_delta":
-                    content = chunk.delta.partial_json
-                    str_tool_list.append(content)
-                if chunk.message is not None:
-                    tool_id = chunk.message.id  # todo claude返回的结果中没有id，这里使用流式输出刚开始时的message id
-                else:
-                    tool_id = None
+                if delta.type == "input_json_delta":
+                    str_tool_list.append(delta.partial_json)
 
             content_all = "".join(str_all_list)
+            visible_all = await self._finish_stream_content(context, message_id, scanner, coalescer, visible_list,
+                                                            tool_calls, tool_dispatcher,
+                                                            emit and len(content_all) != 0)
 
-            if "struct_parse" == self.function_call_type:
-                if "```json" in "".join(str_list):
-                    stop_pos = "".join(str_list).find("```json")
-                else:
-                    stop_pos = len("".join(str_list))
-                data = build_stream_response(context.request_id, context.agent_type, message_id,
-                                             context.stream_message_type, "".join(str_list)[:stop_pos], None, False)
-                await context.queue.put(data)
-                if "```json" in content_all:
-                    stop_pos = content_all.find("```json")
-                else:
-                    stop_pos = len(content_all)
-                if len(content_all) != 0:
-                    data = build_stream_response(context.request_id, context.agent_type, message_id,
-                                                 context.stream_message_type, content_all[:stop_pos], None, True)
-                    await context.queue.put(data)
-            else:
-                if len(content_all) != 0:
-                    data = build_stream_response(context.request_id, context.agent_type, message_id,
-                                                 context.stream_message_type, "".join(str_list), None, False)
-                    await context.queue.put(data)
-                    data = build_stream_response(context.request_id, context.agent_type, message_id,
-                                                 context.stream_message_type, "".join(str_all_list), None, True)
-                    await context.queue.put(data)
-
-            tool_calls = list()
-            if "struct_parse" == self.function_call_type:
-                matches = re.findall(r"```json\s*([\s\S]*?)\s*```", content)
-                for match in matches:
-                    tool_call = self._parse_tool_call(context, match)
-                    if tool_call is not None:
-                        tool_calls.append(tool_call)
-            else:
-                if len(str_tool_list) != 0:
-                    arguments = json_repair.loads("".join(str_tool_list))
-                    if "function_name" in arguments:
-                        current_tool_call = OpenAIToolCall()
-                        current_tool_call.id = tool_id
-                        current_tool_call.type = "function"
-                        current_tool_call.function.name = arguments["function_name"]
-                        current_tool_call.function.arguments = "".join(str_tool_list)
-                        open_tool_calls_map[0] = current_tool_call # claude only call one function
-
-                        for tool_call in open_tool_calls_map.values():
-                            tool_calls.append(
-                                ToolCall(
-                                    id=tool_call.id,
-                                    type=tool_call.type,
-                                    function=Function(
-                                        name=tool_call.function.name,
-                                        arguments=tool_call.function.arguments)
-                                )
-                            )
+            if scanner is None:
+                if claude_tool_call is None and len(str_tool_list) != 0:
+                    claude_tool_call = self._to_claude_tool_call(str_tool_list, tool_id)
+                if claude_tool_call is not None:
+                    # claude only call one function
+                    tool_calls.append(claude_tool_call)
 
             logger.info(f"{context.request_id} call llm stream response {content_all} tool calls {tool_calls}")
-            return ToolCallResponse(content=content_all, tool_calls=tool_calls)
+            record = call.finish()
+            return ToolCallResponse(content=content_all if emit else visible_all, tool_calls=tool_calls,
+                                    total_tokens=record.input_tokens + record.output_tokens,
+                                    duration=record.duration_ms)
         except Exception as e:
             logger.error(f"{context.request_id} ask tool stream error")
             logger.error(traceback.format_exc())
             raise e
+        finally:
+            await coalescer.close()
         return None
 
-    def ask(
+    @staticmethod
+    def _to_tool_call(tool_call, index: int):
+        """部分OpenAI兼容接口不返回工具调用id，按序号及工具名生成，提前执行及结果收集按id对应"""
+        tool_id = tool_call.id or f"call_{index}_{tool_call.function.name}"
+        return ToolCall(id=tool_id, type=tool_call.type,
+                        function=Function(name=tool_call.function.name, arguments=tool_call.function.arguments))
+
+    @staticmethod
+    def _to_claude_tool_call(str_tool_list: list, tool_id: Optional[str]):
+        arguments_str = "".join(str_tool_list)
+        arguments = json_repair.loads(arguments_str)
+        if not isinstance(arguments, dict) or "function_name" not in arguments:
+            return None
+        return ToolCall(id=tool_id or str(uuid.uuid4()), type="function",
+                        function=Function(name=arguments["function_name"], arguments=arguments_str))
+
+    @staticmethod
+    def _dispatch(tool_dispatcher, tool_call: Optional[ToolCall]):
+        if tool_dispatcher is not None and tool_call is not None:
+            tool_dispatcher.dispatch(tool_call)
+
+    def _collect_tool_calls(self, parsed: List[ToolCall], tool_calls: list, tool_dispatcher):
+        for tool_call in parsed:
+            tool_calls.append(tool_call)
+            self._dispatch(tool_dispatcher, tool_call)
+
+    async def ask(
             self,
             context: AgentContext,
             messages: List[Message],
             system_msgs: List[Message],
             stream: bool,
-            temperature: float
+            temperature: float,
+            cache: bool = True
     ):
-        """向LLM发送请求并获取响应"""
+        """
+        向LLM发送请求并获取响应
+        :cache: 低温度调用是否使用响应缓存
+        """
+        context.cancel_token.raise_if_cancelled()
         try:
             formatted_messages = list()
             if system_msgs is not None and len(system_msgs) != 0:
@@ -420,35 +512,54 @@ class LLM:
             if len(self.ext_params) != 0:
                 params.update(self.ext_params)
             logger.info(f"{context.request_id} call llm ask request: {params}")
+            estimated_tokens = self.estimate_tokens(messages, system_msgs)
+
+            cache_key = None
+            if cache and response_cache.cacheable(temperature):
+                cache_key = response_cache.key("ask", params)
+                result = await response_cache.get(cache_key)
+                if result is not None:
+                    logger.info(f"{context.request_id} call llm ask hit cache {cache_key}")
+                    return result
 
             # 处理非流式请求
             if not stream:
                 params["stream"] = False
-                response = self.call_openai(params, 300)
+                response = await self.acall_openai(context, params, 300, estimated_tokens)
                 logger.info(f"{context.request_id} call llm response {response}")
                 choices = response.choices
                 if choices is None or len(choices) == 0:
                     raise Exception("Empty or invalid response from LLM")
-                return choices[0].message.content
+                result = choices[0].message.content
             else:
                 # 处理流式请求
                 params["stream"] = True
-                return self.call_openai_stream(params, 300)
+                result = await self.acall_openai_stream(context, params, estimated_tokens)
+            if cache_key is not None:
+                await response_cache.put(cache_key, result)
+            return result
         except Exception as e:
             raise e
 
     async def ask_tool(
             self,
             context: AgentContext,
-            messages: List[Message],
+            messages: List[Message] | Memory,
             system_msgs: Message,
             tools: ToolCollection,
             tool_choice: str,
             stream: bool,
             timeout: int,
-            temperature
+            temperature,
+            tool_dispatcher=None,
+            cache: bool = True
     ):
-        """向LLM发送工具请求并获取响应"""
+        """
+        向LLM发送工具请求并获取响应
+        :messages: 传入Memory时按上下文窗口截取，复用已计算的token数
+        :tool_dispatcher: 提前执行工具，不为空时即使stream为False也使用流式调用，只是不向前端输出内容
+        :cache: 开启工具调用缓存时，低温度的非流式调用是否使用响应缓存
+        """
 
         def tool_choice_valid(choice: str):
             try:
@@ -457,66 +568,33 @@ class LLM:
             except ValueError:
                 return False
 
-        def add_function_name_param(params: dict, tool_name: str):
-            new_parameters = copy.deepcopy(params)
-            new_required = ["function_name"]
-            if "required" in new_parameters and len(new_parameters["required"] != 0):
-                new_required.extend(new_parameters["required"])
-            new_parameters["required"] = new_required
-
-            new_properties = {"function_name": {"description": "默认值为工具名: " + tool_name, "type": "string"}}
-            if "properties" in new_parameters and new_parameters["properties"] is not None:
-                new_properties.update(new_parameters["properties"])
-            new_parameters["properties"] = new_properties
-            return new_parameters
-
+        context.cancel_token.raise_if_cancelled()
         try:
             if not tool_choice_valid(tool_choice):
                 raise Exception(f"Invalid tool_choice: {tool_choice}")
             start_time = time.time()
             params = dict()
-            formatted_tools = []
-            struct_parse_str_list = []
+            use_prompt_cache = "1" == genie_config.llm_prompt_cache_enable
+            # 工具schema按工具列表版本缓存，工具不变时各步复用
+            formatted_tools = None
+            tool_prompt = ""
             if "struct_parse" == self.function_call_type:
-                struct_parse_str_list.append(genie_config.struct_parse_tool_system_prompt)
-                for tool_name in tools.tool_map:
-                    func_map = {
-                        "name": tool_name,
-                        "description": tools.tool_map[tool_name].desc,
-                        "parameters": add_function_name_param(tools.tool_map[tool_name].to_params)
-                    }
-                    struct_parse_str_list.append(f"- `{tool_name}````json {func_map} ```")
-                for tool_name in tools.mcp_tool_map:
-                    func_map = {
-                        "name": tool_name,
-                        "description": tools.mcp_tool_map[tool_name].desc,
-                        "parameters": add_function_name_param(json.loads(tools.tool_map[tool_name].parameters),
-                                                              tool_name)
-                    }
-                    struct_parse_str_list.append(f"- `{tool_name}````json {func_map} ```")
+                tool_prompt = tools.cached_schema("struct_parse", lambda: self.build_struct_parse_tool_prompt(tools))
+                if system_msgs is not None:
+                    system_msgs.content = system_msgs.content + "\n" + tool_prompt
+            elif "claude" in self.model:
+                formatted_tools = tools.cached_schema(
+                    "claude", lambda: self.gpt2claude_tool(tools.cached_schema("openai", lambda: self.build_tools(tools))))
             else:
-                for tool_name in tools.tool_map:
-                    func_map = {}
-                    func_map["name"] = tool_name
-                    func_map["description"] = tools.tool_map[tool_name].desc
-                    func_map["parameters"] = tools.tool_map[tool_name].to_params
-                    formatted_tools.append({"type": "function", "function": func_map})
-                for tool_name in tools.mcp_tool_map:
-                    parameters = json.loads(tools.mcp_tool_map[tool_name].parameters)
-                    func_map = {}
-                    func_map["name"] = tool_name
-                    func_map["description"] = tools.mcp_tool_map[tool_name].desc
-                    func_map["parameters"] = parameters
-                    formatted_tools.append({"type": "function", "function": func_map})
-                if "claude" in self.model:
-                    formatted_tools = self.gpt2claude_tool(formatted_tools)
+                formatted_tools = tools.cached_schema("openai", lambda: self.build_tools(tools))
+            messages = self.truncate_message(context, messages, system_msgs)
 
             # 格式化消息
             formatted_messages = list()
             if system_msgs is not None:
-                if "struct_parse" == self.function_call_type:
-                    system_msgs.content = system_msgs.content + "\n" + "\n".join(struct_parse_str_list)
-                if "claude" in self.model:
+                if "claude" in self.model and use_prompt_cache:
+                    params["system"] = prompt_cache.claude_system_blocks(system_msgs.content)
+                elif "claude" in self.model:
                     params["system"] = system_msgs.content
                 else:
                     formatted_messages.extend(self.format_messages([system_msgs], False))
@@ -536,11 +614,25 @@ class LLM:
             params["temperature"] = temperature if temperature is not None else self.temperature
             if len(self.ext_params) != 0:
                 params.update(self.ext_params)
+            if use_prompt_cache:
+                self._mark_prompt_cache(params, tools, formatted_tools or tool_prompt)
 
             logger.info(f"f{context.request_id} call llm request {params}")
-
-            if not stream:
-                response = self.call_openai(params, timeout).model_dump()
+            estimated_tokens = self.estimate_tokens(messages, system_msgs)
+
+            if not stream and tool_dispatcher is None:
+                cache_key = None
+                if cache and "1" == genie_config.llm_cache_tool and response_cache.cacheable(params["temperature"]):
+                    cache_key = response_cache.key("ask_tool", params)
+                    cached = await response_cache.get(cache_key)
+                    if cached is not None:
+                        logger.info(f"{context.request_id} call llm ask tool hit cache {cache_key}")
+                        tool_call_response = ToolCallResponse(**cached)
+                        # 工具调用id在一次运行内需要唯一
+                        for tool_call in tool_call_response.tool_calls or []:
+                            tool_call.id = str(uuid.uuid4())
+                        return tool_call_response
+                response = (await self.acall_openai(context, params, timeout, estimated_tokens)).model_dump()
                 logger.info(f"{context.request_id} call llm response {response}")
                 choices = response["choices"]
                 if choices is None or len(choices) == 0:
@@ -553,15 +645,11 @@ class LLM:
                 # 提取工具调用
                 tool_calls = list()
                 if "struct_parse" == self.function_call_type:
-                    matches = re.findall(r"```json\s*([\s\S]*?)\s*```", content)
-                    for match in matches:
-                        tool_call = self._parse_tool_call(context, match)
-                        if tool_call is not None:
-                            tool_calls.append(tool_call)
-
-                    stop_pos = content.find("```json")
-                    if stop_pos > 0:
-                        content = content[:stop_pos]
+                    scanner = FenceScanner()
+                    content, blocks = scanner.feed(content or "")
+                    tail, tail_blocks = scanner.finish()
+                    content += tail
+                    tool_calls.extend(self._parse_tool_calls(context, blocks + tail_blocks))
                 else:
                     if "tool_calls" in message and message["tool_calls"] is not None:
                         for tool_call in message["tool_calls"]:
@@ -576,54 +664,150 @@ class LLM:
                 total_tokens = response["usage"]["total_tokens"]
                 end_time = time.time()
                 duration = int((end_time - start_time) * 1000)
-                return ToolCallResponse(content=content, tool_calls=tool_calls, finish_reason=finish_reason,
-                                        total_tokens=total_tokens, duration=duration)
+                tool_call_response = ToolCallResponse(content=content, tool_calls=tool_calls,
+                                                      finish_reason=finish_reason, total_tokens=total_tokens,
+                                                      duration=duration)
+                if cache_key is not None and finish_reason != "length":
+                    await response_cache.put(cache_key, tool_call_response.model_dump())
+                return tool_call_response
             else:
                 # 处理流式请求
                 params["stream"] = True
                 if "claude" in self.model:
-                    return await self._call_claude_function_call_stream(context, params)
+                    return await self._call_claude_function_call_stream(context, params, tool_dispatcher, stream,
+                                                                        estimated_tokens)
                 else:
-                    return await self._call_openai_function_call_stream(context, params)
+                    return await self._call_openai_function_call_stream(context, params, tool_dispatcher, stream,
+                                                                        estimated_tokens)
         except Exception as e:
             logger.error(f"{context.request_id} Unexpected error in ask_tool: {traceback.format_exc()}")
             raise e
 
+    @staticmethod
+    def _stream_coalescer(context: AgentContext, message_id: str):
+        """合并模型输出的增量内容后输出给前端"""
+        async def send(text: str):
+            # message_id, stream_message_type, 增量内容, is_final
+            await context.queue.put(build_stream_response(context.request_id, context.agent_type, message_id,
+                                                          context.stream_message_type, text, None, False))
+        return StreamCoalescer(send, "llm")
+
+    async def _finish_stream_content(self, context: AgentContext, message_id: str, scanner: Optional[FenceScanner],
+                                     coalescer: StreamCoalescer, visible_builder: list, tool_calls: list,
+                                     tool_dispatcher, emit: bool):
+        """
+        输出流式内容的剩余部分及最终结果，struct_parse模式下只输出代码块之前的内容
+        return: 用户可见的完整内容
+        """
+        if scanner is not None:
+            tail, blocks = scanner.finish()
+            self._collect_tool_calls(self._parse_tool_calls(context, blocks), tool_calls, tool_dispatcher)
+            visible_builder.append(tail)
+            if emit:
+                await coalescer.add(tail)
+        visible_all = "".join(visible_builder)
+        if not emit:
+            return visible_all
+        await coalescer.flush()
+        data = build_stream_response(context.request_id, context.agent_type, message_id,
+                                     context.stream_message_type, visible_all, None, True)
+        await context.queue.put(data)
+        return visible_all
+
+    def _parse_tool_calls(self, context, blocks: List[str]):
+        tool_calls = list()
+        for block in blocks:
+            tool_call = self._parse_tool_call(context, block)
+            if tool_call is not None:
+                tool_calls.append(tool_call)
+        return tool_calls
+
     def _parse_tool_call(self, context, json_content):
         """转换工具格式"""
         try:
             json_obj = json.loads(json_content)
             tool_name = json_obj["function_name"]
             del json_obj["function_name"]
-            return ToolCall(id=str(uuid.uuid4()), function={"name": tool_name, "arguments": json_obj})
+            return ToolCall(id=str(uuid.uuid4()),
+                            function=Function(name=tool_name, arguments=json.dumps(json_obj, ensure_ascii=False)))
         except Exception:
             logger.error(f"{context.request_id} parse tool call error {json_content}")
         return None
 
+    def _mark_prompt_cache(self, params: dict, tools: ToolCollection, schema):
+        """
+        标记提示缓存：claude在工具、系统提示及最后一条消息处设置缓存断点；
+        OpenAI兼容接口在网关支持时按模型及工具设置prompt_cache_key
+        """
+        if "claude" in self.model:
+            params["extra_headers"] = dict(params.get("extra_headers") or {}, **prompt_cache.ANTHROPIC_BETA_HEADERS)
+            if params.get("tools"):
+                params["tools"] = prompt_cache.mark_last_tool(params["tools"])
+            params["messages"] = prompt_cache.mark_last_message(params["messages"])
+        elif "1" == genie_config.llm_prompt_cache_key and self.async_client:
+            cache_key = tools.cached_schema(f"prompt_cache_key:{self.model}",
+                                            lambda: prompt_cache.prompt_cache_key(self.model, schema))
+            params["extra_body"] = dict(params.get("extra_body") or {}, prompt_cache_key=cache_key)
+
+    @staticmethod
+    def build_tools(tools: ToolCollection):
+        """生成openai格式的工具列表"""
+        formatted_tools = list()
+        for tool_name in tools.tool_map:
+            func_map = {}
+            func_map["name"] = tool_name
+            func_map["description"] = tools.tool_map[tool_name].desc
+            func_map["parameters"] = tools.tool_map[tool_name].to_params
+            formatted_tools.append({"type": "function", "function": func_map})
+        for tool_name in tools.mcp_tool_map:
+            parameters = json.loads(tools.mcp_tool_map[tool_name].parameters)
+            func_map = {}
+            func_map["name"] = tool_name
+            func_map["description"] = tools.mcp_tool_map[tool_name].desc
+            func_map["parameters"] = parameters
+            formatted_tools.append({"type": "function", "function": func_map})
+        return formatted_tools
+
+    @staticmethod
+    def add_function_name_param(params: dict, tool_name: str):
+        """工具参数增加function_name字段，不修改原参数"""
+        new_parameters = copy.deepcopy(params) if params is not None else dict()
+        new_required = ["function_name"]
+        if "required" in new_parameters and len(new_parameters["required"]) != 0:
+            new_required.extend(new_parameters["required"])
+        new_parameters["required"] = new_required
+
+        new_properties = {"function_name": {"description": "默认值为工具名: " + tool_name, "type": "string"}}
+        if "properties" in new_parameters and new_parameters["properties"] is not None:
+            new_properties.update(new_parameters["properties"])
+        new_parameters["properties"] = new_properties
+        return new_parameters
+
+    def build_struct_parse_tool_prompt(self, tools: ToolCollection):
+        """生成struct_parse模式下追加到系统提示的工具说明"""
+        struct_parse_str_list = [genie_config.struct_parse_tool_system_prompt]
+        for tool in self.build_tools(tools):
+            tool_name = tool["function"]["name"]
+            func_map = {
+                "name": tool_name,
+                "description": tool["function"]["description"],
+                "parameters": self.add_function_name_param(tool["function"]["parameters"], tool_name)
+            }
+            struct_parse_str_list.append(f"- `{tool_name}````json {func_map} ```")
+        return "\n".join(struct_parse_str_list)
+
     def gpt2claude_tool(
             self,
             gpt_tools: list
     ):
         """将openai工具格式转为claude工具格式"""
-        new_gpt_tools = copy.deepcopy(gpt_tools)
         claude_tools = list()
-        for gpt_tool_wrapper in new_gpt_tools:
+        for gpt_tool_wrapper in gpt_tools:
             claude_tool_map = {}
             claude_tool_map["name"] = gpt_tool_wrapper["function"]["name"]
             claude_tool_map["description"] = gpt_tool_wrapper["function"]["description"]
-            parameters = gpt_tool_wrapper["function"]["parameters"]
-            new_required = list()
-            new_required.append("function_name")
-            if "required" in parameters and len(parameters["required"] != 0):
-                new_required.extend(parameters["required"])
-            parameters["required"] = new_required
-
-            new_properties = {
-                "function_name": {"description": "默认值为工具名: " + gpt_tool_wrapper["function"]["name"], "type": "string"}}
-            if "properties" in parameters and parameters["properties"] is not None:
-                new_properties.update(parameters["properties"])
-            parameters["properties"] = new_properties
-            claude_tool_map["input_schema"] = parameters
+            claude_tool_map["input_schema"] = self.add_function_name_param(gpt_tool_wrapper["function"]["parameters"],
+                                                                           gpt_tool_wrapper["function"]["name"])
             claude_tools.append(claude_tool_map)
 
         return claude_tools
@@ -0,0 +1,88 @@
+import hashlib
+import json
+
+from loguru import logger
+
+from util.metrics import metrics
+
+# Anthropic提示缓存断点，缓存该位置之前的全部前缀（tools -> system -> messages）
+EPHEMERAL = {"type": "ephemeral"}
+ANTHROPIC_BETA_HEADERS = {"anthropic-beta": "prompt-caching-2024-07-31"}
+
+
+def claude_system_blocks(system: str):
+    """
+    Claude系统提示作为一个文本块，在末尾设置缓存断点，不改变提示内容及顺序
+    同一次运行中各步的工具及系统提示不变，作为前缀命中缓存
+    """
+    if not system:
+        return system
+    return [{"type": "text", "text": system, "cache_control": EPHEMERAL}]
+
+
+def mark_last_tool(tools: list):
+    """最后一个工具设置缓存断点，返回新列表，不修改缓存的工具schema"""
+    if not tools:
+        return tools
+    return tools[:-1] + [dict(tools[-1], cache_control=EPHEMERAL)]
+
+
+def mark_last_message(messages: list):
+    """
+    最后一条消息的最后一个内容块设置缓存断点，下一步调用时历史消息作为前缀命中缓存
+    返回新列表，不修改消息上缓存的格式化结果
+    """
+    if not messages:
+        return messages
+    last = messages[-1]
+    content = last.get("content", None)
+    if isinstance(content, str) and len(content) != 0:
+        content = [{"type": "text", "text": content, "cache_control": EPHEMERAL}]
+    elif isinstance(content, list) and len(content) != 0 and isinstance(content[-1], dict):
+        content = content[:-1] + [dict(content[-1], cache_control=EPHEMERAL)]
+    else:
+        return messages
+    return messages[:-1] + [dict(last, content=content)]
+
+
+def prompt_cache_key(model: str, schema):
+    """OpenAI兼容接口的prompt_cache_key，相同模型及工具的请求路由到同一缓存"""
+    content = json.dumps(schema, ensure_ascii=False, sort_keys=True, default=str)
+    return model + "-" + hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+
+def _field(obj, name: str):
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(name, None)
+    return getattr(obj, name, None)
+
+
+def input_tokens(usage):
+    """
+    从openai或anthropic的usage中解析输入token数
+    return: (输入token总数, 命中缓存的token数)，没有输入token信息时返回None
+    """
+    prompt_tokens = _field(usage, "prompt_tokens")
+    if prompt_tokens is not None:
+        cached = _field(_field(usage, "prompt_tokens_details"), "cached_tokens") or 0
+        return prompt_tokens, cached
+    # anthropic的input_tokens不包含读取及写入缓存的部分
+    uncached = _field(usage, "input_tokens")
+    if uncached is None:
+        return None
+    cached = _field(usage, "cache_read_input_tokens") or 0
+    created = _field(usage, "cache_creation_input_tokens") or 0
+    return uncached + cached + created, cached
+
+
+def report_usage(request_id: str, model: str, usage):
+    """记录一次调用命中提示缓存及未命中的输入token数"""
+    tokens = input_tokens(usage)
+    if tokens is None:
+        return
+    total, cached = tokens
+    metrics.inc("llm_input_tokens", cached, model=model, cache="hit")
+    metrics.inc("llm_input_tokens", total - cached, model=model, cache="miss")
+    logger.info(f"{request_id} llm {model} input tokens {total}, cached {cached}, uncached {total - cached}")
@@ -0,0 +1,144 @@
+import asyncio
+import collections
+import threading
+import time
+from contextlib import asynccontextmanager
+
+from loguru import logger
+
+from util.metrics import metrics
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class RateLimiter:
+    """
+    单个LLM接入点（base_url + model + api_key）的限流器，进程内共享
+    rpm/tpm使用预占式令牌桶：调用方先扣减额度，额度为负时按恢复速率等待，先到先得；
+    max_concurrency限制同时进行的请求数，释放时直接移交给等待最久的调用方
+    限制值为0时不限制，超出限制时排队等待而不是报错
+    """
+
+    def __init__(self, key: str, rpm: int = 0, tpm: int = 0, max_concurrency: int = 0):
+        self.key = key
+        self.rpm = rpm or 0
+        self.tpm = tpm or 0
+        self.max_concurrency = max_concurrency or 0
+        self._requests = float(self.rpm)
+        self._tokens = float(self.tpm)
+        self._refill_time = time.monotonic()
+        self._inflight = 0
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+        metrics.set_gauge("llm_limit_rpm", self.rpm, endpoint=key)
+        metrics.set_gauge("llm_limit_tpm", self.tpm, endpoint=key)
+        metrics.set_gauge("llm_limit_max_concurrency", self.max_concurrency, endpoint=key)
+
+    def _refill(self, now: float):
+        elapsed = now - self._refill_time
+        self._refill_time = now
+        if self.rpm > 0:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        if self.tpm > 0:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def _reserve(self, tokens: int):
+        """预占一次请求及tokens额度，返回需要等待的秒数"""
+        with self._lock:
+            self._refill(time.monotonic())
+            wait = 0
+            if self.rpm > 0:
+                self._requests -= 1
+                if self._requests < 0:
+                    wait = max(wait, -self._requests * 60 / self.rpm)
+            if self.tpm > 0:
+                self._tokens -= min(tokens, self.tpm)
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens * 60 / self.tpm)
+            return wait
+
+    def adjust(self, delta_tokens: int):
+        """调用结束后按实际消耗修正tokens额度，delta为实际值减去预估值"""
+        if self.tpm <= 0 or delta_tokens == 0:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.tpm, self._tokens - delta_tokens)
+
+    def _try_acquire_slot(self, wake):
+        """获取并发槽位，成功返回True，否则登记唤醒函数"""
+        with self._lock:
+            if self.max_concurrency <= 0 or (self._inflight < self.max_concurrency and len(self._waiters) == 0):
+                self._inflight += 1
+                metrics.set_gauge("llm_inflight", self._inflight, endpoint=self.key)
+                return True
+            self._waiters.append(wake)
+            return False
+
+    def _release_slot(self):
+        with self._lock:
+            if len(self._waiters) != 0:
+                # 槽位直接移交给等待者，inflight不变
+                wake = self._waiters.popleft()
+                wake()
+                return
+            self._inflight -= 1
+            metrics.set_gauge("llm_inflight", self._inflight, endpoint=self.key)
+
+    def _cancel_waiter(self, wake):
+        with self._lock:
+            if wake in self._waiters:
+                self._waiters.remove(wake)
+                return
+        # 已移交槽位但未来得及唤醒
+        self._release_slot()
+
+    def _record_wait(self, start: float, waited: bool):
+        wait_ms = int((time.monotonic() - start) * 1000)
+        if waited:
+            metrics.inc("llm_rate_limited", endpoint=self.key)
+            if wait_ms >= 1000:
+                logger.info(f"llm endpoint {self.key} rate limited, waited {wait_ms}ms")
+        metrics.observe("llm_rate_limit_wait_ms", wait_ms, endpoint=self.key)
+
+    @asynccontextmanager
+    async def limit(self, tokens: int = 0):
+        start = time.monotonic()
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(_resolve, future)
+
+        acquired = self._try_acquire_slot(wake)
+        if not acquired:
+            try:
+                await future
+            except asyncio.CancelledError:
+                self._cancel_waiter(wake)
+                raise
+        self._record_wait(start, wait > 0 or not acquired)
+        try:
+            yield
+        finally:
+            self._release_slot()
+
+
+_limiters = dict()
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(key: str, rpm: int = 0, tpm: int = 0, max_concurrency: int = 0):
+    """按接入点获取进程内共享的限流器"""
+    with _limiters_lock:
+        limiter = _limiters.get(key, None)
+        if limiter is None:
+            limiter = RateLimiter(key, rpm, tpm, max_concurrency)
+            _limiters[key] = limiter
+        return limiter
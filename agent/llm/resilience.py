@@ -0,0 +1,236 @@
+import asyncio
+import collections
+import random
+import threading
+import time
+from typing import Optional
+
+import anthropic
+import httpx
+import openai
+from loguru import logger
+
+from config.genie_config import genie_config
+from util.metrics import metrics
+
+# 非流式调用耗时、流式调用首个chunk耗时
+KIND_CALL = "call"
+KIND_FIRST_TOKEN = "first_token"
+
+_RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    httpx.TransportError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    anthropic.APIConnectionError,
+    anthropic.RateLimitError,
+    anthropic.InternalServerError,
+)
+
+
+def is_retryable(e: BaseException):
+    """网络错误、超时、限流及5xx可以重试，参数及鉴权错误不重试"""
+    if isinstance(e, _RETRYABLE_ERRORS):
+        return True
+    if isinstance(e, (openai.APIStatusError, anthropic.APIStatusError)):
+        return e.status_code in (408, 409, 429) or e.status_code >= 500
+    return False
+
+
+def _retry_after(e: BaseException):
+    """服务端通过retry-after指定的等待秒数"""
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class LatencyTracker:
+    """最近window次调用的耗时，用于计算分位数"""
+
+    def __init__(self, window: int):
+        self._samples = collections.deque(maxlen=max(1, window))
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """样本数不足时返回None"""
+        with self._lock:
+            if len(self._samples) < genie_config.llm_latency_min_samples:
+                return None
+            samples = sorted(self._samples)
+        index = min(len(samples) - 1, int(len(samples) * p / 100))
+        return samples[index]
+
+
+async def _close_response(response):
+    close = getattr(response, "close", None)
+    if close is not None:
+        await close()
+
+
+class PrefetchedStream:
+    """已读取首个chunk的流式响应，迭代时先返回首个chunk"""
+
+    def __init__(self, response, iterator, first):
+        self._response = response
+        self._iterator = iterator
+        self._first = first
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        if self._first is not None:
+            first, self._first = self._first, None
+            yield first
+        async for chunk in self._iterator:
+            yield chunk
+
+    async def close(self):
+        await _close_response(self._response)
+
+
+class Resilience:
+    """
+    单个逻辑模型的调用容错：
+    可重试错误按带抖动的指数退避重试，流式调用只在收到首个chunk之前重试；
+    非流式调用耗时超过历史分位数时发送一个对冲请求，取先返回的结果；
+    超时时间按历史耗时分位数自适应，不超过调用方给定的超时时间
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self._latency = {
+            KIND_CALL: LatencyTracker(genie_config.llm_latency_window),
+            KIND_FIRST_TOKEN: LatencyTracker(genie_config.llm_latency_window),
+        }
+
+    def timeout(self, kind: str, default: float):
+        """按历史耗时计算超时时间，样本不足时使用默认值"""
+        latency = self._latency[kind].percentile(genie_config.llm_timeout_percentile)
+        if latency is None:
+            return default
+        adaptive = max(genie_config.llm_timeout_min_seconds, latency * genie_config.llm_timeout_multiplier)
+        return min(default, adaptive)
+
+    def _hedge_delay(self):
+        if genie_config.llm_hedge_percentile <= 0:
+            return None
+        return self._latency[KIND_CALL].percentile(genie_config.llm_hedge_percentile)
+
+    def _record(self, kind: str, start: float):
+        cost = time.monotonic() - start
+        self._latency[kind].record(cost)
+        metrics.observe("llm_latency_ms", int(cost * 1000), endpoint=self.key, kind=kind)
+
+    async def _backoff(self, context, attempt: int, e: BaseException):
+        """等待重试，超过重试次数或剩余时间不足时抛出原异常"""
+        if attempt >= genie_config.llm_retry_max_attempts or not is_retryable(e):
+            raise e
+        delay = min(genie_config.llm_retry_max_delay_ms, genie_config.llm_retry_base_delay_ms * 2 ** (attempt - 1))
+        delay = delay / 2000 + random.uniform(0, delay / 2000)
+        retry_after = _retry_after(e)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        remaining = context.remaining_seconds()
+        if remaining is not None and remaining <= delay:
+            raise e
+        metrics.inc("llm_retry", endpoint=self.key, error=type(e).__name__)
+        logger.warning(f"{context.request_id} llm {self.key} call failed: {type(e).__name__} {e}, "
+                       f"retry {attempt}/{genie_config.llm_retry_max_attempts - 1} after {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+    async def _hedged(self, create):
+        """超过对冲延迟仍未返回时再发一个相同请求，取先成功的结果"""
+        delay = self._hedge_delay()
+        if delay is None:
+            return await create()
+        first = asyncio.ensure_future(create())
+        pending = {first}
+        error = None
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if len(done) != 0:
+                return first.result()
+            metrics.inc("llm_hedged", endpoint=self.key)
+            hedge = asyncio.ensure_future(create())
+            pending = {first, hedge}
+            while len(pending) != 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            metrics.inc("llm_hedge_won", endpoint=self.key)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def call(self, context, create):
+        """
+        非流式调用
+        :create: 无参函数，每次调用返回一个发起请求的awaitable
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            context.cancel_token.raise_if_cancelled()
+            start = time.monotonic()
+            try:
+                result = await self._hedged(create)
+                self._record(KIND_CALL, start)
+                return result
+            except Exception as e:
+                await self._backoff(context, attempt, e)
+
+    async def open_stream(self, context, create, on_failure=None):
+        """
+        打开流式响应并读取首个chunk，首个chunk之前失败时重试，之后的失败不重试（内容已经输出）
+        :create: 无参函数，每次调用返回一个创建异步流式响应的awaitable
+        :on_failure: 每次尝试失败时调用，参数为异常
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            context.cancel_token.raise_if_cancelled()
+            start = time.monotonic()
+            response = None
+            try:
+                response = await create()
+                iterator = response.__aiter__()
+                try:
+                    first = await iterator.__anext__()
+                except StopAsyncIteration:
+                    first = None
+                self._record(KIND_FIRST_TOKEN, start)
+                return PrefetchedStream(response, iterator, first)
+            except Exception as e:
+                if response is not None:
+                    await _close_response(response)
+                if on_failure is not None:
+                    await on_failure(e)
+                await self._backoff(context, attempt, e)
+
+
+_resiliences = dict()
+_resiliences_lock = threading.Lock()
+
+
+def get_resilience(key: str):
+    """按逻辑模型获取进程内共享的容错组件"""
+    with _resiliences_lock:
+        resilience = _resiliences.get(key, None)
+        if resilience is None:
+            resilience = Resilience(key)
+            _resiliences[key] = resilience
+        return resilience
@@ -0,0 +1,181 @@
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from loguru import logger
+
+from config.genie_config import genie_config
+from util.metrics import metrics
+
+# 不影响模型输出的请求参数，不参与缓存key计算
+_IGNORED_PARAMS = {"stream", "stream_options", "erp", "extra_headers"}
+
+
+class MemoryTier:
+    """进程内LRU缓存"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._entries.get(key, None)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return item[1]
+
+    def put(self, key: str, value, ttl: int):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class DiskTier:
+    """
+    基于目录的缓存，同一台机器上的多个worker进程共享，超过容量时按最近写入时间淘汰
+    缓存内容包含模型输入输出，目录权限为0700，仅服务用户可读写
+    """
+
+    def __init__(self, path: str, max_bytes: int, sweep_interval: int = 60):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        # 目录已存在时makedirs不修改权限
+        os.chmod(path, 0o700)
+
+    def _file(self, key: str):
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, key: str):
+        try:
+            with open(self._file(key), "r", encoding="utf-8") as f:
+                item = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if item["expireTime"] < time.time():
+            self._remove(self._file(key))
+            return None
+        return item["value"]
+
+    def put(self, key: str, value, ttl: int):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"expireTime": time.time() + ttl, "value": value}, f, ensure_ascii=False)
+        os.replace(tmp_path, self._file(key))
+        if time.time() - self._last_sweep >= self.sweep_interval:
+            self._last_sweep = time.time()
+            self.sweep()
+
+    def sweep(self):
+        """清理过期文件，总大小超过上限时删除最早写入的文件"""
+        files = list()
+        total = 0
+        now = time.time()
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if stat.st_mtime + genie_config.llm_cache_ttl_seconds < now:
+                self._remove(entry.path)
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        files.sort()
+        for _, size, path in files:
+            self._remove(path)
+            metrics.inc("llm_cache_evicted")
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class ResponseCache:
+    """
+    低温度LLM调用的响应缓存，相同的模型、消息、工具及采样参数直接返回缓存结果
+    先查进程内LRU，再查磁盘，磁盘命中时回填内存
+    """
+
+    def __init__(self):
+        self.memory = MemoryTier(genie_config.llm_cache_memory_entries)
+        self.disk = None
+        if "1" == genie_config.llm_cache_enable and genie_config.llm_cache_path:
+            # 相对路径相对服务目录
+            path = Path(__file__).resolve().parents[2] / genie_config.llm_cache_path
+            try:
+                self.disk = DiskTier(str(path), genie_config.llm_cache_max_bytes)
+            except OSError as e:
+                logger.warning(f"llm disk cache disabled: {e}")
+
+    @staticmethod
+    def cacheable(temperature: Optional[float]):
+        return "1" == genie_config.llm_cache_enable and temperature is not None \
+            and temperature <= genie_config.llm_cache_max_temperature
+
+    @staticmethod
+    def key(kind: str, params: dict):
+        """请求参数的规范化哈希"""
+        canonical = {k: v for k, v in params.items() if k not in _IGNORED_PARAMS}
+        canonical["kind"] = kind
+        content = json.dumps(canonical, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str):
+        value = self.memory.get(key)
+        if value is not None:
+            metrics.inc("llm_cache_hit", tier="memory")
+            return value
+        if self.disk is not None:
+            try:
+                value = await asyncio.to_thread(self.disk.get, key)
+            except Exception as e:
+                logger.warning(f"llm cache read error: {e}")
+            if value is not None:
+                metrics.inc("llm_cache_hit", tier="disk")
+                self.memory.put(key, value, genie_config.llm_cache_ttl_seconds)
+                return value
+        metrics.inc("llm_cache_miss")
+        return None
+
+    async def put(self, key: str, value):
+        if value is None:
+            return
+        self.memory.put(key, value, genie_config.llm_cache_ttl_seconds)
+        if self.disk is not None:
+            try:
+                await asyncio.to_thread(self.disk.put, key, value, genie_config.llm_cache_ttl_seconds)
+            except Exception as e:
+                logger.warning(f"llm cache write error: {e}")
+
+
+response_cache = ResponseCache()
@@ -1,6 +1,103 @@
 import math
+import re
+import threading
+
+from loguru import logger
 
 from agent.agent.message import Message
+from config.genie_config import genie_config
+
+# 中日韩文字及全角标点，BPE分词下约1个字1个token
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+class EstimateTokenizer:
+    """不依赖词表的快速估算：中日韩文字按1个token计，其余字符约4个字符1个token"""
+
+    name = "estimate"
+
+    def count(self, text: str):
+        cjk = len(_CJK_PATTERN.findall(text))
+        return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+class TiktokenTokenizer:
+    """
+    tiktoken BPE分词，需要另外安装tiktoken，词表需要已缓存在本地
+    未设置TIKTOKEN_CACHE_DIR时tiktoken会在首次使用时联网下载词表，此时不加载
+    """
+
+    def __init__(self, encoding: str):
+        import os
+        if not os.environ.get("TIKTOKEN_CACHE_DIR"):
+            raise RuntimeError("TIKTOKEN_CACHE_DIR is not set, tiktoken would download the encoding")
+        import tiktoken
+        self.name = f"tiktoken:{encoding}"
+        self._encoding = tiktoken.get_encoding(encoding)
+
+    def count(self, text: str):
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+
+class HuggingFaceTokenizer:
+    """tokenizers库加载的本地tokenizer.json"""
+
+    def __init__(self, path: str):
+        from tokenizers import Tokenizer
+        self.name = f"hf:{path}"
+        self._tokenizer = Tokenizer.from_file(path)
+
+    def count(self, text: str):
+        return len(self._tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+def _anthropic_tokenizer_path():
+    """anthropic SDK自带的tokenizer.json"""
+    import os
+    import anthropic
+    return os.path.join(os.path.dirname(anthropic.__file__), "tokenizer.json")
+
+
+def _load_tokenizer(spec: str):
+    if spec.startswith("tiktoken:"):
+        return TiktokenTokenizer(spec[len("tiktoken:"):])
+    if spec.startswith("hf:"):
+        return HuggingFaceTokenizer(spec[len("hf:"):])
+    if spec == "anthropic":
+        return HuggingFaceTokenizer(_anthropic_tokenizer_path())
+    if spec != "estimate":
+        raise ValueError(f"unknown tokenizer {spec}")
+    return EstimateTokenizer()
+
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer():
+    """
+    按配置加载分词器，进程内共享，服务启动时加载，避免在agent步骤中读取词表
+    auto使用anthropic SDK自带的词表，不联网，不可用时使用估算
+    """
+    global _tokenizer
+    if _tokenizer is not None:
+        return _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is not None:
+            return _tokenizer
+        spec = genie_config.token_counter_tokenizer
+        candidates = ["anthropic"] if spec == "auto" else [spec]
+        for candidate in candidates:
+            try:
+                _tokenizer = _load_tokenizer(candidate)
+                break
+            except Exception as e:
+                logger.warning(f"load tokenizer {candidate} failed: {e}")
+        if _tokenizer is None:
+            _tokenizer = EstimateTokenizer()
+            logger.warning(f"tokenizer {spec} unavailable, token counter falls back to estimate")
+        logger.info(f"token counter use tokenizer {_tokenizer.name}")
+        return _tokenizer
 
 
 class TokenCounter:
@@ -15,20 +112,23 @@ class TokenCounter:
     HIGH_DETAIL_TARGET_SHORT_SIDE = 768
     TILE_SIZE = 512
 
+    def __init__(self, tokenizer=None):
+        self.tokenizer = get_tokenizer() if tokenizer is None else tokenizer
+
     def count_text(self, text: str):
         """计算文本中的token数量"""
-        return 0 if text is None else len(text)
+        return 0 if not text else self.tokenizer.count(text)
 
     def count_content(self, content: str | list):
         if content is None:
             return 0
         if isinstance(content, str):
-            return len(self.count_text(content))
+            return self.count_text(content)
         if isinstance(content, list):
             token_count = 0
             for c in content:
                 if isinstance(c, str):
-                    token_count += len(c)
+                    token_count += self.count_text(c)
                 elif isinstance(c, dict):
                     if c["type"] == "text":
                         token_count += self.count_text(c["text"])
@@ -77,11 +177,24 @@ class TokenCounter:
         return total_tiles * TokenCounter.HIGH_DETAIL_TILE_TOKENS + TokenCounter.LOW_DETAIL_IMAGE_TOKENS
 
     def count_message_tokens(self, message: Message):
+        """计算单条消息的token数量，结果缓存在消息上，消息内容变化后重新计算"""
+        cached = message.cached_token_count(self.tokenizer.name)
+        if cached is not None:
+            return cached
         tokens = TokenCounter.BASE_MESSAGE_TOKENS
         #添加角色 token
         tokens += self.count_text(message.role.value)
         #//添加内容
         if message.content is not None:
             tokens += self.count_content(message.content)
+        if message.base64_image:
+            tokens += self.count_image({})
+        for tool_call in message.tool_calls or []:
+            tokens += TokenCounter.FORMAT_TOKENS
+            if tool_call.function is not None:
+                tokens += self.count_text(tool_call.function.name) + self.count_text(tool_call.function.arguments)
+        message.cache_token_count(self.tokenizer.name, tokens)
+        return tokens
 
-
+    def count_messages(self, messages):
+        return sum(self.count_message_tokens(message) for message in messages)
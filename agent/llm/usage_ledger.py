@@ -0,0 +1,212 @@
+import contextvars
+import threading
+import time
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+from loguru import logger
+
+from agent.llm import prompt_cache
+from config.genie_config import genie_config
+from util.metrics import metrics
+
+# 当前执行的agent及步数，由BaseAgent在每一步开始时设置，用于标记LLM调用记录
+call_scope = contextvars.ContextVar("llm_call_scope", default=(None, 0))
+
+# token数直方图分桶
+TOKEN_BUCKETS = (100, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+
+
+@dataclass
+class UsageRecord:
+    """一次LLM调用的耗时及token消耗"""
+    request_id: Optional[str]
+    agent: Optional[str]
+    step: int
+    model: str
+    stream: bool
+    # 首个内容chunk、首个工具调用chunk的耗时，非流式调用为空
+    ttft_ms: Optional[int]
+    first_tool_ms: Optional[int]
+    duration_ms: int
+    input_tokens: int
+    output_tokens: int
+    cached_tokens: int
+    # 服务端没有返回usage，token数由TokenCounter估算
+    estimated: bool
+    cost: float
+    error: Optional[str] = None
+
+
+class UsageLedger:
+    """一次运行内全部LLM调用的记录及汇总"""
+
+    def __init__(self):
+        self.records = list()
+        self._lock = threading.Lock()
+
+    def add(self, record: UsageRecord):
+        with self._lock:
+            self.records.append(record)
+
+    def summary(self):
+        with self._lock:
+            records = list(self.records)
+        input_tokens = sum(record.input_tokens for record in records)
+        output_tokens = sum(record.output_tokens for record in records)
+        return {
+            "calls": len(records),
+            "inputTokens": input_tokens,
+            "outputTokens": output_tokens,
+            "cachedTokens": sum(record.cached_tokens for record in records),
+            "totalTokens": input_tokens + output_tokens,
+            "durationMs": sum(record.duration_ms for record in records),
+            "cost": round(sum(record.cost for record in records), 6),
+        }
+
+    def to_list(self):
+        with self._lock:
+            return [asdict(record) for record in self.records]
+
+
+def _field(obj, name: str):
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(name, None)
+    return getattr(obj, name, None)
+
+
+def _cost(model: str, input_tokens: int, output_tokens: int, cached_tokens: int):
+    """按配置的每千token价格计算费用，未配置的模型为0"""
+    price = genie_config.llm_price_dict.get(model, None)
+    if not price:
+        return 0.0
+    cached_price = price.get("cached", price.get("input", 0))
+    return ((input_tokens - cached_tokens) * price.get("input", 0) + cached_tokens * cached_price
+            + output_tokens * price.get("output", 0)) / 1000
+
+
+class LLMCall:
+    """
+    统计一次LLM调用：首个内容及工具调用的耗时、服务端返回的usage，结束时写入运行的UsageLedger
+    服务端没有返回usage时，输入token数使用调用前的估算值，输出token数按输出内容计算
+    """
+
+    def __init__(self, context, model: str, stream: bool, estimated_input_tokens: int, token_counter):
+        self.context = context
+        self.model = model
+        self.stream = stream
+        self.estimated_input_tokens = estimated_input_tokens
+        self.token_counter = token_counter
+        self.agent, self.step = call_scope.get()
+        self.start = time.monotonic()
+        self.first_token_time = None
+        self.first_tool_time = None
+        self.input_tokens = None
+        self.output_tokens = None
+        self.cached_tokens = 0
+        self._output = list()
+        self.record = None
+
+    def add_output(self, text: Optional[str]):
+        """非流式调用的输出内容，用于估算输出token数"""
+        if text:
+            self._output.append(text)
+
+    def on_token(self, text: Optional[str] = None):
+        if self.first_token_time is None:
+            self.first_token_time = time.monotonic()
+        if text:
+            self._output.append(text)
+
+    def on_tool(self, text: Optional[str] = None):
+        if self.first_tool_time is None:
+            self.first_tool_time = time.monotonic()
+        if text:
+            self._output.append(text)
+
+    def on_usage(self, usage):
+        """合并openai或anthropic的usage，anthropic流式调用的输入及输出token数分别在不同事件中返回"""
+        if usage is None:
+            return
+        tokens = prompt_cache.input_tokens(usage)
+        if tokens is not None:
+            self.input_tokens, self.cached_tokens = tokens
+        output_tokens = _field(usage, "completion_tokens")
+        if output_tokens is None:
+            output_tokens = _field(usage, "output_tokens")
+        if output_tokens is not None:
+            self.output_tokens = output_tokens
+
+    def on_chunk(self, chunk):
+        """解析openai或anthropic的流式chunk"""
+        choices = getattr(chunk, "choices", None)
+        if choices:
+            delta = choices[0].delta
+            if getattr(delta, "content", None):
+                self.on_token(delta.content)
+            tool_calls = getattr(delta, "tool_calls", None)
+            if tool_calls:
+                self.on_tool("".join(tool_call.function.arguments or "" for tool_call in tool_calls
+                                     if tool_call.function is not None))
+        chunk_type = getattr(chunk, "type", None)
+        if chunk_type == "content_block_start" and getattr(chunk.content_block, "type", None) == "tool_use":
+            self.on_tool()
+        elif chunk_type == "content_block_delta":
+            delta_type = getattr(chunk.delta, "type", None)
+            if delta_type == "text_delta":
+                self.on_token(chunk.delta.text)
+            elif delta_type == "input_json_delta":
+                self.on_tool(chunk.delta.partial_json)
+        elif chunk_type == "message_start":
+            self.on_usage(getattr(chunk.message, "usage", None))
+        self.on_usage(getattr(chunk, "usage", None))
+
+    def finish(self, error: Optional[BaseException] = None):
+        """记录调用结果，重复调用时返回第一次的记录"""
+        if self.record is not None:
+            return self.record
+        end = time.monotonic()
+        estimated = self.input_tokens is None or self.output_tokens is None
+        input_tokens = self.input_tokens if self.input_tokens is not None else self.estimated_input_tokens
+        output_tokens = self.output_tokens if self.output_tokens is not None \
+            else self.token_counter.count_text("".join(self._output))
+        self.record = UsageRecord(
+            request_id=self.context.request_id,
+            agent=self.agent,
+            step=self.step,
+            model=self.model,
+            stream=self.stream,
+            ttft_ms=int((self.first_token_time - self.start) * 1000) if self.first_token_time is not None else None,
+            first_tool_ms=int((self.first_tool_time - self.start) * 1000) if self.first_tool_time is not None else None,
+            duration_ms=int((end - self.start) * 1000),
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            cached_tokens=self.cached_tokens,
+            estimated=estimated,
+            cost=_cost(self.model, input_tokens, output_tokens, self.cached_tokens),
+            error=type(error).__name__ if error is not None else None,
+        )
+        self._observe(self.record)
+        ledger = getattr(self.context, "usage_ledger", None)
+        if ledger is not None:
+            ledger.add(self.record)
+        logger.info(f"{self.context.request_id} llm usage {self.record}")
+        return self.record
+
+    @staticmethod
+    def _observe(record: UsageRecord):
+        metrics.observe("llm_call_duration_ms", record.duration_ms, model=record.model)
+        metrics.observe("llm_call_input_tokens", record.input_tokens, TOKEN_BUCKETS, model=record.model)
+        metrics.observe("llm_call_output_tokens", record.output_tokens, TOKEN_BUCKETS, model=record.model)
+        if record.ttft_ms is not None:
+            metrics.observe("llm_ttft_ms", record.ttft_ms, model=record.model)
+            generate_ms = record.duration_ms - record.ttft_ms
+            if generate_ms > 0 and record.output_tokens > 0:
+                metrics.observe("llm_output_tokens_per_second", int(record.output_tokens * 1000 / generate_ms),
+                                (5, 10, 20, 30, 50, 75, 100, 150, 200, 300), model=record.model)
+        if record.first_tool_ms is not None:
+            metrics.observe("llm_first_tool_ms", record.first_tool_ms, model=record.model)
+        if record.cost > 0:
+            metrics.inc("llm_cost", record.cost, model=record.model)
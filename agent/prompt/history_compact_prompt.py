@@ -0,0 +1,17 @@
+class HistoryCompactPrompt:
+    PROMPT = """你负责整理智能体的执行记录。下面是完成用户任务过程中较早步骤的思考、工具调用及工具执行结果，请压缩为一份摘要，后续步骤将只看到这份摘要。
+
+## 要求
+- 保留已经完成的操作，工具调用的关键入参，以及结论性的结果，如数据、文件名、链接、错误原因
+- 保留尚未解决的问题及失败过的尝试，避免后续重复调用
+- 只根据执行记录整理，不要补充或臆造内容
+- 使用纯文本输出，不超过1000字
+
+## 用户任务
+{{query}}
+
+## 执行记录
+{{history}}
+
+## 摘要
+"""
@@ -3,7 +3,6 @@ import json
 import traceback
 from typing import Optional
 
-import requests
 from loguru import logger
 
 from agent.agent.agent_context import AgentContext
@@ -13,6 +12,7 @@ from agent.entity.code_interpreter_response import CodeInterpreterResponse
 from agent.tool.base_tool import BaseTool
 from config.genie_config import genie_config
 from model.response.agent_response import build_stream_response
+from util import http_client
 
 
 class CodeInterpreterTool(BaseTool):
@@ -75,19 +75,18 @@ class CodeInterpreterTool(BaseTool):
         try:
             url = genie_config.code_interpreter_url + "/v1/tool/code_interpreter"
             logger.info(f"{code_req.request_id} code_interpreter request {code_req}")
-            with requests.post(url, json=code_req.model_dump(by_alias=True), stream=True, timeout=(60,300)) as response:
+            async with http_client.async_client().stream(
+                    "POST", url, json=code_req.model_dump(by_alias=True),
+                    timeout=http_client.timeout(self.context.timeout_for((60, 300)))) as response:
 
                 logger.info(f"{self.context.request_id} code_interpreter_tool response {response} {response.status_code}")
                 code_res = CodeInterpreterResponse(
                     code_output="code_interpreter执行失败" # 默认输出
                 )
-                if not response.ok:
+                if not response.is_success:
                     logger.error(f"{code_req.request_id} code_interpreter request error")
                     raise Exception(f"Unexpected response code: {response.status_code}")
-                for line in response.iter_lines():
-                    if line is None:
-                        continue
-                    line = line.decode("utf8")
+                async for line in self.context.aiterate(response.aiter_lines()):
                     if line.startswith("data: "):
                         data = line[6:]
                         if "[DONE]" == data:
@@ -3,7 +3,6 @@ import json
 import uuid
 from typing import Optional
 
-import requests
 from loguru import logger
 
 from agent.agent.agent_context import AgentContext
@@ -14,6 +13,8 @@ from agent.tool.base_tool import BaseTool
 from agent.tool.common.file_tool import FileTool
 from config.genie_config import genie_config
 from model.response.agent_response import build_stream_response
+from util import http_client
+from util.stream_coalescer import StreamCoalescer
 from util.string_util import remove_special_chars
 
 
@@ -71,27 +72,38 @@ class DeepSearchTool(BaseTool):
             self,
             deep_req: DeepSearchRequest
     ):
+        str_all = list()
+        digital_employee = self.context.tool_collection.get_digital_employee(self.name)
+        result = "搜索结果为空" #默认输出
+        message_id = ""
+        report_res = None
+
+        async def send_report(text: str):
+            # 使用最近一次report消息，answer替换为合并后的增量内容
+            data = build_stream_response(
+                self.context.request_id,
+                self.context.agent_type,
+                message_id,
+                "deep_search",
+                report_res.model_copy(update={"answer": text}).model_dump(by_alias=True),
+                digital_employee,
+                False
+            )
+            await self.queue.put(data)
+
+        coalescer = StreamCoalescer(send_report, "deep_search")
         try:
             url = genie_config.deep_search_url + "/v1/tool/deepsearch"
             logger.info(f"{self.context.request_id} deep_search request {deep_req}")
-            intervals = genie_config.message_interval.get("llm", "1,3").split(",")
-            first_interval = int(intervals[0])
-            send_interval = int(intervals[1])
             index = 1
-            with requests.post(url, json=deep_req.dict(), stream=True, timeout=(60,300)) as response:
+            async with http_client.async_client().stream(
+                    "POST", url, json=deep_req.dict(),
+                    timeout=http_client.timeout(self.context.timeout_for((60, 300)))) as response:
                 logger.info(f"{self.context.request_id} deep_search response {response} {response.status_code}")
-                if not response.ok:
+                if not response.is_success:
                     logger.error(f"{deep_req.request_id} deep_search request error")
                     raise Exception(f"Unexpected response code: {response.status_code}")
-                str_incr = list()
-                str_all = list()
-                digital_employee = self.context.tool_collection.get_digital_employee(self.name)
-                result = "搜索结果为空" #默认输出
-                message_id = ""
-                for line in response.iter_lines():
-                    if line is None:
-                        continue
-                    line = line.decode("utf8")
+                async for line in self.context.aiterate(response.aiter_lines()):
                     if line.startswith("data: "):
                         data = line[6:]
                         if "[DONE]" == data:
@@ -102,6 +114,9 @@ class DeepSearchTool(BaseTool):
                             continue
                         search_res = DeepSearchResponse.model_validate_json(data)
                         file_tool = FileTool(self.context)
+                        if "report" != search_res.message_type or search_res.is_final:
+                            # 其他消息输出前先输出报告的剩余内容，保持顺序
+                            await coalescer.flush()
                         # 上传搜索内容到文件中
                         if search_res.is_final:
                             if self.context.is_stream:
@@ -169,25 +184,16 @@ class DeepSearchTool(BaseTool):
                             elif "report" == search_res.message_type:
                                 if index == 1:
                                     message_id = str(uuid.uuid4())
-                                str_incr.append(search_res.answer)
                                 str_all.append(search_res.answer)
-                                if index == first_interval or index % send_interval == 0:
-                                    search_res.answer = "".join(str_incr)
-                                    str_incr.clear()
-                                    data = build_stream_response(
-                                        self.context.request_id,
-                                        self.context.agent_type,
-                                        message_id,
-                                        "deep_search",
-                                        search_res.model_dump(by_alias=True),
-                                        digital_employee,
-                                        False
-                                    )
-                                    await self.queue.put(data)
+                                report_res = search_res
+                                await coalescer.add(search_res.answer)
                                 index += 1
+                await coalescer.flush()
                 return result
 
         except Exception as e:
             logger.error(f"{self.context.request_id} deep_search request error")
             raise e
+        finally:
+            await coalescer.close()
         return None
@@ -2,7 +2,6 @@ import asyncio
 import traceback
 from typing import Optional
 
-import requests
 from loguru import logger
 
 from agent.entity.code_interpreter_response import FileInfo
@@ -12,6 +11,7 @@ from config.genie_config import genie_config
 from agent.agent.agent_context import AgentContext
 from agent.tool.base_tool import BaseTool
 from model.response.agent_response import build_stream_response
+from util import http_client
 from util.string_util import remove_special_chars
 
 class FileTool(BaseTool):
@@ -79,8 +79,10 @@ class FileTool(BaseTool):
             return None
         url = genie_config.code_interpreter_url + "/v1/file_tool/upload_file"
         try:
-            response = requests.post(url, json=file_req.model_dump(by_alias=True), timeout=(60,300))
-            if not response.ok or response.json() is None:
+            response = await http_client.async_client().post(
+                url, json=file_req.model_dump(by_alias=True),
+                timeout=http_client.timeout(self.context.timeout_for((60, 300))))
+            if not response.is_success or response.json() is None:
                 logger.error(f"{self.context.request_id} upload file faied")
                 return None
             file_res = response.json()
@@ -143,8 +145,10 @@ class FileTool(BaseTool):
         )
         try:
             logger.info(f"{self.context.request_id} file tool get request {req}")
-            response = requests.post(url, json=req.model_dump(by_alias=True), timeout=(60, 300))
-            if not response.ok or response.json() is None:
+            response = await http_client.async_client().post(
+                url, json=req.model_dump(by_alias=True),
+                timeout=http_client.timeout(self.context.timeout_for((60, 300))))
+            if not response.is_success or response.json() is None:
                 err_msg = "获取文件失败"+file_req.file_name
                 logger.error(err_msg)
                 return err_msg
@@ -176,7 +180,7 @@ class FileTool(BaseTool):
                     True
                 )
                 await self.queue.put(data)
-            file_content = self.get_url_content(file_res["ossUrl"])
+            file_content = await self.get_url_content(file_res["ossUrl"])
             if file_content is not None:
                 if len(file_content) > genie_config.file_tool_content_truncate_len:
                     file_content = file_content[: genie_config.file_tool_content_truncate_len]
@@ -185,10 +189,11 @@ class FileTool(BaseTool):
             logger.error(f"{self.context.request_id} get file error")
         return None
 
-    def get_url_content(self, url):
+    async def get_url_content(self, url):
         try:
-            response = requests.get(url, timeout=(60,300))
-            if not response.ok or response.text is None:
+            response = await http_client.async_client().get(
+                url, timeout=http_client.timeout(self.context.timeout_for((60, 300))))
+            if not response.is_success or response.text is None:
                 err_msg = f"{self.context.request_id} 获取文件失败, 状态码:{response.status_code}"
                 logger.error(err_msg)
                 return None
@@ -2,7 +2,6 @@ import asyncio
 import traceback
 import uuid
 from typing import Optional
-import requests
 from loguru import logger
 
 from agent.agent.agent_context import AgentContext
@@ -14,6 +13,8 @@ from agent.tool.common.file_tool import FileTool
 from config.genie_config import genie_config
 from model.response.agent_response import build_stream_response
 from util import string_util
+from util import http_client
+from util.stream_coalescer import StreamCoalescer
 
 
 class MultiModalAgent(BaseTool):
@@ -78,24 +79,36 @@ class MultiModalAgent(BaseTool):
             multi_modal_req: MultiModalAgentRequest
     ):
         url = genie_config.multi_modal_agent_url + "/v1/tool/mragQuery"
-        intervals = genie_config.message_interval.get("knowledge", "1,4").split(",")
-        first_interval = int(intervals[0])
-        send_interval = int(intervals[1])
-        index = 1
         message_id = str(uuid.uuid4())
         digital_employee = self.context.tool_collection.get_digital_employee(self.name)
-        str_incr_list = list()
         str_all_list = list()
+        multi_res = None
+
+        async def send_incr(text: str):
+            # 使用最近一次的响应，data替换为合并后的增量内容
+            incr_res = multi_res.model_copy(update={"data": text, "is_final": False})
+            data = build_stream_response(
+                self.context.request_id,
+                self.context.agent_type,
+                message_id,
+                "markdown",
+                incr_res.model_dump(by_alias=True),
+                digital_employee,
+                False
+            )
+            await self.queue.put(data)
+
+        coalescer = StreamCoalescer(send_incr, "knowledge")
         try:
-            with requests.post(url, json=multi_modal_req.model_dump(by_alias=True), stream=True,
-                               timeout=(60, 600)) as response:
-                if not response.ok:
+            async with http_client.async_client().stream(
+                    "POST", url, json=multi_modal_req.model_dump(by_alias=True),
+                    timeout=http_client.timeout(self.context.timeout_for((60, 600)))) as response:
+                if not response.is_success:
                     logger.error(f"{multi_modal_req.request_id} multi_modal_agent_tool request error")
                     return
-                for line in response.iter_lines():
-                    if line is None or len(line) == 0:
+                async for line in self.context.aiterate(response.aiter_lines()):
+                    if len(line) == 0:
                         continue
-                    line = line.decode("utf8")
                     if line.startswith("data: "):
                         data = line[6:]
                         if "[DONE]" == data:
@@ -117,14 +130,11 @@ class MultiModalAgent(BaseTool):
                                 if "![图片]" in content:
                                     logger.info(f"{self.context.request_id} knowledge_tool received image content: {content}")
 
-                                str_incr_list.append(content)
                                 str_all_list.append(content)
+                                await coalescer.add(content)
 
-                                if index == first_interval or index % send_interval == 0:
-                                    multi_res.data = "".join(str_incr_list)
-                                    multi_res.is_final = False
-                                    str_incr_list.clear()
                                 if "stop" == choice.finish_reason:
+                                    await coalescer.flush()
                                     # 最终响应时使用累加的完整结果,并发送
                                     multi_res.data = "".join(str_all_list)
                                     multi_res.is_final = True
@@ -149,14 +159,17 @@ class MultiModalAgent(BaseTool):
                                         description=file_desc,
                                         content="".join(str_all_list)
                                     )
-                                    file_tool.upload_file(file_req, is_notice_fe=False, is_internal_file=False)
+                                    await file_tool.upload_file(file_req, is_notice_fe=False, is_internal_file=False)
 
+            await coalescer.flush()
             result = "".join(str_all_list) if len(str_all_list) > 0 else "knowledge_tool 执行完成"
             logger.info(f" ==== knowledge_tool recv data: {result} ====")
             return result
         except Exception:
             logger.error(f"{self.context.request_id} knowledge_tool request error")
             logger.error(traceback.format_exc())
+        finally:
+            await coalescer.close()
 
         return None
 
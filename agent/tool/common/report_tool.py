@@ -3,7 +3,6 @@ import json
 import traceback
 import uuid
 
-import requests
 from loguru import logger
 
 from agent.entity.file import File
@@ -14,6 +13,8 @@ from agent.tool.base_tool import BaseTool
 from agent.agent.agent_context import AgentContext
 from config.genie_config import genie_config
 from model.response.agent_response import build_stream_response
+from util import http_client
+from util.stream_coalescer import StreamCoalescer
 
 
 class ReportTool(BaseTool):
@@ -86,26 +87,34 @@ class ReportTool(BaseTool):
             code_req: CodeInterpreterRequest
     ):
         url = genie_config.code_interpreter_url + "/v1/tool/report"
-        intervals = genie_config.message_interval.get("llm", "1,3").split(",")
-        first_interval = int(intervals[0])
-        send_interval = int(intervals[1])
         index = 1
         message_id = str(uuid.uuid4())
         digital_employee = self.context.tool_collection.get_digital_employee(self.name)
+        code_res = None
+
+        async def send_incr(text: str):
+            # 使用最近一次的响应，data替换为合并后的增量内容
+            data = build_stream_response(
+                self.context.request_id,
+                self.context.agent_type,
+                message_id,
+                code_req.file_type,
+                code_res.model_copy(update={"data": text}).model_dump(by_alias=True),
+                digital_employee,# 数字人
+                False
+            )
+            await self.queue.put(data)
+
+        coalescer = StreamCoalescer(send_incr, "report")
         try:
-            with requests.post(url, json=code_req.model_dump(by_alias=True), stream=True, timeout=(60,600)) as response:
+            async with http_client.async_client().stream(
+                    "POST", url, json=code_req.model_dump(by_alias=True),
+                    timeout=http_client.timeout(self.context.timeout_for((60, 600)))) as response:
                 logger.info(f"{self.context.request_id} report_tool response {response} {response.status_code}")
-                if response.raw is None or response.content is None:
-                    logger.error(f"{code_req.request_id} report_tool request error")
-                    return
-                if not response.ok:
+                if not response.is_success:
                     logger.error(f"{code_req.request_id} report_tool request error")
                     return
-                str_incr = list()
-                for line in response.iter_lines():
-                    if line is None:
-                        continue
-                    line = line.decode("utf8")
+                async for line in self.context.aiterate(response.aiter_lines()):
                     if line.startswith("data: "):
                         data = line[6:]
                         if "[DONE]" == data:
@@ -116,6 +125,7 @@ class ReportTool(BaseTool):
                             continue
                         code_res = CodeInterpreterResponse.model_validate_json(data)
                         if code_res.is_final:
+                            await coalescer.flush()
                             #report_tool只会输出一个文件，使用模型输出的文件名和描述
                             if not code_res.file_info:
                                 for file_info in code_res.file_info:
@@ -140,25 +150,15 @@ class ReportTool(BaseTool):
                             )
                             await self.queue.put(data)
                         else:
-                            str_incr.append(code_res.data)
-                            if index == first_interval or index % send_interval == 0:
-                                code_res.data = "".join(str_incr)
-                                data = build_stream_response(
-                                    self.context.request_id,
-                                    self.context.agent_type,
-                                    message_id,
-                                    code_req.file_type,
-                                    code_res.model_dump(by_alias=True),
-                                    digital_employee,# 数字人
-                                    False
-                                )
-                                await self.queue.put(data)
-                                str_incr.clear()
+                            await coalescer.add(code_res.data)
                         index += 1
+                await coalescer.flush()
         except Exception:
             logger.error(f"{self.context.request_id} report_tool request error")
             logger.error(traceback.format_exc())
             return
+        finally:
+            await coalescer.close()
 
         result = code_res.data if code_res.data is not None and len(code_res.data) != 0 else code_res.code_output
         return result
@@ -1,12 +1,11 @@
 import json
 import traceback
 
-import requests
-
 from agent.tool.base_tool import BaseTool
 from config.genie_config import genie_config
 from loguru import logger
 from http import HTTPStatus
+from util import http_client
 
 
 class McpTool(BaseTool):
@@ -29,11 +28,11 @@ class McpTool(BaseTool):
     async def execute(self, obj):
         return None
 
-    def list_tool(self, mcp_server_url):
+    async def list_tool(self, mcp_server_url):
         try:
             mcp_client_url = genie_config.mcp_client_url + "/v1/tool/list"
             mcp_req = {"server_url": mcp_server_url}
-            mcp_res = requests.post(mcp_client_url, json=mcp_req, timeout=30)
+            mcp_res = await http_client.async_client().post(mcp_client_url, json=mcp_req, timeout=30)
             logger.info(f"list tool request: {mcp_req} response: {mcp_res.json()}")
             return json.dumps(mcp_res.json(), ensure_ascii=False)
         except Exception:
@@ -44,13 +43,14 @@ class McpTool(BaseTool):
         try:
             mcp_client_url = genie_config.mcp_client_url + "/v1/tool/call"
             mcp_req = {"name": tool_name, "server_url": mcp_server_url, "arguments": tool_input}
-            mcp_res = requests.post(mcp_client_url, json=mcp_req, timeout=30)
+            mcp_res = await http_client.async_client().post(
+                mcp_client_url, json=mcp_req, timeout=http_client.timeout(self.agent_context.timeout_for(30)))
             if mcp_res.status_code != HTTPStatus.OK:
                 logger.error(f"{self.agent_context.request_id} call tool error")
                 return ""
 
             logger.info(f"call tool request: {mcp_req} response: {mcp_res.json()}")
-            return mcp_res
+            return mcp_res.text
         except Exception:
             logger.error(f"{self.agent_context.request_id} call tool error ")
             logger.error(traceback.format_exc())
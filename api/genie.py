@@ -1,56 +1,127 @@
-import asyncio
-import contextvars
-import json
-import threading
+import httpx
 from model.protocal import AgentRequest, GptQueryReq
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException, Request, Response
 from sse_starlette import ServerSentEvent, EventSourceResponse
 from loguru import logger
-from config.genie_config import genie_config
-from agent.agent.auto_agent import AutoAgent
+from model.response.agent_response import AgentResponse
 from service import multi_agent
+from service.agent_runner import agent_runner, RunnerBusyError
+from service.agent_service import start_auto_agent
+from service.drain import drain_controller
+from service.event_channel import EventChannel
+from service import run_registry as registry
+from service.run_registry import run_registry
+from service.run_stream import RunStream, parse_last_event_id
+from util.metrics import metrics
+from agent.llm.client_pool import client_pool
 
 router = APIRouter()
 
 
-def handle_output_style(query: str, output_style: str):
-    query += genie_config.output_style_prompts_dict.get(output_style, "")
-    return query
-
-
 @router.post("/AutoAgent")
 async def auto_agent(request: AgentRequest):
     logger.info(f"{request.request_id} auto agent request: {request}")
-    # 拼接输出类型
-    request.query = handle_output_style(request.query, request.output_style)
-    queue = asyncio.Queue()
-
-    async def _stream(queue):
-        while True:
-            data = await queue.get()
-            if isinstance(data, str):
-                if "[DONE]" in data:
-                    data = data.replace("[DONE]", "")
-                    yield ServerSentEvent(data=data)
-            yield ServerSentEvent(data=data)
-
-    def run_task(context, queue, request):
-        context.run(lambda: asyncio.run(AutoAgent(queue).run(request)))
-
-    thread = threading.Thread(target=run_task, args=(contextvars.copy_context(), queue, request), daemon=True)
-    thread.start()
+    _check_accepting(request.request_id)
+    queue = EventChannel()
+
+    def _transform(data):
+        if isinstance(data, AgentResponse):
+            return data.model_dump_json(), data.finish
+        return data, False
+
+    try:
+        state = start_auto_agent(request, queue)
+    except RunnerBusyError as e:
+        logger.error(f"{request.request_id} {str(e)}")
+        raise HTTPException(status_code=503, detail="agent runner is busy")
+    # 客户端断开超过宽限时间未续传时取消运行，避免继续消耗LLM及工具调用
+    stream = RunStream(request.request_id, queue, _transform, is_done=lambda: state.finished,
+                       on_abandon=lambda: state.cancel("client disconnected"))
+    state.stream = stream
+    run_registry.register_stream("agent:" + request.request_id, stream)
     return EventSourceResponse(
-        _stream(queue),
+        stream.subscribe(),
         ping_message_factory=lambda: ServerSentEvent(data="heartbeat"),
         ping=10
     )
 
 
+@router.get("/AutoAgent/resume/{request_id}")
+async def resume_auto_agent(request_id: str, raw_request: Request):
+    return await _resume_stream("agent:", request_id, raw_request, ping=10)
+
+
+def _check_accepting(request_id: str):
+    """服务排空中不再接收新的agent请求"""
+    if drain_controller.draining:
+        logger.warning(f"{request_id} server is draining, reject request")
+        raise HTTPException(status_code=503, detail="server is draining")
+
+
 @router.get("/web/health")
 def health():
+    # 排空中返回503，负载均衡不再转发新请求
+    if drain_controller.draining:
+        return Response(content="draining", status_code=503)
     return "ok"
 
 
+@router.get("/web/metrics")
+def get_metrics():
+    return metrics.snapshot()
+
+
+@router.get("/web/runner/stats")
+def runner_stats():
+    stats = agent_runner.stats()
+    stats["registry"] = run_registry.stats()
+    stats["llmClients"] = client_pool.stats()
+    return stats
+
+
+@router.get("/web/api/v1/gpt/run/{request_id}")
+async def run_status(request_id: str, raw_request: Request):
+    state = run_registry.get_local(request_id)
+    if state is not None:
+        return state.to_dict()
+    entry = run_registry.remote_owner("run:" + request_id)
+    if entry is not None and not registry.is_forwarded(raw_request):
+        return await registry.forward(raw_request, entry)
+    raise HTTPException(status_code=404, detail="run not found")
+
+
+@router.get("/web/api/v1/gpt/resume/{request_id}")
+async def resume_agent_stream_incr(request_id: str, raw_request: Request):
+    """queryAgentStreamIncr断线续传，Last-Event-ID为客户端最后收到的事件id"""
+    return await _resume_stream("incr:", request_id, raw_request)
+
+
+async def _resume_stream(prefix: str, request_id: str, raw_request: Request, ping=None):
+    stream = run_registry.get_stream(prefix + request_id)
+    if stream is None:
+        entry = run_registry.remote_owner("run:" + request_id)
+        if entry is not None and not registry.is_forwarded(raw_request):
+            return await registry.forward(raw_request, entry)
+        raise HTTPException(status_code=404, detail="stream not found")
+    last_event_id = parse_last_event_id(raw_request.headers.get("Last-Event-ID")
+                                        or raw_request.query_params.get("lastEventId"))
+    if ping is None:
+        return EventSourceResponse(stream.subscribe(last_event_id))
+    return EventSourceResponse(
+        stream.subscribe(last_event_id),
+        ping_message_factory=lambda: ServerSentEvent(data="heartbeat"),
+        ping=ping
+    )
+
+
 @router.post("/web/api/v1/gpt/queryAgentStreamIncr")
-async def query_agent_stream_incr(request: GptQueryReq):
+async def query_agent_stream_incr(request: GptQueryReq, raw_request: Request):
+    _check_accepting(request.request_id)
+    # 同一会话的请求交给持有会话状态的worker处理
+    entry = run_registry.remote_owner("session:" + request.session_id)
+    if entry is not None and not registry.is_forwarded(raw_request):
+        try:
+            return await registry.forward(raw_request, entry)
+        except httpx.TransportError:
+            logger.error(f"{request.request_id} forward to worker {entry['workerId']} failed, handle locally")
     return await multi_agent.query_multi_agent_incr_stream(request)
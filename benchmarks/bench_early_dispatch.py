@@ -0,0 +1,158 @@
+"""
+提前执行工具基准：本地模拟的LLM服务流式输出多个deep_search工具调用，模拟的搜索服务流式返回结果，
+对比开启、关闭提前执行时工具开始执行的时间与模型输出结束时间的关系，以及整步耗时
+
+用法：python benchmarks/bench_early_dispatch.py [--tools 3] [--arg-chunks 10] [--chunk-ms 50] [--search-ms 600] [--omit-ids]
+--omit-ids模拟不返回工具调用id的OpenAI兼容接口
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from dotenv import load_dotenv
+
+ARGS = None
+# 搜索服务收到各请求的时间
+SEARCH_STARTS = list()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """模拟LLM的/chat/completions流式工具调用，及deep_search、文件上传接口"""
+
+    protocol_version = "HTTP/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    def _sse(self, data):
+        self.wfile.write(f"data: {data}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["content-length"])))
+        if self.path.endswith("/chat/completions"):
+            self.send_response(200)
+            self.send_header("content-type", "text/event-stream")
+            self.end_headers()
+            self._stream_tool_calls()
+        elif self.path.endswith("/v1/tool/deepsearch"):
+            SEARCH_STARTS.append(time.monotonic())
+            self.send_response(200)
+            self.send_header("content-type", "text/event-stream")
+            self.end_headers()
+            self._stream_search(body["query"])
+        else:
+            content = json.dumps({"ossUrl": "oss", "domainUrl": "domain", "fileSize": 1}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    def _stream_tool_calls(self):
+        for index in range(ARGS.tools):
+            arguments = json.dumps({"query": f"query {index} " + "x" * ARGS.arg_chunks})
+            size = max(1, len(arguments) // ARGS.arg_chunks)
+            pieces = [arguments[i:i + size] for i in range(0, len(arguments), size)]
+            for n, piece in enumerate(pieces):
+                tool_call = {"index": index, "function": {"arguments": piece}}
+                if n == 0:
+                    tool_call.update(id=None if ARGS.omit_ids else f"call_{index}", type="function")
+                    tool_call["function"]["name"] = "deep_search"
+                chunk = {"id": "c", "object": "chat.completion.chunk", "created": 1, "model": "m",
+                         "choices": [{"index": 0, "delta": {"tool_calls": [tool_call]}, "finish_reason": None}]}
+                self._sse(json.dumps(chunk))
+                time.sleep(ARGS.chunk_ms / 1000)
+        self._sse("[DONE]")
+
+    def _stream_search(self, query: str):
+        parts = 5
+        for n in range(parts):
+            self._sse(json.dumps({"requestId": "bench", "query": query, "answer": f"{query} part {n} ",
+                                  "isFinal": False, "messageType": "report",
+                                  "searchResult": {"query": [], "docs": []}}))
+            time.sleep(ARGS.search_ms / 1000 / parts)
+        self._sse(json.dumps({"requestId": "bench", "query": query, "answer": f"{query} answer", "isFinal": True,
+                              "messageType": "report", "searchResult": {"query": [], "docs": []}}))
+        self._sse("[DONE]")
+
+
+def start_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ["llm.settings"] = json.dumps({"bench": {"model": "bench-model", "base_url": url + "/v1",
+                                                       "api_key": "bench", "interface_url": "/chat/completions"}})
+    os.environ["autobots.autoagent.deep_search_url"] = url
+    os.environ["autobots.autoagent.code_interpreter_url"] = url
+    os.environ["autobots.autoagent.llm.cache.enable"] = "0"
+    # 已设置的环境变量优先，没有.env时使用模板中的默认配置
+    if not load_dotenv():
+        load_dotenv(os.path.join(ROOT, ".env_template"))
+
+
+async def run_step(early: bool, report: bool = True):
+    from agent.agent.agent_context import AgentContext, ToolCollection
+    from agent.agent.base_agent import BaseAgent, ToolDispatcher
+    from agent.agent.message import Message, Memory
+    from agent.llm.llm import LLM
+    from agent.tool.common.deep_search_tool import DeepSearchTool
+
+    context = AgentContext(request_id="bench", session_id="bench", query="bench", queue=asyncio.Queue(),
+                           agent_type=1, is_stream=True, product_files=list(), task_product_files=list())
+    tools = ToolCollection(context)
+    tools.add_tool(DeepSearchTool(context, context.queue))
+    context.tool_collection = tools
+    agent = BaseAgent(context=context, available_tools=tools)
+    agent.tool_dispatcher = ToolDispatcher(agent.execute_tool) if early else None
+    memory = Memory()
+    memory.add_message(Message.user_message("bench", None))
+
+    SEARCH_STARTS.clear()
+    start = time.monotonic()
+    # 两种方式都使用流式调用，关闭提前执行时等模型输出结束后再执行工具
+    response = await LLM("bench").ask_tool(context, memory, Message.system_message("bench", None), tools, "auto",
+                                           not early, 60, 0, agent.tool_dispatcher)
+    stream_end = time.monotonic()
+    results = await agent.execute_tools(response.tool_calls)
+    end = time.monotonic()
+    # 每个工具调用拿到自己的结果
+    assert len(results) == ARGS.tools, results
+    for index, tool_call in enumerate(response.tool_calls):
+        assert results[tool_call.id].startswith(f"query {index} "), results
+    if not report:
+        return
+    starts = ", ".join(f"{(t - stream_end) * 1000:+.0f}" for t in SEARCH_STARTS)
+    print(f"{'early' if early else 'sequential':<12}stream {(stream_end - start) * 1000:>6.0f}ms  "
+          f"tool starts vs stream end [{starts}]ms  step {(end - start) * 1000:>6.0f}ms")
+
+
+def main():
+    global ARGS
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tools", type=int, default=3)
+    parser.add_argument("--arg-chunks", type=int, default=10)
+    parser.add_argument("--chunk-ms", type=int, default=50)
+    parser.add_argument("--search-ms", type=int, default=600)
+    parser.add_argument("--omit-ids", action="store_true")
+    ARGS = parser.parse_args()
+    start_server()
+
+    from loguru import logger
+    logger.remove()
+    # 预热：加载分词器、建立连接池
+    asyncio.run(run_step(False, False))
+    asyncio.run(run_step(False))
+    asyncio.run(run_step(True))
+
+
+if __name__ == "__main__":
+    main()
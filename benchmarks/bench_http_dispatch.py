@@ -0,0 +1,142 @@
+"""
+HTTP回环调度检查：启动服务及本地模拟的LLM服务，分别以进程内（local）及HTTP回环（http）方式
+调用/web/api/v1/gpt/queryAgentStreamIncr完成一次react运行，检查两种方式都收到最终结果及各自的耗时
+http方式下queryAgentStreamIncr通过/AutoAgent的SSE流（带id、retry字段）接收agent事件
+
+用法：python benchmarks/bench_http_dispatch.py [--runs 3]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from dotenv import load_dotenv
+
+ANSWER = "bench answer"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """模拟LLM的/chat/completions，不调用工具直接返回文本，其他接口返回空结果"""
+
+    protocol_version = "HTTP/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, content_type: str, content: bytes = None):
+        self.send_response(200)
+        self.send_header("content-type", content_type)
+        if content is not None:
+            self.send_header("content-length", str(len(content)))
+        self.end_headers()
+        if content is not None:
+            self.wfile.write(content)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["content-length"])) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            self._send("application/json", b"{}")
+        elif body.get("stream"):
+            self._send("text/event-stream")
+            chunk = {"id": "c", "object": "chat.completion.chunk", "created": 1, "model": "m",
+                     "choices": [{"index": 0, "delta": {"content": ANSWER}, "finish_reason": "stop"}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        else:
+            content = {"id": "c", "object": "chat.completion", "created": 1, "model": "m",
+                       "choices": [{"index": 0, "message": {"role": "assistant", "content": ANSWER},
+                                    "finish_reason": "stop"}]}
+            self._send("application/json", json.dumps(content).encode("utf-8"))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_servers():
+    stand_in = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=stand_in.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{stand_in.server_address[1]}"
+    port = free_port()
+    os.environ["llm.settings"] = json.dumps({"bench": {"model": "bench-model", "base_url": url + "/v1",
+                                                       "api_key": "bench", "interface_url": "/chat/completions"}})
+    for name in ("planner", "executor", "react"):
+        os.environ[f"autobots.autoagent.{name}.model_name"] = "bench"
+    os.environ["autobots.autoagent.default_model_name"] = "bench"
+    for name in ("code_interpreter_url", "deep_search_url", "mcp_client_url", "knowledge_url",
+                 "multimodalagent_url", "data_analysis_url"):
+        os.environ[f"autobots.autoagent.{name}"] = url
+    os.environ["autobots.autoagent.mcp_server_url"] = "[]"
+    os.environ["autobots.server.port"] = str(port)
+    os.environ["autobots.multiagent.auto_agent_url"] = ""
+    os.environ["autobots.server.worker_address"] = ""
+    # 已设置的环境变量优先，没有.env时使用模板中的默认配置
+    if not load_dotenv():
+        load_dotenv(os.path.join(ROOT, ".env_template"))
+
+    import uvicorn
+    from server import create_app
+    server = uvicorn.Server(uvicorn.Config(create_app(), host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, f"http://127.0.0.1:{port}"
+
+
+async def run_once(base_url: str, request_id: str):
+    """调用queryAgentStreamIncr直到最终结果，返回(最终结果, 事件数)"""
+    import httpx
+    from service.multi_agent import iter_sse_data
+
+    body = {"query": "bench", "sessionId": request_id, "requestId": request_id, "deepThink": 0, "user": "bench"}
+    events = 0
+    async with httpx.AsyncClient(timeout=60) as client:
+        async with client.stream("POST", base_url + "/web/api/v1/gpt/queryAgentStreamIncr", json=body) as response:
+            assert response.is_success, response.status_code
+            async for data in iter_sse_data(response.aiter_lines()):
+                events += 1
+                result = json.loads(data)
+                if result.get("finished"):
+                    return result, events
+    return None, events
+
+
+async def check(base_url: str, runs: int):
+    from config.genie_config import genie_config
+
+    for mode in ("local", "http"):
+        genie_config.multi_agent_dispatch_mode = mode
+        for index in range(runs):
+            start = time.monotonic()
+            result, events = await run_once(base_url, f"bench-{mode}-{index}")
+            cost = (time.monotonic() - start) * 1000
+            assert result is not None, f"{mode} stream ended without final result"
+            assert result["status"] == "success", result
+            print(f"{mode:<6}run {index}  events {events:>3}  status {result['status']}  {cost:>6.0f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+    server, base_url = start_servers()
+
+    from loguru import logger
+    logger.remove()
+    try:
+        asyncio.run(check(base_url, args.runs))
+    finally:
+        server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
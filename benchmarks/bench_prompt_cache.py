@@ -0,0 +1,182 @@
+"""
+提示缓存检查：本地模拟的LLM服务记录收到的请求，并在usage中返回命中缓存的token数，
+检查开启提示缓存时发送的prompt_cache_key、stream_options、anthropic-beta请求头及cache_control断点，
+struct_parse模式下系统提示与工具说明的顺序不变，以及从usage中解析出的命中缓存token数
+
+用法：python benchmarks/bench_prompt_cache.py
+"""
+import asyncio
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from dotenv import load_dotenv
+
+SYSTEM_PROMPT = "bench system prompt"
+# 模拟服务收到的请求：(路径, 请求头, 请求体)
+REQUESTS = list()
+OPENAI_USAGE = {"prompt_tokens": 1200, "completion_tokens": 3, "total_tokens": 1203,
+                "prompt_tokens_details": {"cached_tokens": 1024}}
+CLAUDE_USAGE = {"input_tokens": 20, "output_tokens": 1, "cache_read_input_tokens": 1000,
+                "cache_creation_input_tokens": 5}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """模拟OpenAI兼容的/chat/completions及anthropic的/v1/messages，返回固定的usage"""
+
+    protocol_version = "HTTP/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    def _event(self, data, event: str = None):
+        prefix = f"event: {event}\n" if event else ""
+        self.wfile.write(f"{prefix}data: {data}\n\n".encode("utf-8"))
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["content-length"])))
+        REQUESTS.append((self.path, dict(self.headers), body))
+        if self.path.endswith("/messages"):
+            self._claude_stream()
+        elif body.get("stream"):
+            self._openai_stream(body)
+        else:
+            content = json.dumps({"id": "c", "object": "chat.completion", "created": 1, "model": "m",
+                                  "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"},
+                                               "finish_reason": "stop"}],
+                                  "usage": OPENAI_USAGE}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    def _openai_stream(self, body: dict):
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.end_headers()
+        chunk = {"id": "c", "object": "chat.completion.chunk", "created": 1, "model": "m",
+                 "choices": [{"index": 0, "delta": {"content": "ok"}, "finish_reason": None}]}
+        self._event(json.dumps(chunk))
+        # 请求中带stream_options.include_usage时最后返回usage
+        if (body.get("stream_options") or {}).get("include_usage"):
+            chunk = {"id": "c", "object": "chat.completion.chunk", "created": 1, "model": "m", "choices": [],
+                     "usage": OPENAI_USAGE}
+            self._event(json.dumps(chunk))
+        self._event("[DONE]")
+
+    def _claude_stream(self):
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.end_headers()
+        events = [
+            {"type": "message_start",
+             "message": {"id": "m", "type": "message", "role": "assistant", "model": "claude", "content": [],
+                         "stop_reason": None, "stop_sequence": None, "usage": CLAUDE_USAGE}},
+            {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+            {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "ok"}},
+            {"type": "content_block_stop", "index": 0},
+            {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+             "usage": {"output_tokens": 3}},
+            {"type": "message_stop"},
+        ]
+        for event in events:
+            self._event(json.dumps(event), event["type"])
+
+
+def start_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ["llm.settings"] = json.dumps({
+        "gpt": {"model": "bench-gpt", "base_url": url + "/v1", "api_key": "bench",
+                "interface_url": "/chat/completions"},
+        "gpt-struct": {"model": "bench-gpt", "base_url": url + "/v1", "api_key": "bench",
+                       "interface_url": "/chat/completions", "function_call_type": "struct_parse"},
+        "claude": {"model": "claude-bench", "base_url": url, "api_key": "bench", "interface_url": ""},
+    })
+    os.environ["autobots.autoagent.llm.prompt_cache.enable"] = "1"
+    os.environ["autobots.autoagent.llm.prompt_cache.key"] = "1"
+    os.environ["autobots.autoagent.llm.stream_include_usage"] = "1"
+    os.environ["autobots.autoagent.llm.cache.enable"] = "0"
+    # 已设置的环境变量优先，没有.env时使用模板中的默认配置
+    if not load_dotenv():
+        load_dotenv(os.path.join(ROOT, ".env_template"))
+
+
+def cached_tokens(model: str):
+    from util.metrics import metrics
+    return metrics.get("llm_input_tokens", model=model, cache="hit"), \
+        metrics.get("llm_input_tokens", model=model, cache="miss")
+
+
+def cache_control_paths(value, path: str = ""):
+    """请求体中设置了cache_control的位置"""
+    if isinstance(value, dict):
+        paths = [path] if "cache_control" in value else []
+        for key, item in value.items():
+            paths.extend(cache_control_paths(item, f"{path}.{key}" if path else key))
+        return paths
+    if isinstance(value, list):
+        return [p for index, item in enumerate(value) for p in cache_control_paths(item, f"{path}[{index}]")]
+    return []
+
+
+async def ask(model_name: str, stream: bool):
+    from agent.agent.agent_context import AgentContext, ToolCollection
+    from agent.agent.message import Message, Memory
+    from agent.llm.llm import LLM
+    from agent.tool.common.planning_tool import PlanningTool
+
+    context = AgentContext(request_id="bench", session_id="bench", query="bench", queue=asyncio.Queue(),
+                           agent_type=1, is_stream=stream, product_files=list(), task_product_files=list())
+    tools = ToolCollection(context)
+    tools.add_tool(PlanningTool())
+    memory = Memory()
+    memory.add_message(Message.user_message("bench", None))
+    REQUESTS.clear()
+    await LLM(model_name).ask_tool(context, memory, Message.system_message(SYSTEM_PROMPT, None), tools, "auto",
+                                   stream, 60, 0)
+    return REQUESTS[-1]
+
+
+async def check():
+    keys = list()
+    for stream in (False, True):
+        path, headers, body = await ask("gpt", stream)
+        keys.append(body.get("prompt_cache_key"))
+        print(f"openai {'stream' if stream else 'sync':<7}prompt_cache_key {body.get('prompt_cache_key')}  "
+              f"stream_options {body.get('stream_options')}")
+    assert keys[0] is not None and keys[0] == keys[1], keys
+    hit, miss = cached_tokens("bench-gpt")
+    print(f"openai input tokens cached {hit}, uncached {miss}")
+    assert hit == 2 * OPENAI_USAGE["prompt_tokens_details"]["cached_tokens"], hit
+
+    path, headers, body = await ask("gpt-struct", False)
+    system = body["messages"][0]["content"]
+    print(f"struct_parse system prompt first: {system.startswith(SYSTEM_PROMPT)}")
+    assert system.startswith(SYSTEM_PROMPT + "\n"), system[:80]
+
+    path, headers, body = await ask("claude", True)
+    print(f"claude anthropic-beta {headers.get('anthropic-beta')}  cache_control {cache_control_paths(body)}")
+    assert headers.get("anthropic-beta") and len(cache_control_paths(body)) == 3, body
+    hit, miss = cached_tokens("claude-bench")
+    print(f"claude input tokens cached {hit}, uncached {miss}")
+    assert hit == CLAUDE_USAGE["cache_read_input_tokens"], hit
+
+
+def main():
+    start_server()
+
+    from loguru import logger
+    logger.remove()
+    asyncio.run(check())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+TokenCounter基准：对比原字符数估算、CJK估算与BPE分词的准确度和耗时，以及按步累计历史消息时缓存的效果
+
+用法：python benchmarks/bench_token_counter.py [--steps 40] [--tokenizer anthropic]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from agent.agent.message import Message
+from agent.llm.token_counter import TokenCounter, EstimateTokenizer, _load_tokenizer
+
+SAMPLES = {
+    "zh": "根据当前状态和可用工具，确定下一步行动。先搜索京东、淘宝、拼多多三大电商平台的优势和劣势，"
+          "再整理分析结果，最后输出一份HTML格式的分析报告。" * 20,
+    "en": "Determine the next action based on the current state and the available tools. "
+          "Search for the strengths and weaknesses of the major e-commerce platforms first. " * 20,
+    "mixed": "调用deep_search工具搜索 \"2024 Q3 revenue\"，结果保存到report_2024.md；"
+             "然后用code_interpreter计算同比增长率 YoY = (cur - prev) / prev。" * 20,
+    "json": '{"function_name": "code_interpreter", "task": "读取data.csv并统计每个品类的销售额", '
+            '"file_names": ["data.csv"], "max_rows": 1000}' * 20,
+}
+
+
+class LegacyTokenizer:
+    """原实现：按字符数计"""
+
+    name = "legacy"
+
+    def count(self, text: str):
+        return len(text)
+
+
+def timeit(func, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def bench_accuracy(reference, repeat: int):
+    print(f"reference tokenizer: {reference.name}")
+    print(f"{'sample':<8}{'chars':>8}{'bpe':>8}{'legacy':>10}{'err':>8}{'estimate':>10}{'err':>8}"
+          f"{'bpe us':>10}{'est us':>10}")
+    estimator = EstimateTokenizer()
+    legacy = LegacyTokenizer()
+    for name, text in SAMPLES.items():
+        bpe = reference.count(text)
+        old = legacy.count(text)
+        est = estimator.count(text)
+        bpe_us = timeit(lambda: reference.count(text), repeat)
+        est_us = timeit(lambda: estimator.count(text), repeat)
+        print(f"{name:<8}{len(text):>8}{bpe:>8}{old:>10}{(old - bpe) / bpe:>8.0%}{est:>10}{(est - bpe) / bpe:>8.0%}"
+              f"{bpe_us:>10.1f}{est_us:>10.1f}")
+
+
+def bench_history(tokenizer, steps: int):
+    """模拟agent每步追加助手消息和工具结果，每步统计全部历史的token数"""
+    texts = list(SAMPLES.values())
+    cached = TokenCounter(tokenizer)
+    messages = [Message.system_message(texts[0], None)]
+    cached_cost = 0
+    uncached_cost = 0
+    for step in range(steps):
+        messages.append(Message.assistant_message(texts[step % len(texts)], None))
+        messages.append(Message.tool_messsage(texts[(step + 1) % len(texts)] * 3, f"call_{step}", None))
+        start = time.perf_counter()
+        cached_total = cached.count_messages(messages)
+        cached_cost += time.perf_counter() - start
+        start = time.perf_counter()
+        uncached_total = sum(TokenCounter.BASE_MESSAGE_TOKENS + tokenizer.count(message.role.value)
+                             + tokenizer.count(message.content) for message in messages)
+        uncached_cost += time.perf_counter() - start
+        assert cached_total == uncached_total
+    print(f"history of {steps} steps ({len(messages)} messages, {cached_total} tokens) with {tokenizer.name}: "
+          f"uncached {uncached_cost * 1000:.1f}ms, cached {cached_cost * 1000:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--tokenizer", default="anthropic", help="参考分词器，如anthropic、tiktoken:cl100k_base、hf:<path>")
+    args = parser.parse_args()
+
+    reference = _load_tokenizer(args.tokenizer)
+    bench_accuracy(reference, args.repeat)
+    print()
+    bench_history(reference, args.steps)
+    bench_history(EstimateTokenizer(), args.steps)
+
+
+if __name__ == "__main__":
+    main()
@@ -36,6 +36,12 @@ class GenieConfig(BaseSettings):
     plan_pre_prompt: str = Field(default="分析问题并制定计划：", validation_alias="autobots.autoagent.planner.pre_prompt")
     task_pre_prompt: str = Field(default="参考对话历史回答，", validation_alias="autobots.autoagent.task.pre_prompt")
     clear_tool_message: str = Field(default="1", validation_alias="autobots.autoagent.tool.clear_tool_message")
+    history_compact_enable: str = Field(default="0", validation_alias="autobots.autoagent.history_compact.enable")
+    history_compact_watermark: int = Field(default=24000, validation_alias="autobots.autoagent.history_compact.watermark")
+    history_compact_keep_rounds: int = Field(default=2, validation_alias="autobots.autoagent.history_compact.keep_rounds")
+    history_compact_model_name: str = Field(default="", validation_alias="autobots.autoagent.history_compact.model_name")
+    history_compact_prompt: str = Field(default="", validation_alias="autobots.autoagent.history_compact.prompt")
+    early_tool_dispatch: str = Field(default="0", validation_alias="autobots.autoagent.tool.early_dispatch")
     planning_close_update: str = Field(default="1", validation_alias="autobots.autoagent.planner.close_update")
     deep_search_page_count: str = Field(default="5", validation_alias="autobots.autoagent.deep_search_page_count")
     multi_agent_tool_list_dict: dict = Field(default={}, validation_alias="autobots.autoagent.tool_list")
@@ -56,13 +62,65 @@ class GenieConfig(BaseSettings):
     message_size_limit: int = Field(default=10000, validation_alias="autobots.autoagent.summary.message_size_limit")
     sensitive_patterns: dict = Field(default={}, validation_alias="autobots.autoagent.sensitive_patterns")
     output_style_prompts_dict: dict = Field(default={}, validation_alias="autobots.autoagent.output_style_prompts")
-    message_interval: dict = Field(default={}, validation_alias="autobots.autoagent.message_interval")
+    stream_coalesce_dict: dict = Field(default={"default": {"max_latency_ms": 100, "max_bytes": 256}}, validation_alias="autobots.autoagent.stream_coalesce")
     struct_parse_tool_system_prompt: str = Field(default={}, validation_alias="autobots.autoagent.struct_parse_tool_system_prompt")
     sse_client_read_timeout: int = Field(default=1800, validation_alias="autobots.multiagent.sseClient.readTimeout")
     sse_client_connect_timeout: int = Field(default=1800, validation_alias="autobots.multiagent.sseClient.connectTimeout")
     genie_sop_prompt: str = Field(default="", validation_alias="autobots.autoagent.genie_sop_prompt")
     genie_base_prompt: str = Field(default="", validation_alias="autobots.autoagent.genie_base_prompt")
     task_complete_desc: str = Field(default="当前task完成，请将当前task标记为 completed", validation_alias="autobots.autoagent.tool.task_complete_desc")
+    agent_runner_workers: int = Field(default=4, validation_alias="autobots.autoagent.runner.workers")
+    agent_runner_max_concurrency: int = Field(default=200, validation_alias="autobots.autoagent.runner.max_concurrency")
+    agent_runner_max_pending: int = Field(default=1000, validation_alias="autobots.autoagent.runner.max_pending")
+    agent_runner_tenant_max_concurrency: int = Field(default=20, validation_alias="autobots.autoagent.runner.tenant_max_concurrency")
+    agent_runner_tenant_weights_dict: dict = Field(default={}, validation_alias="autobots.autoagent.runner.tenant_weights")
+    agent_runner_agent_type_cost_dict: dict = Field(default={"3": 4, "5": 1}, validation_alias="autobots.autoagent.runner.agent_type_cost")
+    multi_agent_dispatch_mode: str = Field(default="local", validation_alias="autobots.multiagent.dispatch_mode")
+    auto_agent_url: str = Field(default="", validation_alias="autobots.multiagent.auto_agent_url")
+    heartbeat_interval: int = Field(default=10, validation_alias="autobots.multiagent.heartbeat_interval")
+    event_channel_max_size: int = Field(default=256, validation_alias="autobots.autoagent.event_channel.max_size")
+    run_stream_buffer_size: int = Field(default=512, validation_alias="autobots.autoagent.stream.buffer_size")
+    agent_deadline_seconds: int = Field(default=1800, validation_alias="autobots.autoagent.deadline_seconds")
+    agent_deadline_reserve_seconds: int = Field(default=60, validation_alias="autobots.autoagent.deadline_reserve_seconds")
+    run_stream_resume_grace_seconds: float = Field(default=1, validation_alias="autobots.autoagent.stream.resume_grace_seconds")
+    llm_client_max_connections: int = Field(default=200, validation_alias="autobots.autoagent.llm_client.max_connections")
+    llm_client_max_keepalive_connections: int = Field(default=50, validation_alias="autobots.autoagent.llm_client.max_keepalive_connections")
+    llm_client_keepalive_expiry: float = Field(default=60, validation_alias="autobots.autoagent.llm_client.keepalive_expiry")
+    llm_client_connect_timeout: float = Field(default=10, validation_alias="autobots.autoagent.llm_client.connect_timeout")
+    llm_retry_max_attempts: int = Field(default=3, validation_alias="autobots.autoagent.llm.retry.max_attempts")
+    llm_retry_base_delay_ms: int = Field(default=500, validation_alias="autobots.autoagent.llm.retry.base_delay_ms")
+    llm_retry_max_delay_ms: int = Field(default=8000, validation_alias="autobots.autoagent.llm.retry.max_delay_ms")
+    llm_hedge_percentile: float = Field(default=0, validation_alias="autobots.autoagent.llm.hedge_percentile")
+    llm_latency_window: int = Field(default=200, validation_alias="autobots.autoagent.llm.latency.window")
+    llm_latency_min_samples: int = Field(default=20, validation_alias="autobots.autoagent.llm.latency.min_samples")
+    llm_timeout_percentile: float = Field(default=99, validation_alias="autobots.autoagent.llm.timeout.percentile")
+    llm_timeout_multiplier: float = Field(default=3, validation_alias="autobots.autoagent.llm.timeout.multiplier")
+    llm_timeout_min_seconds: float = Field(default=60, validation_alias="autobots.autoagent.llm.timeout.min_seconds")
+    llm_endpoint_eject_failures: int = Field(default=3, validation_alias="autobots.autoagent.llm.endpoint.eject_failures")
+    llm_endpoint_eject_seconds: int = Field(default=30, validation_alias="autobots.autoagent.llm.endpoint.eject_seconds")
+    llm_cache_enable: str = Field(default="0", validation_alias="autobots.autoagent.llm.cache.enable")
+    llm_cache_tool: str = Field(default="0", validation_alias="autobots.autoagent.llm.cache.tool")
+    llm_cache_max_temperature: float = Field(default=0.1, validation_alias="autobots.autoagent.llm.cache.max_temperature")
+    llm_cache_memory_entries: int = Field(default=1024, validation_alias="autobots.autoagent.llm.cache.memory_entries")
+    llm_cache_ttl_seconds: int = Field(default=86400, validation_alias="autobots.autoagent.llm.cache.ttl_seconds")
+    llm_cache_path: str = Field(default="data/llm-cache", validation_alias="autobots.autoagent.llm.cache.path")
+    llm_cache_max_bytes: int = Field(default=268435456, validation_alias="autobots.autoagent.llm.cache.max_bytes")
+    llm_prompt_cache_enable: str = Field(default="0", validation_alias="autobots.autoagent.llm.prompt_cache.enable")
+    llm_prompt_cache_key: str = Field(default="0", validation_alias="autobots.autoagent.llm.prompt_cache.key")
+    llm_stream_include_usage: str = Field(default="1", validation_alias="autobots.autoagent.llm.stream_include_usage")
+    llm_price_dict: dict = Field(default={}, validation_alias="autobots.autoagent.llm.price")
+    token_counter_tokenizer: str = Field(default="auto", validation_alias="autobots.autoagent.token_counter.tokenizer")
+    server_host: str = Field(default="0.0.0.0", validation_alias="autobots.server.host")
+    server_port: int = Field(default=8080, validation_alias="autobots.server.port")
+    server_workers: int = Field(default=1, validation_alias="autobots.server.workers")
+    server_internal_port: int = Field(default=18080, validation_alias="autobots.server.internal_port")
+    worker_id: str = Field(default="0", validation_alias="autobots.server.worker_id")
+    worker_address: str = Field(default="", validation_alias="autobots.server.worker_address")
+    run_registry_backend: str = Field(default="local", validation_alias="autobots.server.run_registry.backend")
+    run_registry_path: str = Field(default="data/run-registry", validation_alias="autobots.server.run_registry.path")
+    run_registry_ttl: int = Field(default=7200, validation_alias="autobots.server.run_registry.ttl")
+    drain_grace_seconds: int = Field(default=120, validation_alias="autobots.server.drain_grace_seconds")
+    run_retention_seconds: int = Field(default=300, validation_alias="autobots.server.run_retention_seconds")
 
 
 genie_config = GenieConfig()
@@ -12,7 +12,11 @@ class LLMSettings:
             interface_url: Optional[str] = None,
             function_call_type: Optional[str] = None,
             max_input_tokens: int = 0,
-            ext_params: dict = {}
+            ext_params: dict = {},
+            rpm: int = 0,
+            tpm: int = 0,
+            max_concurrency: int = 0,
+            endpoints: Optional[list] = None
     ):
         self.model = model
         self.max_tokens = max_tokens
@@ -25,3 +29,9 @@ class LLMSettings:
         self.function_call_type = function_call_type
         self.max_input_tokens = max_input_tokens
         self.ext_params = ext_params
+        # 接口限流配置，0表示不限制
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        # 多接入点配置，每项可覆盖base_url、api_key、interface_url及限流配置
+        self.endpoints = endpoints
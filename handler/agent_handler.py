@@ -44,6 +44,11 @@ class AgentResponseHandler:
         stream_result.response_type = ResponseTypeEnum.TEXT.value
         stream_result.status = "success" if agent_response.finish else "running"
         stream_result.finished = agent_response.finish
+        if agent_response.finish and agent_response.ext is not None and "usage" in agent_response.ext:
+            # 本次运行LLM调用的总耗时（毫秒）及总token数
+            usage = agent_response.ext["usage"]
+            stream_result.use_times = usage["durationMs"]
+            stream_result.user_tokens = usage["totalTokens"]
 
         if "result" == agent_response.message_type:
             stream_result.response = agent_response.result
@@ -20,7 +20,7 @@ class PlanSolveHandler(AgentHandler):
         self.sop_recall = SopRecall(genie_config)
 
     async def handle(self, context: AgentContext, request: AgentRequest):
-        self._handle_sop_recall(context, request)
+        await self._handle_sop_recall(context, request)
         planning = PlanningAgent(context=context)
         executor = ExecutorAgent(context=context)
         summary = SummaryAgent(context=context)
@@ -28,37 +28,22 @@ class PlanSolveHandler(AgentHandler):
         planning_result = await planning.run(request.query)
         step_idx = 0
         while step_idx <= self.genie_config.planner_max_steps:
+            context.cancel_token.raise_if_cancelled()
             # todo 任务并非是由<sep>进行切分的，所以这里应该是多余的，planning_results中元素只有一个，也就不需要多个executor,所以下面的else并未实现
             planning_results = ["你的任务是："+task for task in planning_result.split("<sep>")]
             context.task_product_files.clear()
             # if len(planning_results) == 1:
             executor_result = await executor.run(planning_results[0])
+            if context.deadline_reached(self.genie_config.agent_deadline_reserve_seconds):
+                # 剩余时间仅够总结，不再规划新的任务，总结已完成的部分
+                logger.warning(f"{context.request_id} request deadline is nearly reached, summary completed tasks")
+                data = await self._summary_task_result(context, request, summary, executor)
+                break
             # else:
             planning_result = await planning.run(executor_result)
             if "finish" == planning_result:
                 # 任务成功结束，总结任务
-                result = summary.summary_task_result(executor.memory.messages, request.query)
-                task_result = dict()
-                task_result["taskSummary"] = result.task_summary
-                if result.files is None or len(result.files) == 0:
-                    if context.product_files is not None and len(context.product_files) != 0:
-                        file_res = context.product_files
-                        #过滤中间搜索结果文件
-                        file_res = [file for file in file_res if not file.get("is_internal_file", None)]
-                        task_result["fileList"] = reversed(file_res)
-                else:
-                    task_result["fileList"] = result.files
-
-                data = build_stream_response(
-                    context.request_id,
-                    context.agent_type,
-                    None,
-                    "result",
-                    task_result,
-                    None,
-                    True
-                )
-                await context.queue.put("[DONE]"+data)
+                data = await self._summary_task_result(context, request, summary, executor)
                 break
 
             if planning.state == AgentState.IDLE or executor.state == AgentState.IDLE:
@@ -71,7 +56,8 @@ class PlanSolveHandler(AgentHandler):
                     None,
                     True
                 )
-                await context.queue.put("[DONE]"+data)
+                data.ext = {"usage": context.usage_ledger.summary()}
+                await context.queue.put(data)
                 break
 
             if planning.state == AgentState.ERROR or executor.state == AgentState.ERROR:
@@ -84,19 +70,47 @@ class PlanSolveHandler(AgentHandler):
                     None,
                     True
                 )
-                await context.queue.put("[DONE]"+data)
+                data.ext = {"usage": context.usage_ledger.summary()}
+                await context.queue.put(data)
                 break
             step_idx += 1
 
         return data
 
+    async def _summary_task_result(self, context: AgentContext, request: AgentRequest, summary: SummaryAgent,
+                                   executor: ExecutorAgent):
+        result = await summary.summary_task_result(executor.memory.messages, request.query)
+        task_result = dict()
+        task_result["taskSummary"] = result.task_summary
+        if result.files is None or len(result.files) == 0:
+            if context.product_files is not None and len(context.product_files) != 0:
+                file_res = context.product_files
+                #过滤中间搜索结果文件
+                file_res = [file for file in file_res if not file.get("is_internal_file", None)]
+                task_result["fileList"] = list(reversed(file_res))
+        else:
+            task_result["fileList"] = result.files
+
+        data = build_stream_response(
+            context.request_id,
+            context.agent_type,
+            None,
+            "result",
+            task_result,
+            None,
+            True
+        )
+        data.ext = {"usage": context.usage_ledger.summary()}
+        await context.queue.put(data)
+        return data
+
     def support(self, agent_type):
         return AgentType.PLAN_SOLVE.value == agent_type
 
-    def _handle_sop_recall(self, agent_context: AgentContext, request):
+    async def _handle_sop_recall(self, agent_context: AgentContext, request):
         try:
             logger.info(f"{request.request_id} 开始执行SOP召回")
-            sop_res = self.sop_recall.sop_recall(request.request_id, request.query)
+            sop_res = await self.sop_recall.sop_recall(request.request_id, request.query, agent_context.timeout_for(3000))
 
             if self.sop_recall.is_valid_sop_result(sop_res):
                 sop_content = sop_res["data"]["choosed_sop_string"]
@@ -20,7 +20,8 @@ class ReactHandler(AgentHandler):
         summary = SummaryAgent(context)
         summary.system_prompt = summary.system_prompt.replace("{{query}}", request.query)
         await executor.run(request.query)
-        summary_result = summary.summary_task_result(executor.memory.messages, request.query)
+        context.cancel_token.raise_if_cancelled()
+        summary_result = await summary.summary_task_result(executor.memory.messages, request.query)
 
         # 组装结果
         task_result = {}
@@ -31,8 +32,9 @@ class ReactHandler(AgentHandler):
         else:
             task_result["fileList"] = summary_result.files
         data = build_stream_response(context.request_id, context.agent_type, None, "result", task_result, None, True)
+        data.ext = {"usage": context.usage_ledger.summary()}
 
-        await context.queue.put("[DONE]"+data)
+        await context.queue.put(data)
         return data
 
     def support(self, agent_type):
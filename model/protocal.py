@@ -15,6 +15,7 @@ class Message(BaseModel):
 
 class AgentRequest(BaseModel):
     request_id: str = Field(default="", alias="requestId", description="Request ID")
+    session_id: str = Field(default="", alias="sessionId", description="sessionId")
     erp: str = Field(default="", description="erp")
     query: str = Field(default="", description="query")
     agent_type: Optional[int] = Field(default=None,alias="agentType", description="agentType")
@@ -23,6 +24,7 @@ class AgentRequest(BaseModel):
     is_stream: bool = Field(default=False, alias="isStream", description="isStream")
     messages: Optional[List[Message]] = Field(default=None,description="messages")
     output_style: str = Field(default="html", alias="outputStyle", description="outputStyle")
+    deadline_seconds: Optional[int] = Field(default=None, alias="deadlineSeconds", description="deadlineSeconds")
 
     class Config:
         populate_by_name = True
@@ -54,6 +56,7 @@ class GptQueryReq(BaseModel):
     output_style: str = Field(None,alias="outputStyle", description="outputStyle")
     trace_id: str = Field(None,alias="traceId", description="traceId")
     user: str = Field(None,description="user")
+    deadline_seconds: Optional[int] = Field(None, alias="deadlineSeconds", description="deadlineSeconds")
 
     class Config:
         populate_by_name = True
@@ -82,7 +82,7 @@ def build_stream_response(
         digital_employee: str,
         is_final: bool
 ):
-    """组装流式输出返回值"""
+    """组装流式输出返回值，返回AgentResponse对象，仅在输出到SSE时序列化"""
     try:
         if message_id is None:
             message_id = str(uuid.uuid4())
@@ -132,11 +132,11 @@ def build_stream_response(
                 response.result = task_result["taskSummary"]
             response.result_map["agentType"] = agent_type
         elif message_type in ["browser", "code", "html", "markdown", "ppt", "file", "knowledge", "deep_search",
-                              "data_analysis"]:
+                              "data_analysis", "queue"]:
             response.result_map = message
             response.result_map["agentType"] = agent_type
 
-        return response.model_dump_json()
+        return response
 
     except Exception:
         logger.error("sse send error " + traceback.format_exc())
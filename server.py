@@ -1,4 +1,9 @@
+import asyncio
+import multiprocessing
 import os
+import signal
+import socket
+import time
 from pathlib import Path
 
 import uvicorn
@@ -22,9 +27,25 @@ def log_setting():
     logger.add(log_path, format=log_format, rotation="200 MB")
 
 
+def start_agent_runner():
+    from service.agent_runner import agent_runner
+    agent_runner.start()
+
+
+def load_tokenizer():
+    from agent.llm.token_counter import get_tokenizer
+    get_tokenizer()
+
+
+def stop_agent_runner():
+    from service.agent_runner import agent_runner
+    agent_runner.shutdown()
+
+
 def create_app():
     _app = FastAPI(
-        on_startup=[log_setting, print_logo]
+        on_startup=[log_setting, print_logo, load_tokenizer, start_agent_runner],
+        on_shutdown=[stop_agent_runner]
     )
     register_middleware(_app)
     register_router(_app)
@@ -48,13 +69,104 @@ def register_router(app: FastAPI):
     app.include_router(data_router)
 
 
-app = create_app()
+def bind_socket(host: str, port: int):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
 
-if __name__ == "__main__":
-    uvicorn.run(
+
+class GenieServer(uvicorn.Server):
+    """
+    收到退出信号后先排空运行中的agent任务，再按uvicorn原有流程退出
+    排空期间SSE连接保持，再次收到信号时立即退出
+    """
+
+    async def serve(self, sockets=None):
+        self._loop = asyncio.get_running_loop()
+        self._draining = False
+        await super().serve(sockets)
+
+    def handle_exit(self, sig, frame):
+        if self._draining or self.should_exit:
+            super().handle_exit(sig, frame)
+            return
+        self._draining = True
+        self._loop.call_soon_threadsafe(self._loop.create_task, self._drain(sig, frame))
+
+    async def _drain(self, sig, frame):
+        from service.drain import drain_controller
+        try:
+            await drain_controller.drain()
+        finally:
+            super().handle_exit(sig, frame)
+
+
+def create_server_config(**kwargs):
+    from config.genie_config import genie_config
+    return uvicorn.Config(
         app="server:app",
-        host="0.0.0.0",
-        port=8080,
-        workers=1
+        timeout_graceful_shutdown=genie_config.drain_grace_seconds + 30,
+        **kwargs
     )
 
+
+def run_worker(sockets: list):
+    GenieServer(create_server_config()).run(sockets=sockets)
+
+
+def run_supervisor(workers: int):
+    """
+    多进程模式：所有worker共享对外端口，每个worker额外监听一个内部端口，
+    会话归属其他worker时通过内部端口转发，worker异常退出后自动拉起
+    """
+    from config.genie_config import genie_config
+    if "local" == genie_config.run_registry_backend:
+        # 进程内注册表无法跨worker共享
+        os.environ["autobots.server.run_registry.backend"] = "file"
+    public_sock = bind_socket(genie_config.server_host, genie_config.server_port)
+    spawn = multiprocessing.get_context("spawn")
+    processes = dict()
+    stopping = False
+
+    def _start_worker(worker_id: int, internal_sock):
+        os.environ["autobots.server.worker_id"] = str(worker_id)
+        os.environ["autobots.server.worker_address"] = f"http://127.0.0.1:{internal_sock.getsockname()[1]}"
+        process = spawn.Process(target=run_worker, kwargs={"sockets": [public_sock, internal_sock]},
+                                name=f"genie-worker-{worker_id}")
+        process.start()
+        processes[worker_id] = (process, internal_sock)
+        logger.info(f"genie worker {worker_id} started, pid: {process.pid}")
+
+    def _terminate(sig, frame):
+        nonlocal stopping
+        stopping = True
+        for process, _ in processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    for worker_id in range(workers):
+        _start_worker(worker_id, bind_socket("127.0.0.1", genie_config.server_internal_port + worker_id))
+    signal.signal(signal.SIGINT, _terminate)
+    signal.signal(signal.SIGTERM, _terminate)
+
+    while not stopping:
+        for worker_id, (process, internal_sock) in list(processes.items()):
+            if not process.is_alive() and not stopping:
+                logger.error(f"genie worker {worker_id} exited with code {process.exitcode}, restarting")
+                _start_worker(worker_id, internal_sock)
+        time.sleep(1)
+    for process, _ in processes.values():
+        process.join()
+
+
+app = create_app()
+
+if __name__ == "__main__":
+    from config.genie_config import genie_config
+    if genie_config.server_workers > 1:
+        run_supervisor(genie_config.server_workers)
+    else:
+        GenieServer(create_server_config(host=genie_config.server_host, port=genie_config.server_port)).run()
+
@@ -0,0 +1,222 @@
+import asyncio
+import collections
+import contextvars
+import threading
+import time
+import traceback
+from typing import Optional
+
+from loguru import logger
+
+from config.genie_config import genie_config
+from service.fair_queue import FairQueue
+from util.metrics import metrics
+
+
+class RunnerBusyError(Exception):
+    """运行中及排队中的任务数均已达到上限"""
+    pass
+
+
+class RunHandle:
+    """一次agent运行的句柄"""
+
+    def __init__(self, run_id: str, coro_factory, context: contextvars.Context, tenant: str = "", cost: float = 1):
+        self.run_id = run_id
+        self.coro_factory = coro_factory
+        self.context = context
+        self.tenant = tenant
+        self.cost = cost
+        self.queue_position = 0
+        self.worker: Optional["_Worker"] = None
+        self.task: Optional[asyncio.Task] = None
+        self.submit_time = time.time()
+        self.start_time = None
+        self.finished = False
+        self.finish_time = None
+
+    @property
+    def loop(self):
+        return self.worker.loop if self.worker is not None else None
+
+    @property
+    def running(self):
+        return self.start_time is not None
+
+
+class _Worker:
+    """长驻事件循环，可以是独立线程，也可以是服务端自身的事件循环"""
+
+    def __init__(self, name: str, loop: asyncio.AbstractEventLoop = None):
+        self.name = name
+        self.active = 0
+        self.thread = None
+        if loop is not None:
+            self.loop = loop
+            return
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run_forever, name=name, daemon=True)
+        self.thread.start()
+
+    def _run_forever(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def stop(self):
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class AgentRunner:
+    """
+    agent运行器，使用固定数量的长驻事件循环执行agent任务，替代每个请求一个线程+一个事件循环的方式
+    workers为0时直接在服务端事件循环中执行
+    排队任务按租户加权公平调度，单个租户的运行数不超过tenant_max_concurrency
+    """
+
+    def __init__(self, workers: int, max_concurrency: int, max_pending: int, tenant_max_concurrency: int = 0,
+                 tenant_weights: dict = None):
+        self.workers_num = max(0, workers)
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_pending = max(0, max_pending)
+        self.tenant_max_concurrency = tenant_max_concurrency
+        self._workers = list()
+        self._active = set()
+        self._tenant_active = collections.Counter()
+        self._pending = FairQueue(tenant_weights)
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            if self.workers_num == 0:
+                self._workers.append(_Worker("agent-runner-main", asyncio.get_running_loop()))
+            else:
+                for i in range(self.workers_num):
+                    self._workers.append(_Worker(f"agent-runner-{i}"))
+            self._started = True
+        logger.info(f"agent runner started, workers: {self.workers_num}, max concurrency: {self.max_concurrency}, "
+                    f"max pending: {self.max_pending}")
+
+    def shutdown(self):
+        with self._lock:
+            for worker in self._workers:
+                worker.stop()
+            self._workers.clear()
+            self._started = False
+
+    def submit(self, run_id: str, coro_factory, tenant: str = "", cost: float = 1) -> RunHandle:
+        """
+        提交agent任务
+        :coro_factory: 无参函数，返回待执行的协程，在工作循环中调用
+        :tenant: 租户，公平调度及并发上限按租户计算
+        :cost: 任务成本，成本越高排队时让出越多
+        """
+        self.start()
+        handle = RunHandle(run_id, coro_factory, contextvars.copy_context(), tenant, cost)
+        with self._lock:
+            if len(self._active) < self.max_concurrency and self._tenant_runnable(tenant):
+                self._start(handle)
+            elif len(self._pending) < self.max_pending:
+                self._pending.push(handle, tenant, cost)
+                handle.queue_position = self._pending.position(handle)
+                metrics.inc("agent_run_queued", tenant=tenant)
+                logger.info(f"{run_id} agent runner queued, tenant: {tenant}, position: {handle.queue_position}, "
+                            f"pending: {len(self._pending)}")
+            else:
+                raise RunnerBusyError(f"agent runner is busy, active: {len(self._active)}, "
+                                      f"pending: {len(self._pending)}")
+        return handle
+
+    def cancel(self, handle: RunHandle):
+        """取消任务，排队中的任务直接移除，运行中的任务取消其协程"""
+        with self._lock:
+            if not handle.running:
+                if handle in self._pending:
+                    self._pending.remove(handle)
+                    handle.finished = True
+                    handle.finish_time = time.time()
+                    metrics.inc("agent_run_cancelled", stage="pending")
+                    logger.info(f"{handle.run_id} agent run cancelled before start")
+                return
+        handle.loop.call_soon_threadsafe(self._cancel_task, handle)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers_num,
+                "maxConcurrency": self.max_concurrency,
+                "maxPending": self.max_pending,
+                "tenantMaxConcurrency": self.tenant_max_concurrency,
+                "active": len(self._active),
+                "pending": len(self._pending),
+                "tenantActive": dict(self._tenant_active),
+                "tenantPending": self._pending.tenant_pending(),
+                "workerActive": {worker.name: worker.active for worker in self._workers},
+            }
+
+    def position(self, handle: RunHandle):
+        """排队位置，已运行返回0"""
+        with self._lock:
+            return self._pending.position(handle) if handle in self._pending else 0
+
+    def _tenant_runnable(self, tenant: str):
+        return self.tenant_max_concurrency <= 0 or self._tenant_active[tenant] < self.tenant_max_concurrency
+
+    def _start(self, handle: RunHandle):
+        """需持有锁调用，选择当前任务最少的工作循环执行"""
+        worker = min(self._workers, key=lambda w: w.active)
+        worker.active += 1
+        self._tenant_active[handle.tenant] += 1
+        handle.worker = worker
+        handle.start_time = time.time()
+        self._active.add(handle)
+        worker.loop.call_soon_threadsafe(self._create_task, handle)
+
+    def _create_task(self, handle: RunHandle):
+        handle.task = handle.context.run(handle.loop.create_task, self._run(handle))
+
+    def _cancel_task(self, handle: RunHandle):
+        if handle.task is not None:
+            handle.task.cancel()
+
+    async def _run(self, handle: RunHandle):
+        try:
+            await handle.coro_factory()
+        except asyncio.CancelledError:
+            metrics.inc("agent_run_cancelled", stage="running")
+            logger.info(f"{handle.run_id} agent run cancelled")
+        except Exception:
+            logger.error(f"{handle.run_id} agent run error")
+            logger.error(traceback.format_exc())
+        finally:
+            self._finish(handle)
+
+    def _finish(self, handle: RunHandle):
+        with self._lock:
+            handle.finished = True
+            handle.finish_time = time.time()
+            handle.worker.active -= 1
+            self._active.discard(handle)
+            self._tenant_active[handle.tenant] -= 1
+            if self._tenant_active[handle.tenant] <= 0:
+                del self._tenant_active[handle.tenant]
+            while len(self._pending) != 0 and len(self._active) < self.max_concurrency:
+                next_handle = self._pending.pop(self._tenant_runnable)
+                if next_handle is None:
+                    break
+                metrics.observe("agent_run_queue_wait_ms", int((time.time() - next_handle.submit_time) * 1000),
+                                tenant=next_handle.tenant)
+                self._start(next_handle)
+        logger.info(f"{handle.run_id} agent run finished, cost: {time.time() - handle.start_time}s")
+
+
+agent_runner = AgentRunner(
+    genie_config.agent_runner_workers,
+    genie_config.agent_runner_max_concurrency,
+    genie_config.agent_runner_max_pending,
+    genie_config.agent_runner_tenant_max_concurrency,
+    genie_config.agent_runner_tenant_weights_dict
+)
@@ -0,0 +1,38 @@
+import time
+
+from agent.agent.agent_context import CancelToken
+from agent.agent.auto_agent import AutoAgent
+from config.genie_config import genie_config
+from model.protocal import AgentRequest
+from model.response.agent_response import build_stream_response
+from service.agent_runner import agent_runner
+from service.run_registry import run_registry, RunState
+
+
+def handle_output_style(query: str, output_style: str):
+    query += genie_config.output_style_prompts_dict.get(output_style, "")
+    return query
+
+
+def start_auto_agent(request: AgentRequest, queue):
+    """
+    在agent运行器中启动AutoAgent，事件以AgentResponse对象写入queue
+    /AutoAgent接口与queryAgentStreamIncr进程内调用共用该入口，运行状态注册到run_registry
+    """
+    # 拼接输出类型
+    request.query = handle_output_style(request.query, request.output_style)
+    cancel_token = CancelToken()
+    # 截止时间从接收请求开始计算，包含排队时间
+    deadline_seconds = request.deadline_seconds or genie_config.agent_deadline_seconds
+    deadline = time.time() + deadline_seconds if deadline_seconds > 0 else None
+    auto_agent = AutoAgent(queue, cancel_token, deadline)
+    tenant = request.erp or "genie"
+    cost = genie_config.agent_runner_agent_type_cost_dict.get(str(request.agent_type), 1)
+    handle = agent_runner.submit(request.request_id, lambda: auto_agent.run(request), tenant, cost)
+    # 首个事件输出排队位置，0表示已开始运行
+    queue.put_nowait(build_stream_response(request.request_id, request.agent_type, None, "queue",
+                                           {"queuePosition": handle.queue_position, "tenant": tenant}, None, False))
+    state = RunState(request.request_id, request.session_id, handle=handle, queue=queue, agent=auto_agent,
+                     cancel_token=cancel_token)
+    run_registry.register(state)
+    return state
@@ -0,0 +1,46 @@
+import asyncio
+import time
+
+from loguru import logger
+
+from config.genie_config import genie_config
+from service.run_registry import run_registry
+from util.metrics import metrics
+
+
+class DrainController:
+    """
+    服务排空：停止接收新的agent请求，等待运行中的任务在宽限时间内结束，
+    超时后为剩余任务输出终止结果并取消，保证客户端收到结束事件后再退出
+    """
+
+    def __init__(self, grace_seconds: int, flush_seconds: int = 5):
+        self.grace_seconds = grace_seconds
+        self.flush_seconds = flush_seconds
+        self.draining = False
+        self.drain_time = None
+
+    async def drain(self):
+        if self.draining:
+            return
+        self.draining = True
+        self.drain_time = time.time()
+        running = run_registry.running_states()
+        logger.info(f"server draining, running: {len(running)}, grace: {self.grace_seconds}s")
+        while len(running) != 0 and time.time() - self.drain_time < self.grace_seconds:
+            await asyncio.sleep(1)
+            running = run_registry.running_states()
+
+        if len(running) != 0:
+            logger.warning(f"drain grace exceeded, terminate {len(running)} runs")
+            metrics.inc("drain_terminated_runs", len(running))
+            for state in running:
+                state.terminate("服务重启，任务终止。")
+        # 等待终止结果输出到客户端
+        flush_start = time.time()
+        while run_registry.has_open_streams() and time.time() - flush_start < self.flush_seconds:
+            await asyncio.sleep(0.1)
+        logger.info(f"server drained, cost: {time.time() - self.drain_time}s")
+
+
+drain_controller = DrainController(genie_config.drain_grace_seconds)
@@ -0,0 +1,159 @@
+import asyncio
+import collections
+import threading
+
+from config.genie_config import genie_config
+from model.response.agent_response import AgentResponse
+from util.metrics import metrics
+
+# 增量事件中需要拼接的文本字段
+_TEXT_FIELDS = {
+    "tool_thought": "tool_thought",
+    "plan_thought": "plan_thought",
+    "agent_stream": "result",
+}
+# 增量事件中result_map内需要拼接的字段，报告类为data，深度搜索为answer
+_RESULT_MAP_FIELDS = {
+    "html": "data",
+    "markdown": "data",
+    "ppt": "data",
+    "deep_search": "answer",
+}
+
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def _call_in_loop(loop: asyncio.AbstractEventLoop, callback, *args):
+    if _running_loop() is loop:
+        callback(*args)
+        return
+    try:
+        loop.call_soon_threadsafe(callback, *args)
+    except RuntimeError:
+        # 事件循环已关闭
+        pass
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+def merge_agent_response(tail, item):
+    """
+    合并同一message的非最终增量事件，无法合并时返回None
+    最终事件（is_final、result）不参与合并
+    """
+    if not isinstance(tail, AgentResponse) or not isinstance(item, AgentResponse):
+        return None
+    if tail.is_final or item.is_final or tail.finish or item.finish:
+        return None
+    if tail.message_id != item.message_id or tail.message_type != item.message_type:
+        return None
+    field = _TEXT_FIELDS.get(item.message_type, None)
+    if field is not None:
+        setattr(tail, field, (getattr(tail, field) or "") + (getattr(item, field) or ""))
+        tail.message_time = item.message_time
+        return tail
+    key = _RESULT_MAP_FIELDS.get(item.message_type, None)
+    if key is not None and tail.result_map is not None and item.result_map is not None:
+        if not isinstance(tail.result_map.get(key, ""), str) or not isinstance(item.result_map.get(key, ""), str):
+            return None
+        merged_map = dict(item.result_map)
+        merged_map[key] = (tail.result_map.get(key) or "") + (item.result_map.get(key) or "")
+        tail.result_map = merged_map
+        tail.message_time = item.message_time
+        return tail
+    return None
+
+
+class EventChannel:
+    """
+    agent事件通道，消费端（SSE）所在事件循环持有队列，生产端可以在任意线程/事件循环中写入，
+    跨循环写入时通过call_soon_threadsafe唤醒消费端，避免跨loop直接操作asyncio.Queue导致事件延迟
+
+    通道有界：消费端跟不上时，同一message的非最终增量事件合并到队尾事件中；
+    无法合并时生产端等待，最终事件不会被丢弃
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None, maxsize: int = None, merge=merge_agent_response):
+        self._loop = loop or asyncio.get_running_loop()
+        self._maxsize = genie_config.event_channel_max_size if maxsize is None else maxsize
+        self._merge = merge
+        self._items = collections.deque()
+        self._getter = None
+        self._putters = collections.deque()
+        self._lock = threading.Lock()
+
+    def _try_put(self, item):
+        """需持有锁调用，返回是否写入成功"""
+        if len(self._items) != 0 and self._merge is not None:
+            merged = self._merge(self._items[-1], item)
+            if merged is not None:
+                self._items[-1] = merged
+                metrics.inc("event_channel_coalesced")
+                return True
+        if self._maxsize <= 0 or len(self._items) < self._maxsize:
+            self._append(item)
+            return True
+        return False
+
+    def _append(self, item):
+        self._items.append(item)
+        if self._getter is not None:
+            getter, self._getter = self._getter, None
+            _call_in_loop(self._loop, _resolve, getter)
+
+    def _wakeup_putter(self):
+        while len(self._putters) != 0:
+            loop, putter = self._putters.popleft()
+            if not putter.done():
+                _call_in_loop(loop, _resolve, putter)
+                return
+
+    async def put(self, item):
+        while True:
+            with self._lock:
+                if self._try_put(item):
+                    return
+                putter = asyncio.get_running_loop().create_future()
+                self._putters.append((asyncio.get_running_loop(), putter))
+            metrics.inc("event_channel_blocked")
+            try:
+                await putter
+            except asyncio.CancelledError:
+                with self._lock:
+                    # 已被唤醒但被取消，将唤醒传递给下一个生产者
+                    if putter.done() and not putter.cancelled():
+                        self._wakeup_putter()
+                raise
+
+    def put_nowait(self, item):
+        """非协程写入无法等待，通道已满且无法合并时超出上限写入"""
+        with self._lock:
+            if not self._try_put(item):
+                metrics.inc("event_channel_overflow")
+                self._append(item)
+
+    async def get(self):
+        while True:
+            with self._lock:
+                if len(self._items) != 0:
+                    item = self._items.popleft()
+                    self._wakeup_putter()
+                    return item
+                getter = self._loop.create_future()
+                self._getter = getter
+            await getter
+
+    def qsize(self):
+        with self._lock:
+            return len(self._items)
+
+    def empty(self):
+        return self.qsize() == 0
@@ -0,0 +1,72 @@
+import collections
+import heapq
+import itertools
+
+
+class FairQueue:
+    """
+    按租户加权公平排队（WFQ），每个任务的虚拟完成时间为 max(虚拟时间, 租户上一个任务的虚拟完成时间) + 成本 / 权重，
+    出队时选择虚拟完成时间最小且租户未达到并发上限的任务，大批量提交的租户不会饿死其他租户
+    非线程安全，由调用方加锁
+    """
+
+    def __init__(self, weights: dict = None, default_weight: float = 1):
+        self.weights = weights or dict()
+        self.default_weight = default_weight
+        self.virtual_time = 0
+        self._last_finish = dict()
+        self._tenant_queues = collections.defaultdict(list)
+        self._tags = dict()
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._tags)
+
+    def __contains__(self, item):
+        return item in self._tags
+
+    def weight(self, tenant: str):
+        return max(float(self.weights.get(tenant, self.default_weight)), 0.01)
+
+    def push(self, item, tenant: str, cost: float = 1):
+        finish = max(self.virtual_time, self._last_finish.get(tenant, 0)) + cost / self.weight(tenant)
+        self._last_finish[tenant] = finish
+        tag = (finish, next(self._seq))
+        self._tags[item] = (tag, tenant)
+        heapq.heappush(self._tenant_queues[tenant], (tag, item))
+
+    def pop(self, runnable=None):
+        """
+        取出下一个任务
+        :runnable: 判断租户当前是否可以运行的函数，为空时不限制
+        """
+        best = None
+        for tenant, tenant_queue in self._tenant_queues.items():
+            if len(tenant_queue) == 0 or (runnable is not None and not runnable(tenant)):
+                continue
+            if best is None or tenant_queue[0][0] < self._tenant_queues[best][0][0]:
+                best = tenant
+        if best is None:
+            return None
+        tag, item = heapq.heappop(self._tenant_queues[best])
+        del self._tags[item]
+        if len(self._tenant_queues[best]) == 0:
+            del self._tenant_queues[best]
+        self.virtual_time = max(self.virtual_time, tag[0])
+        return item
+
+    def remove(self, item):
+        tag, tenant = self._tags.pop(item)
+        tenant_queue = self._tenant_queues[tenant]
+        tenant_queue.remove((tag, item))
+        heapq.heapify(tenant_queue)
+        if len(tenant_queue) == 0:
+            del self._tenant_queues[tenant]
+
+    def position(self, item):
+        """排队位置，从1开始，按虚拟完成时间估算，不考虑租户并发上限"""
+        tag = self._tags[item][0]
+        return 1 + sum(1 for other_tag, _ in self._tags.values() if other_tag < tag)
+
+    def tenant_pending(self):
+        return {tenant: len(tenant_queue) for tenant, tenant_queue in self._tenant_queues.items()}
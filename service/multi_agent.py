@@ -1,11 +1,9 @@
 import asyncio
-import json
 import time
 import traceback
 import httpx
-import requests
 from loguru import logger
-from sse_starlette import ServerSentEvent, EventSourceResponse
+from sse_starlette import EventSourceResponse
 from agent.entity.enums import AutoBotsResultStatus, AgentType, ResponseTypeEnum
 from handler.plan_solve_agent_response_handler import PlanSolveAgentResponseHandler
 from handler.react_agent_response_handler import ReactAgentResponseHandler
@@ -14,6 +12,11 @@ from model.response.agent_response import EventResult, AgentResponse
 from model.response.gpt_process_result import GptProcessResult
 from util.chat_util import ChatUtils
 from config.genie_config import genie_config
+from service.agent_runner import RunnerBusyError
+from service.agent_service import start_auto_agent
+from service.event_channel import EventChannel
+from service.run_registry import run_registry
+from service.run_stream import RunStream
 
 handler_map = {
     AgentType.PLAN_SOLVE: PlanSolveAgentResponseHandler(),
@@ -26,13 +29,16 @@ client = httpx.AsyncClient()
 def build_agent_request(request: GptQueryReq):
     agent_req = AgentRequest()
     agent_req.request_id = request.request_id
+    agent_req.session_id = request.session_id
     agent_req.erp = request.user
     agent_req.query = request.query
     agent_req.agent_type = 5 if request.deep_think == 0 else 3
     agent_req.sop_prompt = genie_config.genie_sop_prompt if agent_req.agent_type == 3 else ""
     agent_req.base_prompt = genie_config.genie_base_prompt if agent_req.agent_type == 5 else ""
     agent_req.is_stream = True
-    agent_req.output_style = request.output_style
+    # 未指定时为空字符串，不追加输出类型提示，HTTP调用时AgentRequest不接受None
+    agent_req.output_style = request.output_style or ""
+    agent_req.deadline_seconds = request.deadline_seconds
 
     return agent_req
 
@@ -52,22 +58,137 @@ def build_heartbeat_data(req_id):
     return result.model_dump_json(by_alias=True)
 
 
+def build_error_data(req_id, error_msg):
+    result = GptProcessResult()
+    result.finished = True
+    result.status = "error"
+    result.response_type = ResponseTypeEnum.TEXT.value
+    result.response = error_msg
+    result.response_all = error_msg
+    result.req_id = req_id
+    result.error_msg = error_msg
+    return result.model_dump_json(by_alias=True)
+
+
+def build_queue_data(req_id, data: AgentResponse):
+    result = GptProcessResult()
+    result.finished = False
+    result.status = "success"
+    result.response_type = ResponseTypeEnum.TEXT.value
+    result.response = ""
+    result.response_all = ""
+    result.req_id = req_id
+    result.package_type = "queue"
+    result.result_map = data.result_map
+    return result
+
+
+def handle_agent_response(auto_req: AgentRequest, data: AgentResponse, agent_resp_list: list,
+                          event_result: EventResult):
+    """将agent事件转换为增量输出结果"""
+    if "queue" == data.message_type:
+        return build_queue_data(auto_req.request_id, data)
+    agent_type = AgentType(auto_req.agent_type)
+    handler = handler_map[agent_type]
+    return handler.handle(auto_req, data, agent_resp_list, event_result)
+
+
+async def put_incr_result(auto_req: AgentRequest, result: GptProcessResult, queue, start_time):
+    """输出增量结果，返回任务是否结束"""
+    if result.finished:
+        logger.info(f"{auto_req.request_id} task total cost time:{time.time() - start_time}ms")
+        await queue.put("[DONE]" + result.model_dump_json(by_alias=True))
+        logger.info("lyz:" + result.model_dump_json(by_alias=True))
+        return True
+    await queue.put(result.model_dump_json(by_alias=True))
+    logger.info(result.model_dump_json(by_alias=True))
+    return False
+
+
 async def handle_multi_agent_request(auto_req: AgentRequest, queue):
-    url = "http://127.0.0.1:8080/AutoAgent"
+    if "http" == genie_config.multi_agent_dispatch_mode:
+        await handle_multi_agent_http_request(auto_req, queue)
+    else:
+        await handle_multi_agent_local_request(auto_req, queue)
+
+
+async def handle_multi_agent_local_request(auto_req: AgentRequest, queue):
+    """进程内调用AutoAgent，直接消费AgentResponse对象，不经过HTTP及JSON序列化"""
+    start_time = time.time()
+    channel = EventChannel()
+    try:
+        run_state = start_auto_agent(auto_req, channel)
+    except RunnerBusyError as e:
+        logger.error(f"{auto_req.request_id} {str(e)}")
+        await queue.put("[DONE]" + build_error_data(auto_req.request_id, "系统繁忙，请稍后重试"))
+        return
+    try:
+        agent_resp_list = list()
+        event_result = EventResult()
+        run_state.event_result = event_result
+        while True:
+            try:
+                data = await asyncio.wait_for(channel.get(), timeout=genie_config.heartbeat_interval)
+            except asyncio.TimeoutError:
+                if run_state.finished and channel.empty():
+                    logger.error(f"{auto_req.request_id} agent run finished without result")
+                    await queue.put("[DONE]" + build_error_data(auto_req.request_id, "任务执行异常，任务终止。"))
+                    break
+                await queue.put(build_heartbeat_data(auto_req.request_id))
+                continue
+            if data is None:
+                continue
+            result = handle_agent_response(auto_req, data, agent_resp_list, event_result)
+            if result is None:
+                continue
+            if await put_incr_result(auto_req, result, queue, start_time):
+                break
+    except asyncio.CancelledError:
+        run_state.cancel("client disconnected")
+        raise
+    except Exception:
+        logger.error(traceback.format_exc())
+
+
+async def iter_sse_data(lines):
+    """
+    解析SSE事件流，按事件输出data字段，多行data以换行拼接
+    id、retry、event字段及:开头的注释行忽略
+    """
+    data_lines = list()
+    async for line in lines:
+        if len(line) == 0:
+            if len(data_lines) != 0:
+                yield "\n".join(data_lines)
+                data_lines = list()
+            continue
+        field, _, value = line.partition(":")
+        if field == "data":
+            data_lines.append(value[1:] if value.startswith(" ") else value)
+    if len(data_lines) != 0:
+        yield "\n".join(data_lines)
+
+
+async def handle_multi_agent_http_request(auto_req: AgentRequest, queue):
+    """通过HTTP调用AutoAgent接口，用于agent独立部署的场景"""
+    url = genie_config.auto_agent_url
+    if len(url) == 0:
+        # 未配置时调用本worker，保证多worker部署下run的状态仍在当前worker
+        address = genie_config.worker_address or f"http://127.0.0.1:{genie_config.server_port}"
+        url = address + "/AutoAgent"
     start_time = time.time()
     try:
+        timeout = httpx.Timeout(genie_config.sse_client_read_timeout, connect=genie_config.sse_client_connect_timeout)
         async with client.stream("POST", url=url, json=auto_req.model_dump(),
-                                 timeout=60) as response:
+                                 timeout=timeout) as response:
 
             if not response.is_success:
                 logger.error(f"{auto_req.request_id}, response body is failed: {response}")
+                await queue.put("[DONE]" + build_error_data(auto_req.request_id, "任务执行异常，任务终止。"))
                 return
             agent_resp_list = list()
             event_result = EventResult()
-            async for line in response.aiter_lines():
-                if len(line) == 0:
-                    continue
-                line = line.replace("data: ", "")
+            async for line in iter_sse_data(response.aiter_lines()):
                 if line.startswith("heartbeat"):
                     result = build_heartbeat_data(auto_req.request_id)
                     await queue.put(result)
@@ -75,18 +196,17 @@ async def handle_multi_agent_request(auto_req: AgentRequest, queue):
                     continue
                 data = AgentResponse.model_validate_json(line)
                 # logger.info(f"{auto_req.request_id} recv from auto controller: {data}")
-                agent_type = AgentType(auto_req.agent_type)
-                handler = handler_map[agent_type]
-                result = handler.handle(auto_req, data, agent_resp_list, event_result)
-                if result.finished:
-                    logger.info(f"{auto_req.request_id} task total cost time:{time.time() - start_time}ms")
-                    await queue.put("[DONE]" + result.model_dump_json(by_alias=True))
-                    logger.info("lyz:" + result.model_dump_json(by_alias=True))
-                    break
-                await queue.put(result.model_dump_json(by_alias=True))
-                logger.info(result.model_dump_json(by_alias=True))
+                result = handle_agent_response(auto_req, data, agent_resp_list, event_result)
+                if result is None:
+                    continue
+                if await put_incr_result(auto_req, result, queue, start_time):
+                    return
+            logger.error(f"{auto_req.request_id} agent stream closed without result")
+    except asyncio.CancelledError:
+        raise
     except Exception:
         logger.error(traceback.format_exc())
+    await queue.put("[DONE]" + build_error_data(auto_req.request_id, "任务执行异常，任务终止。"))
 
 
 async def search_for_agent_request(request: GptQueryReq, queue):
@@ -104,26 +224,31 @@ async def search_for_agent_request(request: GptQueryReq, queue):
 
 
 async def query_multi_agent_incr_stream(request: GptQueryReq):
-    queue = asyncio.Queue()
+    # 输出为序列化后的增量结果，不做合并，通道写满时上游等待，增量事件在agent事件通道中合并
+    queue = EventChannel(merge=None)
 
-    request.user = "genie"
+    # 保留调用方标识，按租户公平调度
+    request.user = request.user or "genie"
     request.deep_think = 0 if request.deep_think is None else request.deep_think
     trace_id = ChatUtils.get_request_id(request.user, request.session_id, request.request_id)
     request.trace_id = trace_id
 
-    async def _stream(queue):
-        while True:
-            data = await queue.get()
-            if isinstance(data, str):
-                if "[DONE]" in data:
-                    data = data.replace("[DONE]", "")
-                    yield ServerSentEvent(data=data)
-                    break
-            yield ServerSentEvent(data=data)
+    def _transform(data):
+        if isinstance(data, str) and "[DONE]" in data:
+            return data.replace("[DONE]", ""), True
+        return data, False
+
+    def _on_abandon():
+        # 客户端断开且未续传时取消请求任务，进程内调用取消agent运行，HTTP调用关闭到AutoAgent的连接
+        if not task.done():
+            logger.info(f"{request.request_id} client disconnected, cancel agent request")
+            task.cancel()
 
-    asyncio.create_task(search_for_agent_request(request, queue))
+    task = asyncio.create_task(search_for_agent_request(request, queue))
+    stream = RunStream(request.request_id, queue, _transform, is_done=task.done, on_abandon=_on_abandon)
+    run_registry.register_stream("incr:" + request.request_id, stream)
 
     return EventSourceResponse(
-        _stream(queue)
+        stream.subscribe()
     )
 
@@ -0,0 +1,268 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import httpx
+from fastapi import Request
+from loguru import logger
+from starlette.background import BackgroundTask
+from starlette.responses import StreamingResponse
+
+from config.genie_config import genie_config
+from model.response.agent_response import build_stream_response
+from service.agent_runner import agent_runner
+
+FORWARDED_HEADER = "X-Genie-Forwarded"
+
+
+class RunState:
+    """当前worker持有的运行状态，AgentContext、事件队列、EventResult等均通过该对象访问"""
+
+    def __init__(self, run_id: str, session_id: str = None, handle=None, queue=None, agent=None, cancel_token=None):
+        self.run_id = run_id
+        self.session_id = session_id
+        self.handle = handle
+        self.queue = queue
+        self.agent = agent
+        self.cancel_token = cancel_token
+        self.stream = None
+        self.event_result = None
+        self.create_time = time.time()
+
+    @property
+    def context(self):
+        return self.agent.context if self.agent is not None else None
+
+    @property
+    def finished(self):
+        return self.handle is not None and self.handle.finished
+
+    def cancel(self, reason: str):
+        """取消运行，设置取消标记关闭进行中的LLM/工具流，并取消运行器中的任务"""
+        if self.finished or (self.cancel_token is not None and self.cancel_token.cancelled):
+            return
+        logger.info(f"{self.run_id} cancel agent run: {reason}")
+        if self.cancel_token is not None:
+            self.cancel_token.cancel()
+        if self.handle is not None:
+            agent_runner.cancel(self.handle)
+
+    def terminate(self, message: str):
+        """取消运行并输出最终结果，用于服务排空超时等场景"""
+        if self.finished:
+            return
+        self.cancel("terminated: " + message)
+        agent_type = self.context.agent_type if self.context is not None else None
+        data = build_stream_response(self.run_id, agent_type, None, "result", message, None, True)
+        if self.context is not None:
+            data.ext = {"usage": self.context.usage_ledger.summary()}
+        self.queue.put_nowait(data)
+
+    def to_dict(self):
+        return {
+            "runId": self.run_id,
+            "sessionId": self.session_id,
+            "workerId": genie_config.worker_id,
+            "running": self.handle is not None and self.handle.running and not self.handle.finished,
+            "finished": self.finished,
+            "createTime": int(self.create_time * 1000),
+            "usage": self.context.usage_ledger.summary() if self.context is not None else None,
+        }
+
+
+class LocalRegistryBackend:
+    """进程内注册表，单worker部署使用"""
+
+    def __init__(self):
+        self._entries = dict()
+        self._lock = threading.Lock()
+
+    def put(self, key: str, value: dict, ttl: int):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            item = self._entries.get(key, None)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                del self._entries[key]
+                return None
+            return item[1]
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class FileRegistryBackend:
+    """
+    基于共享目录的注册表，同一台机器上的多个worker进程共享
+    转发请求时信任目录中记录的worker地址，目录需为服务用户所有且权限为0700
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        if os.stat(path).st_uid != os.getuid():
+            raise PermissionError(f"run registry path {path} is not owned by the service user")
+        # 目录已存在时makedirs不修改权限
+        os.chmod(path, 0o700)
+
+    def _file(self, key: str):
+        return os.path.join(self.path, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def put(self, key: str, value: dict, ttl: int):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"expireTime": time.time() + ttl, "value": value}, f, ensure_ascii=False)
+        os.replace(tmp_path, self._file(key))
+
+    def get(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._file(key), "r", encoding="utf-8") as f:
+                item = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if item["expireTime"] < time.time():
+            self.delete(key)
+            return None
+        return item["value"]
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+
+
+class RunRegistry:
+    """
+    运行注册表，记录run及session归属的worker
+    本worker的运行状态保存在进程内，其他worker只能拿到归属信息，需要将请求转发到归属worker处理
+    """
+
+    def __init__(self, backend, ttl: int, retention: int):
+        self.backend = backend
+        self.ttl = ttl
+        self.retention = retention
+        self._states = dict()
+        self._streams = dict()
+        self._lock = threading.Lock()
+
+    def _owner_entry(self, run_id: str, session_id: str):
+        return {
+            "runId": run_id,
+            "sessionId": session_id,
+            "workerId": genie_config.worker_id,
+            "address": genie_config.worker_address,
+        }
+
+    def register(self, state: RunState):
+        self._sweep()
+        with self._lock:
+            self._states[state.run_id] = state
+        entry = self._owner_entry(state.run_id, state.session_id)
+        self.backend.put("run:" + state.run_id, entry, self.ttl)
+        if state.session_id:
+            self.backend.put("session:" + state.session_id, entry, self.ttl)
+
+    def get_local(self, run_id: str) -> Optional[RunState]:
+        with self._lock:
+            return self._states.get(run_id, None)
+
+    def register_stream(self, key: str, stream):
+        """登记可续传的输出流，key为<接口>:<run_id>"""
+        with self._lock:
+            self._streams[key] = stream
+
+    def get_stream(self, key: str):
+        with self._lock:
+            return self._streams.get(key, None)
+
+    def running_states(self):
+        with self._lock:
+            return [state for state in self._states.values() if not state.finished]
+
+    def has_open_streams(self):
+        with self._lock:
+            return any(not stream.closed for stream in self._streams.values())
+
+    def lookup(self, run_id: str) -> Optional[dict]:
+        return self.backend.get("run:" + run_id)
+
+    def remote_owner(self, key: str) -> Optional[dict]:
+        """key为run:<id>或session:<id>，归属其他worker时返回归属信息"""
+        entry = self.backend.get(key)
+        if entry is None or entry.get("workerId") == genie_config.worker_id:
+            return None
+        if not entry.get("address"):
+            return None
+        return entry
+
+    def _sweep(self):
+        """清理已结束且超过保留时间的运行状态"""
+        now = time.time()
+        with self._lock:
+            expired = [run_id for run_id, state in self._states.items()
+                       if state.finished and now - state.handle.finish_time > self.retention]
+            expired_streams = [key for key, stream in self._streams.items()
+                               if stream.closed and now - stream.close_time > self.retention]
+            for key in expired_streams:
+                del self._streams[key]
+            for run_id in expired:
+                state = self._states.pop(run_id)
+                self.backend.delete("run:" + run_id)
+                if state.session_id:
+                    entry = self.backend.get("session:" + state.session_id)
+                    if entry is not None and entry.get("runId") == run_id:
+                        self.backend.delete("session:" + state.session_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workerId": genie_config.worker_id,
+                "runs": len(self._states),
+                "streams": len(self._streams),
+                "running": len([state for state in self._states.values() if not state.finished]),
+            }
+
+
+def is_forwarded(request: Request):
+    return request.headers.get(FORWARDED_HEADER) is not None
+
+
+async def forward(request: Request, entry: dict):
+    """将请求转发到归属worker，流式返回其响应"""
+    url = entry["address"] + request.url.path
+    if request.url.query:
+        url += "?" + request.url.query
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in ("host", "content-length")}
+    headers[FORWARDED_HEADER] = str(genie_config.worker_id)
+    logger.info(f"{entry['runId']} forward {request.url.path} to worker {entry['workerId']} {entry['address']}")
+    forward_req = forward_client.build_request(request.method, url, headers=headers, content=await request.body())
+    response = await forward_client.send(forward_req, stream=True)
+    return StreamingResponse(
+        response.aiter_raw(),
+        status_code=response.status_code,
+        headers={k: v for k, v in response.headers.items() if k.lower() not in ("content-length", "transfer-encoding")},
+        background=BackgroundTask(response.aclose)
+    )
+
+
+def _create_backend():
+    if "file" == genie_config.run_registry_backend:
+        # 相对路径相对服务目录
+        return FileRegistryBackend(str(Path(__file__).resolve().parents[1] / genie_config.run_registry_path))
+    return LocalRegistryBackend()
+
+
+forward_client = httpx.AsyncClient(timeout=httpx.Timeout(genie_config.sse_client_read_timeout,
+                                                         connect=genie_config.sse_client_connect_timeout))
+run_registry = RunRegistry(_create_backend(), genie_config.run_registry_ttl, genie_config.run_retention_seconds)
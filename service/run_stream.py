@@ -0,0 +1,163 @@
+import asyncio
+import collections
+import itertools
+import time
+import traceback
+from typing import Optional
+
+from loguru import logger
+from sse_starlette import ServerSentEvent
+
+from config.genie_config import genie_config
+from util.metrics import metrics
+
+
+class RunStream:
+    """
+    一次运行的SSE输出流，每个事件分配递增id并保存在有限的回放缓冲区中
+    搬运任务从事件通道读取事件写入缓冲区，客户端按游标读取缓冲区，断线后携带Last-Event-ID重连可以补齐缺失的事件
+    搬运任务最多领先客户端已读位置window个事件，客户端断开时停止搬运，由事件通道对agent形成背压
+    客户端全部断开超过宽限时间仍未重连时，调用on_abandon取消运行
+    """
+
+    def __init__(self, run_id: str, source, transform, is_done=None, on_abandon=None,
+                 buffer_size: int = None, grace_seconds: float = None):
+        """
+        :source: 事件通道
+        :transform: 事件转换函数，返回(data, 是否结束)，返回None时跳过该事件
+        :is_done: 运行是否已结束，通道为空且运行结束时关闭输出流
+        :on_abandon: 客户端断开超过宽限时间时调用
+        """
+        self.run_id = run_id
+        self.source = source
+        self.transform = transform
+        self.is_done = is_done
+        self.on_abandon = on_abandon
+        self.buffer_size = max(1, genie_config.run_stream_buffer_size if buffer_size is None else buffer_size)
+        self.window = max(1, self.buffer_size // 2)
+        self.grace_seconds = genie_config.run_stream_resume_grace_seconds if grace_seconds is None else grace_seconds
+        self.closed = False
+        self.close_time = None
+        self._events = collections.deque(maxlen=self.buffer_size)
+        self._last_id = 0
+        self._ack_id = 0
+        self._readers = 0
+        self._published = asyncio.Event()
+        self._acked = asyncio.Event()
+        self._abandon_timer = None
+        self._pump_task = asyncio.create_task(self._pump())
+
+    @property
+    def last_event_id(self):
+        return self._last_id
+
+    async def _pump(self):
+        try:
+            while True:
+                while self._last_id - self._ack_id >= self.window:
+                    self._acked.clear()
+                    await self._acked.wait()
+                try:
+                    item = await asyncio.wait_for(self.source.get(), timeout=genie_config.heartbeat_interval)
+                except asyncio.TimeoutError:
+                    if self.is_done is not None and self.is_done() and self.source.empty():
+                        logger.warning(f"{self.run_id} run finished without final event, close stream")
+                        break
+                    continue
+                if item is None:
+                    continue
+                res = self.transform(item)
+                if res is None:
+                    continue
+                data, final = res
+                self._publish(data)
+                if final:
+                    break
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.error(f"{self.run_id} run stream pump error")
+            logger.error(traceback.format_exc())
+        finally:
+            self.closed = True
+            self.close_time = time.time()
+            self._notify()
+
+    def _publish(self, data):
+        self._last_id += 1
+        self._events.append((self._last_id, data))
+        self._notify()
+
+    def _notify(self):
+        self._published.set()
+        self._published = asyncio.Event()
+
+    def _events_after(self, cursor: int):
+        if len(self._events) == 0:
+            return []
+        first_id = self._events[0][0]
+        if cursor + 1 < first_id:
+            metrics.inc("run_stream_replay_gap")
+            logger.warning(f"{self.run_id} replay from {cursor} lost {first_id - cursor - 1} events")
+        start = max(0, cursor + 1 - first_id)
+        return list(itertools.islice(self._events, start, None))
+
+    def _ack(self, event_id: int):
+        if event_id > self._ack_id:
+            self._ack_id = event_id
+            self._acked.set()
+
+    async def subscribe(self, last_event_id: int = 0):
+        """从last_event_id之后开始输出事件，先回放缓冲区，再跟随实时事件"""
+        self._attach(last_event_id)
+        cursor = last_event_id
+        # 首个事件设置重连间隔，浏览器默认约3秒后才重连，需在宽限时间内重连
+        retry = int(self.grace_seconds * 500) if self.grace_seconds > 0 else None
+        try:
+            while True:
+                published = self._published
+                for event_id, data in self._events_after(cursor):
+                    yield ServerSentEvent(data=data, id=str(event_id), retry=retry)
+                    retry = None
+                    cursor = event_id
+                    self._ack(cursor)
+                if self.closed and cursor >= self._last_id:
+                    return
+                await published.wait()
+        finally:
+            self._detach(cursor)
+
+    def _attach(self, last_event_id: int):
+        self._readers += 1
+        if self._abandon_timer is not None:
+            self._abandon_timer.cancel()
+            self._abandon_timer = None
+        if last_event_id > 0:
+            metrics.inc("run_stream_resumed")
+            logger.info(f"{self.run_id} stream resumed from event {last_event_id}, last event {self._last_id}")
+
+    def _detach(self, cursor: int):
+        self._readers -= 1
+        if self._readers != 0 or self.closed:
+            return
+        logger.info(f"{self.run_id} stream detached at event {cursor}, wait {self.grace_seconds}s for resume")
+        if self.grace_seconds <= 0:
+            self._abandon()
+        else:
+            self._abandon_timer = asyncio.get_running_loop().call_later(self.grace_seconds, self._abandon)
+
+    def _abandon(self):
+        self._abandon_timer = None
+        if self._readers != 0 or self.closed:
+            return
+        metrics.inc("run_stream_abandoned")
+        self._pump_task.cancel()
+        if self.on_abandon is not None:
+            self.on_abandon()
+
+
+def parse_last_event_id(value: Optional[str]):
+    try:
+        return max(0, int(value)) if value else 0
+    except ValueError:
+        return 0
@@ -1,5 +1,5 @@
 from config.genie_config import GenieConfig
-import requests
+from util import http_client
 from http import HTTPStatus
 from loguru import logger
 
@@ -8,11 +8,12 @@ class SopRecall:
     def __init__(self, genie_config: GenieConfig):
         self.genie_config = genie_config
 
-    def sop_recall(self, request_id, query):
+    async def sop_recall(self, request_id, query, timeout=3000):
         sop_recall_url = self.genie_config.auto_bots_knowledge_url + "/v1/tool/sopRecall"
         #sop参数
         sop_req = {"requestId": request_id, "query": query}
-        sop_res = requests.post(sop_recall_url, json=sop_req, timeout=3000)
+        sop_res = await http_client.async_client().post(sop_recall_url, json=sop_req,
+                                                        timeout=http_client.timeout(timeout))
         if sop_res.status_code != HTTPStatus.OK:
             logger.error(f"{request_id} SOP召回服务返回空响应")
             return None
@@ -0,0 +1,29 @@
+import asyncio
+import threading
+import weakref
+
+import httpx
+
+_clients = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def async_client():
+    """
+    工具调用外部服务使用的httpx异步客户端，多个运行共享工作事件循环，请求不能阻塞事件循环
+    连接绑定在事件循环上，按事件循环分别缓存，事件循环回收后随之释放
+    """
+    loop = asyncio.get_running_loop()
+    with _lock:
+        client = _clients.get(loop, None)
+        if client is None:
+            client = httpx.AsyncClient(limits=httpx.Limits(max_connections=None, max_keepalive_connections=50))
+            _clients[loop] = client
+        return client
+
+
+def timeout(value):
+    """AgentContext.timeout_for的结果转为httpx超时，value为秒数或(连接超时, 读取超时)"""
+    if isinstance(value, tuple):
+        return httpx.Timeout(value[1], connect=value[0])
+    return httpx.Timeout(value)
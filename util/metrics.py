@@ -0,0 +1,83 @@
+import threading
+
+# 默认直方图分桶，单位由调用方决定（耗时一般为毫秒）
+DEFAULT_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+
+def _key(name: str, labels: dict):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={labels[k]}" for k in sorted(labels)) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                return
+        self.bucket_counts[-1] += 1
+
+    def to_dict(self):
+        bucket_map = {str(bound): self.bucket_counts[i] for i, bound in enumerate(self.buckets)}
+        bucket_map["+Inf"] = self.bucket_counts[-1]
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "avg": self.sum / self.count if self.count != 0 else 0,
+            "max": self.max,
+            "buckets": bucket_map,
+        }
+
+
+class Metrics:
+    """进程内指标，计数器、瞬时值及直方图，通过/web/metrics查看"""
+
+    def __init__(self):
+        self._counters = dict()
+        self._gauges = dict()
+        self._histograms = dict()
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value, **labels):
+        with self._lock:
+            self._gauges[_key(name, labels)] = value
+
+    def observe(self, name: str, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key, None)
+            if histogram is None:
+                histogram = Histogram(buckets)
+                self._histograms[key] = histogram
+            histogram.observe(value)
+
+    def get(self, name: str, **labels):
+        with self._lock:
+            return self._counters.get(_key(name, labels), 0)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "histograms": {key: histogram.to_dict() for key, histogram in self._histograms.items()},
+            }
+
+
+metrics = Metrics()
@@ -0,0 +1,109 @@
+import asyncio
+import time
+from dataclasses import dataclass
+
+from config.genie_config import genie_config
+
+
+@dataclass(frozen=True)
+class CoalescePolicy:
+    """流式增量内容的合并策略，max_latency_ms<=0时每段内容立即输出，max_bytes<=0时不按大小输出"""
+    max_latency_ms: int = 100
+    max_bytes: int = 256
+
+
+_policies = dict()
+
+
+def coalesce_policy(stream_type: str):
+    """按流类型读取合并策略，未配置的类型使用default，解析结果进程内缓存"""
+    policy = _policies.get(stream_type, None)
+    if policy is None:
+        conf = genie_config.stream_coalesce_dict.get(stream_type, None) \
+            or genie_config.stream_coalesce_dict.get("default", None) or {}
+        policy = CoalescePolicy(max_latency_ms=int(conf.get("max_latency_ms", CoalescePolicy.max_latency_ms)),
+                                max_bytes=int(conf.get("max_bytes", CoalescePolicy.max_bytes)))
+        _policies[stream_type] = policy
+    return policy
+
+
+class StreamCoalescer:
+    """
+    合并流式输出的增量内容：首段内容立即输出，之后距最早未输出内容超过max_latency_ms，
+    或未输出内容超过max_bytes字节时输出，先满足的条件触发
+    超时由定时器触发输出，每次add时也检查是否超时
+    """
+
+    def __init__(self, send, stream_type: str = "llm"):
+        """:send: async def send(text)，输出合并后的内容"""
+        self.send = send
+        self.policy = coalesce_policy(stream_type)
+        self.flushes = 0
+        self._buffer = list()
+        self._bytes = 0
+        self._first_time = None
+        self._timer = None
+        self._timer_task = None
+        self._lock = asyncio.Lock()
+
+    async def add(self, text: str):
+        if not text:
+            return
+        self._buffer.append(text)
+        self._bytes += len(text.encode("utf-8"))
+        if self._first_time is None:
+            self._first_time = time.monotonic()
+        if self._due():
+            await self.flush()
+        elif self._timer is None:
+            self._schedule()
+
+    async def flush(self):
+        """输出全部未输出的内容"""
+        self._cancel_timer()
+        async with self._lock:
+            if len(self._buffer) == 0:
+                return
+            text = "".join(self._buffer)
+            self._buffer.clear()
+            self._bytes = 0
+            self._first_time = None
+            try:
+                await self.send(text)
+            except asyncio.CancelledError:
+                # 定时输出被close取消时内容放回缓冲区，由最后一次输出发送
+                self._buffer.insert(0, text)
+                self._bytes += len(text.encode("utf-8"))
+                self._first_time = self._first_time or time.monotonic()
+                raise
+            self.flushes += 1
+
+    async def close(self):
+        """取消定时器及进行中的定时输出，再输出剩余内容，之后不会再有输出"""
+        self._cancel_timer()
+        task, self._timer_task = self._timer_task, None
+        if task is not None and not task.done():
+            task.cancel()
+            # 不使用await task，避免吞掉调用方自身的取消
+            await asyncio.wait([task])
+        await self.flush()
+
+    def _due(self):
+        if self.flushes == 0 or self.policy.max_latency_ms <= 0:
+            return True
+        if 0 < self.policy.max_bytes <= self._bytes:
+            return True
+        return (time.monotonic() - self._first_time) * 1000 >= self.policy.max_latency_ms
+
+    def _schedule(self):
+        delay = self.policy.max_latency_ms / 1000 - (time.monotonic() - self._first_time)
+        self._timer = asyncio.get_running_loop().call_later(max(delay, 0), self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._timer_task = asyncio.get_running_loop().create_task(self.flush())
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None